@@ -0,0 +1,594 @@
+#!/usr/bin/env python
+"""
+Benchmarks of sql module hot paths.
+
+Usage:
+    python bench.py [name ...]               run all or given benchmarks
+    python bench.py --json results.json      also write results as JSON
+    python bench.py --save-baseline          store results as the baseline
+    python bench.py --baseline bench_baseline.json --tolerance 0.2
+        compare with the baseline, exit with status 1 if any result
+        got worse by more than the tolerance
+
+Names are those of bench_* functions without the prefix, like "render".
+Baselines are machine specific, store them on the machine running the
+comparison, before changes are made.
+"""
+
+import argparse
+import collections
+import csv
+import json
+import operator
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import sql
+from sql import Param as P
+
+
+def make_db(rows, **kwargs):
+    """Return in-memory sqlite Db with Users table of given size."""
+    db = sql.Db(engine='sqlite', name=':memory:', **kwargs)
+    db._execute("""CREATE TABLE Users (
+        id integer NOT NULL PRIMARY KEY,
+        login varchar(35) NOT NULL,
+        age integer NOT NULL
+        )""")
+    sql.SqlBuilder().Insert(db.Users, 'id', 'login', 'age').Values(
+        (i, 'user%d' % i, i % 90) for i in xrange(rows)).FetchFrom(db)
+    return db
+
+
+# results of this run, name => (value, unit)
+RESULTS = collections.OrderedDict()
+# units where higher values are better, lower are better for other ones
+HIGHER_IS_BETTER = ('queries/s', )
+
+
+def record(name, value, unit):
+    """Print and store single result."""
+    RESULTS[name] = (value, unit)
+    print "%-50s %12.2f %s" % (name, value, unit)
+
+
+def best(func, number, repeat=3):
+    """Return the least time of repeated timings, it is the least noisy."""
+    return min(timeit.repeat(func, number=number, repeat=repeat))
+
+
+def report(name, seconds, number):
+    """Record time taken by number of calls as microseconds per call."""
+    record(name, seconds / number * 1e6, 'us/call')
+
+
+def bench_param_binding(number=20000):
+    """
+    Same query shape run with distinct Param values each time.
+    Inlined values produce new SQL text on every call, so sqlite
+    has to parse and plan it again; bound ones reuse cached statement.
+    """
+    for paramstyle in (None, ) + sql.PARAMSTYLES:
+        db = make_db(1000, paramstyle=paramstyle)
+        query = sql.SqlBuilder().Select(db.Users.id, db.Users.login
+            ).From(db.Users
+            ).Where(db.Users.id == P('id')).And(db.Users.age > P('age'))
+        prepared = query.Prepare(db)
+        ids = iter(xrange(10 ** 9))
+
+        def run():
+            i = ids.next()
+            list(prepared.FetchFrom(db, {'id': i % 1000, 'age': i % 90}))
+        report("prepared fetch, paramstyle=%s" % paramstyle,
+               timeit.timeit(run, number=number), number)
+
+
+def bench_execute_many(rows=20000):
+    """UPDATE by primary key for every row: FetchFrom loop vs ExecuteMany."""
+    db = make_db(rows, paramstyle='qmark')
+    query = sql.SqlBuilder().Update(db.Users).Set(age=P('age')
+        ).Where(db.Users.id == P('id'))
+
+    def loop():
+        for i in xrange(rows):
+            query.params = {'id': i, 'age': i % 50}
+            query.FetchFrom(db)
+
+    def many():
+        query.ExecuteMany(db, ({'id': i, 'age': i % 50}
+                               for i in xrange(rows)))
+    report("update loop of FetchFrom, per row", timeit.timeit(loop, number=1),
+           rows)
+    report("update ExecuteMany, per row", timeit.timeit(many, number=1), rows)
+
+
+def bench_insert(rows=200000):
+    """Bulk Insert().Values() compared to a row per statement."""
+    db = make_db(0)
+
+    def bulk():
+        sql.SqlBuilder().Insert(db.Users, 'id', 'login', 'age').Values(
+            (rows + i, 'user%d' % i, i % 90) for i in xrange(rows)
+            ).FetchFrom(db)
+
+    def single():
+        for i in xrange(rows):
+            db._execute("INSERT INTO Users(id, login, age) VALUES(?, ?, ?)",
+                        (i, 'user%d' % i, i % 90))
+        db._commit()
+    report("insert row per statement, per row",
+           timeit.timeit(single, number=1), rows)
+    report("insert bulk Values(), per row", timeit.timeit(bulk, number=1),
+           rows)
+
+
+def bench_row_access(rows=100000):
+    """Access every column of every row by name."""
+    db = make_db(rows)
+    query = sql.SqlBuilder().Select(db.Users.id, db.Users.login,
+        (db.Users.age, 'a')).From(db.Users)
+
+    def run():
+        for row in query.FetchFrom(db):
+            row.id, row.login, row.users__age, row.a
+    report("fetch and access 4 columns, per row",
+           timeit.timeit(run, number=1), rows)
+
+
+def bench_batches(rows=500000):
+    """Iterate over a large table row by row, in batches and by batches."""
+    db = make_db(rows)
+    query = sql.SqlBuilder().Select(db.Users.id, db.Users.age
+        ).From(db.Users)
+
+    def per_row():
+        for row in query.FetchFrom(db):
+            pass
+
+    def batched():
+        for row in query.FetchFrom(db, batch_size=1000):
+            pass
+
+    def by_batches():
+        for batch in query.FetchFrom(db).iter_batches(1000):
+            pass
+    report("iterate rows one by one, per row",
+           timeit.timeit(per_row, number=1), rows)
+    report("iterate rows, batch_size=1000, per row",
+           timeit.timeit(batched, number=1), rows)
+    report("iter_batches(1000), per row",
+           timeit.timeit(by_batches, number=1), rows)
+
+    def columns():
+        query.FetchColumns(db)
+    report("FetchColumns(), per row", timeit.timeit(columns, number=1), rows)
+
+
+def bench_pool(rows=100000, queries=200):
+    """
+    Read throughput of pooled Db on WAL mode database file
+    depending on number of threads. sqlite releases GIL while
+    executing, so aggregate queries run in parallel.
+    """
+    tmp = tempfile.mkdtemp()
+    try:
+        name = os.path.join(tmp, 'bench.db')
+        db = sql.Db(engine='sqlite', name=name, paramstyle='qmark')
+        db._execute("PRAGMA journal_mode=WAL")
+        db._execute("CREATE TABLE Users (id integer NOT NULL PRIMARY KEY, "
+                    "login varchar(35) NOT NULL, age integer NOT NULL)")
+        sql.SqlBuilder().Insert(db.Users, 'id', 'login', 'age').Values(
+            (i, 'user%d' % i, i % 90) for i in xrange(rows)).FetchFrom(db)
+        for threads in (1, 2, 4, 8):
+            pool = sql.Db(engine='sqlite', name=name, paramstyle='qmark',
+                          pool_size=threads)
+            query = sql.SqlBuilder().Select(sql.Count()).From(pool.Users
+                ).Where(pool.Users.age > P('age'))
+            query.params = {'age': 45}
+
+            def worker():
+                with pool.checkout():
+                    for i in xrange(queries // threads):
+                        query.FetchFrom(pool).next()
+            workers = [threading.Thread(target=worker)
+                       for i in xrange(threads)]
+            started = time.time()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            elapsed = time.time() - started
+            record("pooled reads, %d threads" % threads, queries / elapsed,
+                   'queries/s')
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_write_queue(writes=2000, threads=4):
+    """
+    Single-row UPDATEs from several threads, each committed on its own
+    compared to committed in groups by WriteQueue.
+    """
+    tmp = tempfile.mkdtemp()
+    try:
+        db = sql.Db(engine='sqlite', name=os.path.join(tmp, 'bench.db'),
+                    pool_size=threads + 1)
+        with db.checkout():
+            db._execute("CREATE TABLE Users (id integer NOT NULL "
+                        "PRIMARY KEY, age integer NOT NULL)")
+            sql.SqlBuilder().Insert(db.Users, 'id', 'age').Values(
+                (i, 0) for i in xrange(writes)).FetchFrom(db)
+        update = lambda i: sql.SqlBuilder().Update(db.Users).Set(
+            age=sql.Expr(db.Users.age) + 1).Where(db.Users.id == i)
+
+        def separate(start):
+            with db.checkout():
+                for i in xrange(start, writes, threads):
+                    update(i).FetchFrom(db)
+                    db._commit()
+        writer = sql.WriteQueue(db)
+
+        def queued(start):
+            futures = [writer.submit(update(i))
+                       for i in xrange(start, writes, threads)]
+            for future in futures:
+                future.result()
+        for name, func in (('separate commits', separate),
+                           ('write queue', queued)):
+            workers = [threading.Thread(target=func, args=(i, ))
+                       for i in xrange(threads)]
+            started = time.time()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            record("updates, %s" % name, writes / (time.time() - started),
+                   'queries/s')
+        writer.shutdown()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_sharded(rows=100000, queries=50):
+    """
+    Aggregate and ordered queries on a single file compared to the same
+    rows split between 4 shards, queried at once on worker threads.
+    """
+    tmp = tempfile.mkdtemp()
+    try:
+        db = sql.Db(engine='sqlite', name=os.path.join(tmp, 'single'))
+        sdb = sql.ShardedDb([{'engine': 'sqlite',
+                              'name': os.path.join(tmp, 'shard%d' % i)}
+                             for i in xrange(4)], key='id',
+                            bounds=[rows // 4 * i for i in xrange(1, 4)])
+        ddl = "CREATE TABLE Users (id integer NOT NULL PRIMARY KEY, " \
+            "login varchar(35) NOT NULL, age integer NOT NULL)"
+        db._execute(ddl)
+        for shard in sdb.shards:
+            with shard.checkout():
+                shard._execute(ddl)
+                shard._commit()
+        for target in (db, sdb):
+            sql.SqlBuilder().Insert(target.Users, 'id', 'login', 'age').Values(
+                (i, 'user%d' % i, i % 90) for i in xrange(rows)
+                ).FetchFrom(target)
+        for target, kind in ((db, 'single file'), (sdb, '4 shards')):
+            count = sql.SqlBuilder().Select(target.Users.age, sql.Count()
+                ).From(target.Users).Where(target.Users.login > 'user5'
+                ).GroupBy(target.Users.age)
+            top = sql.SqlBuilder().Select(target.Users.id, target.Users.login
+                ).From(target.Users).Where(target.Users.age > 45
+                ).OrderBy(target.Users.login).Limit(100)
+            for name, query in (('grouped count', count), ('top 100', top)):
+                started = time.time()
+                for i in xrange(queries):
+                    list(query.FetchFrom(target))
+                record("%s, %s" % (name, kind),
+                       queries / (time.time() - started), 'queries/s')
+        sdb.shutdown()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_result_cache(rows=100000, number=200):
+    """Aggregate dashboard query repeated with the same params."""
+    for cache_size in (None, 100):
+        db = make_db(rows, paramstyle='qmark', cache_size=cache_size)
+        query = sql.SqlBuilder().Select(db.Users.age, sql.Count()
+            ).From(db.Users).Where(db.Users.age > P('age'))
+        query.params = {'age': 45}
+        report("repeated SELECT, cache_size=%s" % cache_size,
+               timeit.timeit(lambda: list(query.FetchFrom(db)),
+                             number=number), number)
+
+
+def bench_hooks(number=20000):
+    """Small SELECT by primary key, without hooks, with one and slow log."""
+    db = make_db(1000, paramstyle='qmark')
+    query = sql.SqlBuilder().Select(db.Users.login).From(db.Users
+        ).Where(db.Users.id == P('id'))
+    query.params = {'id': 10}
+
+    def run():
+        list(query.FetchFrom(db))
+    report("SELECT, no hooks", timeit.timeit(run, number=number), number)
+    db.add_hook(lambda stats: None)
+    report("SELECT, one hook", timeit.timeit(run, number=number), number)
+    db.add_hook(sql.SlowQueryLog(1))
+    report("SELECT, hook and slow query log",
+           timeit.timeit(run, number=number), number)
+    db.add_hook(sql.MetricsRegistry())
+    report("SELECT, hooks and metrics", timeit.timeit(run, number=number),
+           number)
+    query.params = {}
+    query.Where(db.Users.id == 10)
+    report("SELECT of inlined values, hooks and metrics",
+           timeit.timeit(run, number=number), number)
+
+
+def node_size(obj):
+    """Return bytes taken by object and its instance dict, if any."""
+    attrs = getattr(obj, '__dict__', None)
+    return sys.getsizeof(obj) + (sys.getsizeof(attrs) if attrs else 0)
+
+
+def bench_construction(number=20000):
+    """Build typical query tree, and sizes of nodes it consists of."""
+    db = sql.Db(engine='sqlite', name=':memory:')
+
+    def build():
+        sql.SqlBuilder().Select(db.Users.id, (db.Users.login, 'lgn')
+            ).From(db.Users
+            ).Where(db.Users.login != 'admin'
+            ).And(db.Users.age > P('age'), db.Users.id._in_((1, 2, 3)))
+    report("build SELECT with 3 conditions", timeit.timeit(build,
+           number=number), number)
+    for node in (db.Users.id == 1, sql.Literal(1), P('x'), sql.Alias('x'),
+                 db.Users.id):
+        record("size of %s" % type(node).__name__, node_size(node), 'bytes')
+
+
+def bench_large_exprs(terms=10000, depth=500):
+    """Build and render long AND/OR chains and deeply nested Exprs."""
+    db = sql.Db(engine='sqlite', name=':memory:')
+    conds = [db.Users.id == i for i in xrange(terms)]
+    for name in ('Where', 'Or'):
+        def build():
+            query = sql.SqlBuilder().Select().From(db.Users
+                ).Where(db.Users.age > 1)
+            return getattr(query, name)(*conds)
+        query = build()
+        report("%s() of %d terms, build" % (name, terms),
+               timeit.timeit(build, number=1), 1)
+        report("%s() of %d terms, render" % (name, terms),
+               timeit.timeit(lambda: query.sql(db='sqlite'), number=1), 1)
+    for name, op in (('|', operator.or_), ('&', operator.and_)):
+        report("reduce(%s) of %d terms, build" % (name, terms),
+               timeit.timeit(lambda: reduce(op, conds), number=1), 1)
+
+    def nest():
+        expr = db.Users.id == 0
+        for i in xrange(depth):
+            expr = (expr | (db.Users.age == i)) & (db.Users.id != i)
+        return expr
+    expr = nest()
+    report("%d levels of nesting, build" % depth,
+           timeit.timeit(nest, number=1), 1)
+    report("%d levels of nesting, render" % depth,
+           timeit.timeit(lambda: expr.sql(db='sqlite'), number=1), 1)
+
+
+def bench_large_in(rows=200000, values=200000):
+    """SELECT with IN of many values, as a list and as JSON array."""
+    ids = range(0, values * 2, 2)
+    for paramstyle in (None, 'qmark'):
+        for threshold in (None, 500):
+            if paramstyle and not threshold:
+                # too many variables for sqlite
+                continue
+            tdb = make_db(rows, paramstyle=paramstyle, in_threshold=threshold)
+            query = sql.SqlBuilder().Select(sql.Count()).From(tdb.Users
+                ).Where(tdb.Users.id._in_(P('ids')))
+            query.params = {'ids': ids}
+            report("IN of %d values, paramstyle=%s, in_threshold=%s" % (
+                values, paramstyle, threshold), timeit.timeit(
+                lambda: query.FetchFrom(tdb).next(), number=1), 1)
+
+
+def bench_literals(number=20000):
+    """Convert strings needing escapes and lists of mixed values."""
+    value = "it's a \\path\\ with\ttabs and\nnewlines " * 4
+    values = [1, 'x', 2.5, None] * 25
+    for db in ('sqlite', 'mysql', 'postgres'):
+        report("escape string, db=%s" % db, timeit.timeit(
+            lambda: sql.Literal(value).sql(db=db), number=number), number)
+        report("escape unicode, db=%s" % db, timeit.timeit(
+            lambda: sql.Literal(unicode(value)).sql(db=db), number=number),
+            number)
+        report("list of 100 mixed values, db=%s" % db, timeit.timeit(
+            lambda: sql.Literal(values).sql(db=db), number=number), number)
+
+
+def bench_exprs(number=100000):
+    """Expr nodes built by operators of Fields, Literals and Params."""
+    db = sql.Db(engine='sqlite', name=':memory:')
+    users = db.Users
+    ids = iter(xrange(10 ** 9))
+    report("Field == value", best(
+        lambda: users.id == ids.next(), number=number), number)
+    report("Field == Param", best(
+        lambda: users.id == P('id'), number=number), number)
+    report("(Field + 1) * Field", best(
+        lambda: (users.age + 1) * users.id, number=number), number)
+    report("(a == 1) & ((b > 2) | (c != 'x'))", best(
+        lambda: (users.id == 1) & ((users.age > 2) | (users.login != 'x')),
+        number=number), number)
+    report("Field._in_(list of 10)", best(
+        lambda: users.id._in_(range(10)), number=number), number)
+    checked = make_db(0, check_schema=True).Users
+    report("Field == value, check_schema", best(
+        lambda: checked.id == ids.next(), number=number), number)
+    report("Field._in_(list of 10), check_schema", best(
+        lambda: checked.id._in_(range(10)), number=number), number)
+
+
+def bench_render(number=20000):
+    """SqlBuilder.sql() of representative queries."""
+    db = sql.Db(engine='sqlite', name=':memory:')
+    select = sql.SqlBuilder().Select(db.u.id, (db.u.login, 'lgn')
+        ).From((db.Users, 'u')
+        ).Where(db.u.login != 'admin'
+        ).And(db.u.age > P('age'), db.u.id._in_((1, 2, 3))
+        ).Limit(10)
+    select.params = {'age': 30}
+    update = sql.SqlBuilder().Update(db.Users).Set(
+        (db.Users.login, 'joe'), (db.Users.age, db.Users.age + 1)
+        ).Where(db.Users.id == P('id'))
+    update.params = {'id': 1}
+    join = sql.SqlBuilder().Select(db.Users.login, sql.Count()
+        ).From(db.Users
+        ).InnerJoin(db.Groups, db.Groups.id == db.Users.group_id
+        ).LeftJoin((db.Rights, 'r'), db.r.group_id == db.Groups.id,
+                   db.r.name != None
+        ).Where(db.Groups.name._in_(('admins', 'staff')))
+    for name, query in (('SELECT', select), ('UPDATE', update),
+                        ('JOIN', join)):
+        report("render %s" % name, best(
+            lambda: query.sql(db='sqlite'), number=number), number)
+    args = []
+    report("render SELECT, qmark", best(
+        lambda: select.sql(db='sqlite', paramstyle='qmark', args=args),
+        number=number), number)
+
+
+def bench_fetch(sizes=(1, 100, 10000), number=200000):
+    """End-to-end FetchFrom of tables of several sizes."""
+    for rows in sizes:
+        db = make_db(rows, paramstyle='qmark')
+        query = sql.SqlBuilder().Select(db.Users.id, db.Users.login,
+            db.Users.age).From(db.Users).Where(db.Users.age >= P('age'))
+        query.params = {'age': 0}
+        times = max(1, number // rows)
+        report("FetchFrom of %d rows, per row" % rows, best(
+            lambda: list(query.FetchFrom(db)), number=times), times * rows)
+
+
+def bench_export(rows=200000):
+    """Write whole table to a file, per format, and by iterating rows."""
+    db = make_db(rows)
+    query = sql.SqlBuilder().Select(db.Users.id, db.Users.login,
+        (db.Users.age, 'a')).From(db.Users)
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'export')
+
+        def rows_csv():
+            with open(path, 'wb') as f:
+                writer = csv.writer(f)
+                for row in query.FetchFrom(db):
+                    writer.writerow([row.id, row.login, row.a])
+        report("rows of FetchFrom to csv, per row",
+               timeit.timeit(rows_csv, number=1), rows)
+        for format in sorted(sql.EXPORTERS):
+            def export():
+                with open(path, 'wb') as f:
+                    query.ExportTo(db, f, format=format)
+            report("ExportTo(%s), per row" % format,
+                   timeit.timeit(export, number=1), rows)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_paginate(rows=200000, page_size=1000, number=20):
+    """Keyset pages at the start and at the end of a large table."""
+    db = make_db(rows, paramstyle='qmark')
+    query = sql.SqlBuilder().Select(db.Users.id, db.Users.login
+        ).From(db.Users).Where(db.Users.age > P('age'))
+    query.params = {'age': 10}
+    for depth, token in (('first', None),
+                         ('last', sql.Pages.encode(rows - page_size * 2))):
+        report("page of %d rows, %s page" % (page_size, depth), best(
+            lambda: query.Paginate(db, db.Users.id, page_size, token).next(),
+            number=number), number)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print results along with baseline ones.
+    Return list of names of results worse than baseline by more than
+    tolerance, a fraction.
+    """
+    regressions = []
+    for name, (value, unit) in results.iteritems():
+        if name not in baseline:
+            continue
+        base = baseline[name][0]
+        if not base:
+            continue
+        change = value / base - 1
+        if unit in HIGHER_IS_BETTER:
+            change = -change
+        worse = change > tolerance
+        if worse:
+            regressions.append(name)
+        print "%-50s %+8.1f%%%s" % (name, change * 100,
+                                     "  REGRESSION" if worse else "")
+    return regressions
+
+
+def main(argv=None):
+    """Run benchmarks according to command line. Return exit status."""
+    parser = argparse.ArgumentParser(description="Benchmarks of sql module")
+    parser.add_argument('names', nargs='*',
+                        help="benchmarks to run, all by default")
+    parser.add_argument('--json', help="file to write results to")
+    parser.add_argument('--baseline', default='bench_baseline.json',
+                        help="file of baseline results, %(default)s")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store results as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed slowdown, fraction, %(default)s")
+    args = parser.parse_args(argv)
+    names = args.names or BENCHMARKS
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark %s" % name)
+    for name in names:
+        print "== %s" % name
+        globals()['bench_' + name]()
+    results = dict((name, list(res)) for name, res in RESULTS.iteritems())
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print "== compared to %s" % args.baseline
+        regressions = compare(RESULTS, baseline, args.tolerance)
+        if regressions:
+            print "%d regressions found" % len(regressions)
+            return 1
+    return 0
+
+
+# in the order they are run by default
+BENCHMARKS = ['exprs', 'construction', 'render', 'literals', 'large_exprs',
+              'large_in', 'param_binding', 'execute_many', 'insert',
+              'row_access', 'fetch', 'batches', 'paginate', 'export',
+              'result_cache', 'hooks', 'pool', 'write_queue', 'sharded']
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,42 @@
 """
 This module provides utility functions for constructing SQL queries for some
-database. Currently only SELECT, UPDATE and DELETE are implemented.
+database. Currently only SELECT, INSERT, UPDATE and DELETE are implemented.
 
 Sample usage:
 ~~~~~~~~~~~~
 # connecting to database
 db = sql.Db(engine='sqlite', name='/home/joe/file')
+# or, to pass Params to the driver instead of inlining them into SQL text
+db = sql.Db(engine='sqlite', name='/home/joe/file', paramstyle='qmark')
+# or, to share a pool of connections between threads,
+# each running its queries within db.checkout() or db.transaction() blocks
+db = sql.Db(engine='sqlite', name='/home/joe/file', pool_size=8)
+# or, to run queries on worker threads, getting futures of results
+db = sql.AsyncDb(engine='sqlite', name='/home/joe/file', workers=4)
+# or, to commit writes of many threads together
+writer = sql.WriteQueue(sql.Db(engine='sqlite', name='/home/joe/file',
+                               pool_size=2))
+# or, to run queries on several files at once, split by ranges of Users.id
+db = sql.ShardedDb([{'engine': 'sqlite', 'name': '/home/joe/file1'},
+                    {'engine': 'sqlite', 'name': '/home/joe/file2'}],
+                   key='id', bounds=[1000000])
+# or, to keep results of up to 100 SELECTs for a minute
+db = sql.Db(engine='sqlite', name='/home/joe/file', cache_size=100,
+            cache_ttl=60)
+# or, to log queries running longer than half a second
+db = sql.Db(engine='sqlite', name='/home/joe/file', slow_query_time=0.5)
+# or, to collect counts and latencies of queries by their shape
+db = sql.Db(engine='sqlite', name='/home/joe/file', metrics=True)
+db.metrics.write_prometheus('/var/lib/node_exporter/sql.prom')
+# or, to reject unknown columns and comparisons of mismatched types,
+# like db.Users.login < 5, while queries are built
+db = sql.Db(engine='sqlite', name='/home/joe/file', check_schema=True)
+# or, to warn of queries scanning whole tables of more than 10000 rows
+db = sql.Db(engine='sqlite', name='/home/joe/file', full_scan_rows=10000)
+# or, to get indexes suggested for queries run
+db = sql.Db(engine='sqlite', name='/home/joe/file', index_advisor=True)
+for suggestion in db.index_advisor.suggestions():
+    suggestion['index'].FetchFrom(db)
 
 # constructing the query
     query = sql.SqlBuilder(
@@ -21,6 +52,11 @@ query.params = {'since': datetime.date(year=2010, month=1, day=1)}
 # actual execution
 rows = query.FetchFrom(db)
 
+# a query run many times may be compiled once,
+# then only parameter values are substituted on each execution
+prepared = query.Prepare(db)
+rows = prepared.FetchFrom(db, {'since': datetime.date(2011, 1, 1)})
+
 # each row returned is not just a tuple but an object that tries to map
 # its properties to table fields
 row = rows.next()
@@ -30,6 +66,15 @@ row = rows.next()
 # but also row.login and row.users__login (double underscore)
 # and row.lgn (by alias)
 
+# for numeric processing results may be fetched column by column,
+# as arrays keyed by the same names
+columns = query.FetchColumns(db)
+ids = columns['id']
+
+# large results may be written straight to a file, batch by batch
+with open('/tmp/users.csv', 'wb') as f:
+    stats = query.ExportTo(db, f, format='csv')
+
 Literal data and Parameters like strings, number, dates, sequences
 are escaped in db-specific fashion to avoid SQL injection attacks.
 
@@ -43,61 +88,2093 @@ sql.Max((db.a.b + 1) * db.b.c)) => MAX((a.b + 1) * b.c)
 Also it possible to use expressions when assigning values in UPDATE, like
 Set((db.a.b, db.a.c + 4)) => SET a.b = (a.c + 4)
 
+Rows are inserted in bulk from any iterable, chunked into multi-row
+INSERT statements within a single transaction:
+sql.SqlBuilder().Insert(db.Users, db.Users.id, db.Users.login
+    ).Values((i, 'user%d' % i) for i in xrange(1000000)).FetchFrom(db)
+
+Several queries are run in one transaction, committed at the end of block,
+or rolled back if it raises, within a block savepoints are used:
+with db.transaction():
+    sql.SqlBuilder().Delete().From(db.Users).Where(db.Users.id == 1
+        ).FetchFrom(db)
+    sql.SqlBuilder().Insert(db.Users, 'id').Values([(1, )]).FetchFrom(db)
+
 Known limitations:
 ~~~~~~~~~~~~~~~~~
+Tables named like attributes of Db, like db.schema or db.metrics, are
+    available as db.table('schema') only.
 Tables of declared fields are not checked for presence in from or join clauses.
 Also Aliases are not checked to be previously declared.
 LIKE and few other SQL lookups are not implemented.
 Only sqlite Db connection/execution is implemented, while escaping is provided
     for multiple database backends.
-No column type checking in Expressions.
+Columns and their types are checked only with Db(check_schema=True), and only
+    for tables present in the database, in comparisons of Fields.
 No checking for logical/non-logical expressions:
     first ones are more appropriate in WHERE, second are in SET.
 """
 
+import array
+import base64
+import bisect
+import collections
+import contextlib
 import copy
+import cStringIO
+import csv
 import datetime
+import decimal
+import hashlib
+import heapq
+import itertools
+import json
+import logging
 from types import NoneType
-import operator
 from collections import Iterable
+import os
+import Queue
+import re
 import sqlite3
+import sys
+import threading
+import time
+import warnings
+import weakref
 
 
 class Db(object):
     """
     Provides Db connection. Returns Tables as its properties.
+
+    Keyword arguments:
+        engine: type of database engine, only 'sqlite' is supported
+        name: database name, for sqlite it is a file name or ':memory:'
+        paramstyle: when set, Params are not inlined in SQL text but passed
+            to the driver separately, 'qmark' (?) or 'named' (:name) style.
+            This allows the driver to reuse its compiled statements.
+        pool_size: when set, Db keeps a pool of up to that many connections
+            to be shared by threads, see .checkout(). Queries run outside
+            of checkout() and transaction() blocks raise.
+        pool_timeout: seconds to wait for a free pooled connection,
+            forever by default
+        in_threshold: sequences longer than that, used with IN, are
+            passed to the database as a single JSON array, 500 by default
+            when sqlite has json_each(), of JSON1 extension, None otherwise.
+            None turns it off.
+        cache_size: when set, results of up to that many SELECTs run
+            through SqlBuilder are kept, and replayed for the same SQL and
+            params. Least recently used ones are dropped first.
+            Writes run through SqlBuilder drop results of tables they touch,
+            others should be followed by .invalidate(). They are dropped
+            again on commit, so results read by other connections of pool
+            meanwhile are not kept. In pool mode, SELECTs run within
+            a transaction, or after uncommitted writes, bypass the cache.
+        cache_ttl: seconds cached results are kept for, forever by default
+        cache_rows: results of more rows than that, 10000 by default,
+            are not cached, but read from the cursor as usual.
+            Results read in batches are never stored, only replayed.
+        slow_query_time: when set, queries taking longer than that many
+            seconds are logged and kept in .slow_queries, see SlowQueryLog
+        metrics: when True, calls, errors, latencies and row counts are
+            collected per query shape in .metrics, see MetricsRegistry
+        check_schema: when True, Fields of tables known to .schema are
+            checked for presence, and their comparisons for compatible
+            types of operands, raising SchemaError. Names of tables not
+            found in the database, like aliases, are not checked.
+        index_advisor: when True, Fields queries filter, join and order by
+            are recorded in .index_advisor, see IndexAdvisor
+        full_scan_rows: when set, plans of queries are checked before
+            execution, and FullScanWarning is issued for those scanning
+            whole tables of more rows than that. It costs additional
+            queries, so it is meant for tests.
+
+    Timings of queries run through SqlBuilder and PreparedQuery
+    are reported to callbacks added with .add_hook()
+
+    Tables named like attributes and methods of Db, such as schema,
+    metrics, dialect, transaction or checkout, are not returned as its
+    properties, use .table(name) for them.
+    """
+    def __init__(self, **kwargs):
+        # Tables are created once per name
+        self._tables = {}
+        self._settings = {
+            'engine': kwargs['engine'],
+            'name': kwargs['name'],
+            'paramstyle': kwargs.get('paramstyle'),
+            'pool_size': kwargs.get('pool_size'),
+            'pool_timeout': kwargs.get('pool_timeout'),
+            'in_threshold': kwargs['in_threshold'] if 'in_threshold' in kwargs
+                else 500 if sqlite_json_arrays() else None,
+            'cache_size': kwargs.get('cache_size'),
+            'cache_ttl': kwargs.get('cache_ttl'),
+            'cache_rows': kwargs.get('cache_rows', 10000),
+            'slow_query_time': kwargs.get('slow_query_time'),
+            'metrics': kwargs.get('metrics', False),
+            'full_scan_rows': kwargs.get('full_scan_rows'),
+            'check_schema': kwargs.get('check_schema', False),
+            'index_advisor': kwargs.get('index_advisor', False),
+        }
+        if self._settings['paramstyle'] not in (None, ) + PARAMSTYLES:
+            raise Exception(
+                "Paramstyle %s unknown" % self._settings['paramstyle'])
+        # Only sqlite for now
+        if self._settings['engine'] != 'sqlite':
+            raise Exception("DB Backend not Implemented")
+        self.dialect = get_dialect(self._settings['engine'])
+        self.schema = Schema(self)
+        self._cache = ResultCache(self._settings['cache_size'],
+            self._settings['cache_ttl']) if self._settings['cache_size'] \
+            else None
+        self._hooks = []
+        # stats of SELECTs garbage collected before being reported
+        self._dropped = collections.deque()
+        self.slow_queries = None
+        if self._settings['slow_query_time'] is not None:
+            self.slow_queries = SlowQueryLog(
+                self._settings['slow_query_time'])
+            self.add_hook(self.slow_queries)
+        self.metrics = None
+        if self._settings['metrics']:
+            self.metrics = MetricsRegistry()
+            self.add_hook(self.metrics)
+        self.index_advisor = None
+        if self._settings['index_advisor']:
+            self.index_advisor = IndexAdvisor(self)
+            self.add_hook(self.index_advisor)
+        # connection of thread in pool mode, depth of transaction() blocks
+        self._local = threading.local()
+        if self._settings['pool_size']:
+            if self._settings['name'] == ':memory:':
+                raise Exception("Connection pool requires database file")
+            self.__connection = None
+            self._pool = ConnectionPool(self._connect,
+                self._settings['pool_size'], self._settings['pool_timeout'])
+        else:
+            self._pool = None
+            self.__connection = self._connect()
+
+    def _connect(self):
+        """Open new connection to the database. Return it."""
+        # pooled connections are passed between threads, never shared
+        return sqlite3.connect(self._settings['name'],
+                               check_same_thread=self._pool is None)
+
+    def _connection(self):
+        """
+        Return connection to be used by current thread.
+        In pool mode it is the one checked out with .checkout(),
+        connections are never kept by threads outside of it.
+        """
+        if self._pool is None:
+            return self.__connection
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            raise Exception("No pooled connection checked out, "
+                            "run queries within db.checkout() block")
+        return connection
+
+    def release(self):
+        """
+        Return connection used by current thread to the pool.
+        Uncommitted changes are rolled back.
+        """
+        if self._pool is None:
+            return
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            self._local.connection = None
+            # rolled back, so nothing to invalidate
+            self._local.written = None
+            self._pool.release(connection)
+
+    @contextlib.contextmanager
+    def checkout(self):
+        """
+        Context manager keeping pooled connection with current thread
+        for the duration of the block, returning it to the pool on exit,
+        unless the thread had it before the block.
+
+        Usage:
+            with db.checkout():
+                rows = list(query.FetchFrom(db))
+        """
+        held = getattr(self._local, 'connection', None) is not None
+        if self._pool is not None and not held:
+            self._local.connection = self._pool.acquire()
+        try:
+            yield self
+        finally:
+            if not held:
+                self.release()
+
+    def _execute(self, query, args=()):
+        """Execute given SQL with given DB-API args, return cursor."""
+        if self._settings['engine']:
+            return self._connection().execute(query, args)
+        else:
+            raise Exception("DB Backend not Implemented")
+
+    def _executemany(self, query, seq_of_args):
+        """Execute given SQL once per item of seq_of_args, return cursor."""
+        if self._settings['engine']:
+            return self._connection().executemany(query, seq_of_args)
+        else:
+            raise Exception("DB Backend not Implemented")
+
+    def add_hook(self, func):
+        """
+        Call func(stats) with QueryStats of each query once it is done,
+        that is after its rows are exhausted for SELECT, or its
+        ResultIterator is closed. Stats of those garbage collected before
+        are passed along with the next query reported.
+        Hooks are called in the thread running the query.
+        """
+        self._hooks = self._hooks + [func]
+
+    def remove_hook(self, func):
+        """Stop calling func added with .add_hook()"""
+        self._hooks = [f for f in self._hooks if f != func]
+
+    def _report(self, stats):
+        """
+        Pass stats of finished query to hooks, after those of queries
+        whose rows were dropped unread since the last call.
+        """
+        dropped = self._dropped
+        while dropped:
+            try:
+                earlier = dropped.popleft()
+            except IndexError:
+                # taken by another thread
+                break
+            for func in self._hooks:
+                func(earlier)
+        for func in self._hooks:
+            func(stats)
+
+    def _run(self, query, args, source, stats=None, store=True):
+        """
+        Execute SQL rendered from source, SqlBuilder or PreparedQuery.
+        Return cursor. SELECTs go through the result cache of Db,
+        other queries invalidate results of tables they touch.
+        With store False, results of SELECT are not stored in the cache,
+        for those read in batches.
+
+        With QueryStats given, execution is timed and reported to hooks,
+        rows of SELECT are counted and timed while fetched.
+        """
+        if self._settings['full_scan_rows'] is not None:
+            self._check_scans(query, args, source)
+        if stats is None:
+            return self.__run(query, args, source, store)
+        stats.sql = query
+        stats.args = args
+        started = time.time()
+        try:
+            cursor = self.__run(query, args, source, store)
+        except Exception, e:
+            stats.execute = time.time() - started
+            stats.error = e
+            self._report(stats)
+            raise
+        stats.execute = time.time() - started
+        if source.query_type == SELECT:
+            stats.cached = isinstance(cursor, CachedCursor) and cursor.hit
+            return TimedCursor(cursor, stats, self)
+        stats.rows = cursor.rowcount
+        self._report(stats)
+        return cursor
+
+    def __run(self, query, args, source, store=True):
+        """Execute SQL rendered from source without timing. Return cursor.
+        """
+        if source.query_type == SELECT:
+            return self._select(query, args, source, store)
+        cursor = self._execute(query, args)
+        self._wrote(source.tables())
+        return cursor
+
+    def _check_scans(self, query, args, source):
+        """Warn if the query would scan whole tables above the size limit.
+        """
+        limit = self._settings['full_scan_rows']
+        aliases = source.aliases()
+        for name in explain_plan(self, query, args).full_scans():
+            table = aliases.get(name.lower(), name)
+            try:
+                size = self._execute(
+                    'SELECT COUNT(*) FROM "%s"' % table).fetchone()[0]
+            except sqlite3.Error:
+                # not a table, like a view
+                continue
+            if size > limit:
+                warnings.warn(FullScanWarning(
+                    "Full scan of %s, %d rows: %s" % (table, size, query)),
+                    stacklevel=4)
+
+    def _select(self, query, args, source, store=True):
+        """
+        Execute SELECT through the result cache, when it is on.
+        Return cursor, CachedCursor for cached results.
+        source is SqlBuilder or PreparedQuery the SQL was rendered from.
+        Results are stored unless store is False, or they have more than
+        cache_rows rows.
+        """
+        if self._cache is None or self._uncommitted():
+            return self._execute(query, args)
+        try:
+            key = (query, tuple(sorted(args.iteritems()))
+                   if isinstance(args, dict) else tuple(args))
+            result = self._cache.get(key)
+        except TypeError:
+            # unhashable args are never cached
+            return self._execute(query, args)
+        if result is not None:
+            return CachedCursor(*result)
+        cursor = self._execute(query, args)
+        if not store:
+            return cursor
+        limit = self._settings['cache_rows']
+        rows = cursor.fetchmany(limit + 1)
+        if len(rows) > limit:
+            return PeekedCursor(rows, cursor)
+        result = (cursor.description, tuple(rows))
+        self._cache.put(key, source.tables(), result)
+        return CachedCursor(*result, hit=False)
+
+    def _uncommitted(self):
+        """
+        Return True when connection of current thread, in pool mode,
+        may be in the middle of a transaction, so it sees what others
+        do not, or does not see what was committed since it started.
+        """
+        return self._pool is not None and bool(
+            getattr(self._local, 'depth', 0)
+            or getattr(self._local, 'written', None))
+
+    def _wrote(self, tables):
+        """
+        Drop cached results of given tables, written by current thread.
+        In pool mode, they are dropped again once the write is committed,
+        since other connections may have cached what was there before.
+        """
+        if self._cache is None:
+            return
+        self.invalidate(*tables)
+        if self._pool is not None:
+            written = getattr(self._local, 'written', None)
+            if written is None:
+                written = self._local.written = set()
+            written.update(tables)
+
+    def _committed(self):
+        """Drop cached results of tables written by the committed transaction.
+        """
+        written = getattr(self._local, 'written', None)
+        if written:
+            self._local.written = None
+            self.invalidate(*written)
+
+    def invalidate(self, *tables):
+        """
+        Drop cached results of SELECTs reading any of given tables,
+        Tables or names. Drop all of them when no tables are given.
+        """
+        if self._cache is not None:
+            self._cache.invalidate(
+                set(str(t).lower() for t in tables) if tables else None)
+
+    def _commit(self):
+        """Commit current transaction, unless in transaction() block,
+        which commits on exit.
+        """
+        if not getattr(self._local, 'depth', 0):
+            self._connection().commit()
+            self._committed()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Context manager running statements of the block in one transaction,
+        committed on exit, rolled back when the block raises.
+        Nested blocks are savepoints, rolled back on their own.
+        Statements run before the outermost block are committed.
+        In pool mode, connection is checked out for the block, see
+        .checkout()
+
+        Usage:
+            with db.transaction():
+                query.FetchFrom(db)
+                try:
+                    with db.transaction():
+                        other_query.FetchFrom(db)
+                except sqlite3.IntegrityError:
+                    pass
+        """
+        with self.checkout():
+            with self._transaction():
+                yield self
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Run the block of .transaction() on connection of the thread."""
+        connection = self._connection()
+        depth = getattr(self._local, 'depth', 0)
+        name = 'sp%d' % depth
+        if depth:
+            connection.execute('SAVEPOINT ' + name)
+        else:
+            isolation_level = connection.isolation_level
+            # sqlite3 module must not begin or commit on its own meanwhile
+            connection.isolation_level = None
+            connection.execute('BEGIN')
+        self._local.depth = depth + 1
+        try:
+            try:
+                yield self
+            except:
+                if depth:
+                    connection.execute('ROLLBACK TO ' + name)
+                    connection.execute('RELEASE ' + name)
+                else:
+                    connection.execute('ROLLBACK')
+                    self._local.written = None
+                # results may have been cached from changes rolled back
+                self.invalidate()
+                raise
+            if depth:
+                connection.execute('RELEASE ' + name)
+            else:
+                try:
+                    connection.execute('COMMIT')
+                except:
+                    connection.execute('ROLLBACK')
+                    self._local.written = None
+                    self.invalidate()
+                    raise
+                self._committed()
+        finally:
+            self._local.depth = depth
+            if not depth:
+                connection.isolation_level = isolation_level
+
+    # queries are run by SqlBuilder itself, see ShardedDb
+    sharded = False
+
+    def table(self, name):
+        """Return Table with given name, the same one for the same name."""
+        try:
+            return self._tables[name]
+        except KeyError:
+            table = self._tables[name] = Table(name,
+                self.schema if self._settings['check_schema'] else None)
+            return table
+
+    def __getattr__(self, name):
+        """Return Table with given name, see .table()"""
+        return self.table(name)
+
+
+# whether sqlite library has json_each(), None until checked
+_sqlite_json_arrays = None
+
+
+def sqlite_json_arrays():
+    """
+    Return True if sqlite library supports json_each(), it is missing
+    from builds without JSON1 extension.
+    """
+    global _sqlite_json_arrays
+    if _sqlite_json_arrays is None:
+        try:
+            sqlite3.connect(':memory:').execute(
+                "SELECT value FROM json_each('[1]')").fetchall()
+            _sqlite_json_arrays = True
+        except sqlite3.OperationalError:
+            _sqlite_json_arrays = False
+    return _sqlite_json_arrays
+
+
+class SchemaError(Exception):
+    """Raised for unknown columns and mismatched types of operands."""
+
+
+class Schema(object):
+    """
+    Tables and columns of the database, with type affinities of columns,
+    loaded on first use. Call .refresh() once tables are altered.
+    """
+    # Python types of values fitting columns of given affinity,
+    # strings fit numeric columns when they hold numbers.
+    # Columns of NUMERIC and BLOB affinity accept anything.
+    compatible = {
+        'INTEGER': (int, long, float, bool, decimal.Decimal, NoneType),
+        'REAL': (int, long, float, bool, decimal.Decimal, NoneType),
+        'TEXT': (basestring, datetime.date, datetime.time, NoneType),
+    }
+
+    def __init__(self, db):
+        """Initialize schema of Db, not loaded yet."""
+        self.db = db
+        self.tables = None
+
+    def refresh(self):
+        """
+        Load tables and views with their columns from the database.
+        Tables are keyed by lowercase name, each is a dict of lowercase
+        column name => type affinity.
+        """
+        tables = {}
+        # in pool mode, the connection is not kept by the thread
+        # building Exprs, like event loop of AsyncDb
+        with self.db.checkout():
+            for name, in self.db._execute(
+                    "SELECT name FROM sqlite_master "
+                    "WHERE type IN ('table', 'view')").fetchall():
+                tables[name.lower()] = dict(
+                    (column[1].lower(), self.affinity(column[2]))
+                    for column in self.db._execute(
+                        'PRAGMA table_info("%s")' % name.replace('"', '""')))
+        self.tables = tables
+
+    @staticmethod
+    def affinity(declared_type):
+        """Return affinity of column of declared type, by sqlite rules."""
+        declared_type = (declared_type or '').upper()
+        if 'INT' in declared_type:
+            return 'INTEGER'
+        if 'CHAR' in declared_type or 'CLOB' in declared_type \
+                or 'TEXT' in declared_type:
+            return 'TEXT'
+        if not declared_type or 'BLOB' in declared_type:
+            return 'BLOB'
+        if 'REAL' in declared_type or 'FLOA' in declared_type \
+                or 'DOUB' in declared_type:
+            return 'REAL'
+        return 'NUMERIC'
+
+    def columns(self, table):
+        """Return dict of columns of table with given name, or None."""
+        if self.tables is None:
+            self.refresh()
+        return self.tables.get(str(table).lower())
+
+    def check_field(self, table, name):
+        """Raise SchemaError if known table has no column of given name."""
+        columns = self.columns(table)
+        if columns is not None and name.lower() not in columns:
+            raise SchemaError("Table %s has no column %s" % (table, name))
+
+    def check(self, field, other, operator):
+        """Raise SchemaError if Field can not be compared to other."""
+        columns = self.columns(field.table)
+        affinity = columns and columns.get(field.name.lower())
+        if affinity not in self.compatible:
+            return
+        if isinstance(other, Literal):
+            other = other.value
+        if operator == 'IN' and isinstance(other, Iterable) \
+                and not isinstance(other, basestring):
+            values = other
+        else:
+            values = (other, )
+        for value in values:
+            if isinstance(value, Literal):
+                value = value.value
+            if isinstance(value, Field):
+                columns = self.columns(value.table)
+                other_affinity = columns and columns.get(value.name.lower())
+                if (affinity == 'TEXT') != (other_affinity == 'TEXT') \
+                        and other_affinity in self.compatible:
+                    raise SchemaError("%s of %s type compared to %s of %s"
+                        % (field, affinity, value, other_affinity))
+            elif isinstance(value, Overloaded):
+                # values of Params and Exprs are unknown
+                continue
+            elif not isinstance(value, self.compatible[affinity]) \
+                    and not (affinity != 'TEXT' and is_number(value)):
+                raise SchemaError("%s of %s type compared to %r" % (
+                    field, affinity, value))
+
+
+def is_number(value):
+    """Return True if value is a string holding a number."""
+    try:
+        float(value)
+        return isinstance(value, basestring)
+    except (TypeError, ValueError):
+        return False
+
+
+class FullScanWarning(UserWarning):
+    """
+    Issued by Db with full_scan_rows set for queries scanning large tables.
+    Tests may turn it into an error:
+        warnings.simplefilter('error', sql.FullScanWarning)
+    """
+
+
+class PlanNode(object):
+    """
+    Step of a query plan, as reported by EXPLAIN QUERY PLAN.
+    The root node has no detail, its children are top level steps.
+    """
+    __slots__ = ('id', 'detail', 'children')
+    # SCAN of a table without an index, in formats of old and new sqlite
+    full_scan_re = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?$')
+
+    def __init__(self, id, detail=None):
+        """Initialize node without children."""
+        self.id = id
+        self.detail = detail
+        self.children = []
+
+    def __repr__(self):
+        return "<PlanNode:%s>" % self.detail
+
+    def __iter__(self):
+        """Iterate over all nodes below this one, depth first."""
+        for child in self.children:
+            yield child
+            for node in child:
+                yield node
+
+    def full_scans(self):
+        """Return list of tables or aliases scanned without index."""
+        res = []
+        for node in self:
+            match = self.full_scan_re.match(node.detail)
+            if match:
+                res.append(match.group(2) or match.group(1))
+        return res
+
+    def dump(self, indent=0):
+        """Return the plan as text, indented like sqlite3 shell does."""
+        lines = []
+        for child in self.children:
+            lines.append("%s%s" % ("  " * indent, child.detail))
+            if child.children:
+                lines.append(child.dump(indent + 1))
+        return "\n".join(lines)
+
+
+def explain_plan(db, query, args=()):
+    """Return PlanNode tree of SQL query run with args on Db."""
+    root = PlanNode(0)
+    nodes = {0: root}
+    for id, parent, notused, detail in db._execute(
+            "EXPLAIN QUERY PLAN " + query, args):
+        node = nodes[id] = PlanNode(id, detail)
+        # parents are reported before their children
+        nodes.get(parent, root).children.append(node)
+    return root
+
+
+class ConnectionPool(object):
+    """
+    Thread safe pool of database connections, created on demand
+    up to max_size. Each connection is used by one thread at a time.
+    """
+    def __init__(self, connect, max_size, timeout=None):
+        """
+        Initialize empty pool.
+        connect is a callable returning new connection,
+        timeout is seconds .acquire() waits for a free one, None is forever.
+        """
+        self.connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.size = 0
+        # last released connection is the first reused, it is warmer
+        self.idle = Queue.LifoQueue()
+        self.lock = threading.Lock()
+        # called with no arguments once a connection is released
+        self.on_release = None
+
+    def acquire(self, block=True):
+        """
+        Take idle connection or create a new one. Return connection.
+        When all are in use, wait for one, or return None if not block.
+        """
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self.lock:
+            create = self.size < self.max_size
+            if create:
+                self.size += 1
+        if create:
+            try:
+                return self.connect()
+            except:
+                with self.lock:
+                    self.size -= 1
+                raise
+        if not block:
+            return None
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except Queue.Empty:
+            raise Exception("No free connection in %s seconds" % self.timeout)
+
+    def release(self, connection):
+        """Roll back what was left uncommitted and return connection."""
+        connection.rollback()
+        self.idle.put(connection)
+        if self.on_release is not None:
+            self.on_release()
+
+
+class ResultCache(object):
+    """
+    Thread safe LRU mapping of query key => result, with optional TTL.
+    Each result is recorded with names of tables it was read from.
+    """
+    def __init__(self, max_size, ttl=None):
+        """Initialize empty cache of up to max_size results."""
+        self.max_size = max_size
+        self.ttl = ttl
+        # key => (expiry time or None, tables, result), oldest first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return result stored for key, or None."""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] < time.time():
+                return None
+            # now it is the most recently used
+            self.entries[key] = entry
+            return entry[2]
+
+    def put(self, key, tables, result):
+        """Store result read from given set of lowercase table names."""
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, tables, result)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, tables=None):
+        """Drop results read from any of tables, all if tables is None."""
+        with self.lock:
+            if tables is None:
+                self.entries.clear()
+                return
+            for key, entry in self.entries.items():
+                if not tables.isdisjoint(entry[1]):
+                    del self.entries[key]
+
+
+class CachedCursor(object):
+    """
+    Replays rows stored by ResultCache, having the part of DB-API cursor
+    interface ResultIterator and FetchColumns rely on.
+    """
+    def __init__(self, description, rows, hit=True):
+        """
+        Initialize with cursor description and sequence of rows.
+        hit is False when rows were just fetched to be cached.
+        """
+        self.description = description
+        self.rows = rows
+        self.hit = hit
+        self.pos = 0
+        self.arraysize = 1
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Return next row."""
+        if self.pos >= len(self.rows):
+            raise StopIteration
+        self.pos += 1
+        return self.rows[self.pos - 1]
+
+    def fetchmany(self, size=None):
+        """Return list of up to size next rows, arraysize by default."""
+        start = self.pos
+        self.pos = min(start + (size or self.arraysize), len(self.rows))
+        return list(self.rows[start:self.pos])
+
+    def fetchall(self):
+        """Return list of all remaining rows."""
+        start, self.pos = self.pos, len(self.rows)
+        return list(self.rows[start:])
+
+
+class PeekedCursor(object):
+    """
+    Cursor with rows fetched ahead put back in front of the rest of them,
+    having the same part of DB-API cursor interface CachedCursor has.
+    """
+    def __init__(self, rows, cursor):
+        """Initialize with list of rows fetched from cursor already."""
+        self.rows = rows
+        self.cursor = cursor
+        self.description = cursor.description
+        self.pos = 0
+        self.arraysize = 1
+
+    def __iter__(self):
+        return self
+
+    def _take(self, size):
+        """Return list of up to size rows fetched ahead, drop them."""
+        res = self.rows[self.pos:self.pos + size]
+        self.pos += len(res)
+        if self.pos >= len(self.rows):
+            self.rows = []
+            self.pos = 0
+        return res
+
+    def next(self):
+        """Return next row."""
+        if self.rows:
+            return self._take(1)[0]
+        return self.cursor.next()
+
+    def fetchmany(self, size=None):
+        """Return list of up to size next rows, arraysize by default."""
+        size = size or self.arraysize
+        res = self._take(size)
+        if len(res) < size:
+            res.extend(self.cursor.fetchmany(size - len(res)))
+        return res
+
+    def fetchall(self):
+        """Return list of all remaining rows."""
+        res = self._take(len(self.rows))
+        res.extend(self.cursor.fetchall())
+        return res
+
+    def close(self):
+        """Close the cursor."""
+        self.rows = []
+        self.cursor.close()
+
+
+class QueryStats(object):
+    """
+    Timings of a query passed to Db hooks, in seconds.
+
+    Attributes:
+        query_type: SELECT, UPDATE, DELETE or INSERT
+        sql: SQL text executed
+        args: values bound to it, when Db has paramstyle
+        params: Params of the query
+        build: time from creation of SqlBuilder to its first execution,
+            None for later executions and PreparedQuery
+        render: time taken by rendering SQL text
+        execute: time taken by the database to execute it
+        fetch: time taken by fetching rows of SELECT
+        rows: number of rows fetched, or affected by other queries
+        cached: whether rows were taken from the result cache
+        error: exception raised, if any
+        source: SqlBuilder or PreparedQuery run
+    """
+    __slots__ = ('query_type', 'sql', 'args', 'params', 'build', 'render',
+                 'execute', 'fetch', 'rows', 'cached', 'error', 'source')
+
+    def __init__(self, source, params=None):
+        """Initialize stats of query not run yet."""
+        self.source = source
+        self.query_type = source.query_type
+        self.params = params
+        self.sql = None
+        self.args = ()
+        self.build = None
+        self.render = self.execute = self.fetch = 0.0
+        self.rows = None
+        self.cached = False
+        self.error = None
+
+    def duration(self):
+        """Return time the query took to render, execute and fetch."""
+        return self.render + self.execute + self.fetch
+
+    def __repr__(self):
+        return "<QueryStats:%s %.6fs rows=%s>" % (
+            self.query_type, self.duration(), self.rows)
+
+
+class TimedCursor(object):
+    """
+    Wraps cursor of SELECT, timing and counting rows fetched from it.
+    Stats are reported once rows are exhausted or fetching fails,
+    or once it is closed before that, with rows fetched so far.
+    When garbage collected before, they are queued to be reported with
+    the next query, hooks are not called by the garbage collector.
+    """
+    def __init__(self, cursor, stats, db):
+        """Initialize with cursor, its QueryStats and Db to report to."""
+        self.cursor = cursor
+        self.stats = stats
+        self.db = db
+        self.description = cursor.description
+        stats.rows = 0
+
+    def _get_arraysize(self):
+        return self.cursor.arraysize
+
+    def _set_arraysize(self, size):
+        self.cursor.arraysize = size
+
+    arraysize = property(_get_arraysize, _set_arraysize)
+
+    def __iter__(self):
+        return self
+
+    def _fetched(self, started, rows, done=False, error=None):
+        """Account rows fetched since started, report stats when done."""
+        stats = self.stats
+        if stats is None:
+            return
+        stats.fetch += time.time() - started
+        stats.rows += rows
+        if done or error is not None:
+            stats.error = error
+            self.stats = None
+            self.db._report(stats)
+
+    def next(self):
+        """Return next row."""
+        started = time.time()
+        try:
+            row = self.cursor.next()
+        except StopIteration:
+            self._fetched(started, 0, True)
+            raise
+        except Exception, e:
+            self._fetched(started, 0, error=e)
+            raise
+        self._fetched(started, 1)
+        return row
+
+    def fetchmany(self, size=None):
+        """Return list of up to size next rows, arraysize by default."""
+        started = time.time()
+        try:
+            rows = self.cursor.fetchmany(size or self.cursor.arraysize)
+        except Exception, e:
+            self._fetched(started, 0, error=e)
+            raise
+        self._fetched(started, len(rows), not rows)
+        return rows
+
+    def fetchall(self):
+        """Return list of all remaining rows."""
+        started = time.time()
+        try:
+            rows = self.cursor.fetchall()
+        except Exception, e:
+            self._fetched(started, 0, error=e)
+            raise
+        self._fetched(started, len(rows), True)
+        return rows
+
+    def close(self):
+        """Close the cursor, report stats if they were not yet."""
+        self._fetched(time.time(), 0, True)
+        close = getattr(self.cursor, 'close', None)
+        if close is not None:
+            close()
+
+    def __del__(self):
+        """Queue stats of rows left unread to be reported."""
+        stats, self.stats = self.stats, None
+        if stats is not None:
+            self.db._dropped.append(stats)
+
+
+class SlowQueryLog(object):
+    """
+    Db hook keeping QueryStats of queries that took longer than threshold
+    seconds, up to size most recent ones, and logging them as warnings.
+    """
+    logger = logging.getLogger('sql.slow')
+
+    def __init__(self, threshold, size=100):
+        """Initialize empty log."""
+        self.threshold = threshold
+        self.entries = collections.deque(maxlen=size)
+
+    def __call__(self, stats):
+        """Record stats of the query if it was slow."""
+        if stats.duration() < self.threshold:
+            return
+        self.entries.append(stats)
+        self.logger.warning("Slow query, %.3fs (render %.3fs, execute %.3fs,"
+            " fetch %.3fs), %s rows: %s; params %r", stats.duration(),
+            stats.render, stats.execute, stats.fetch, stats.rows,
+            stats.sql, stats.args or stats.params)
+
+
+class Histogram(object):
+    """Counts of observed values falling into buckets, and their sum."""
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        """Initialize with sorted upper bounds of buckets, +Inf is implied.
+        """
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        """Count the value in its bucket."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def buckets(self):
+        """Return list of (upper bound, cumulative count), last is +Inf."""
+        res = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'), ), self.counts):
+            total += count
+            res.append((bound, total))
+        return res
+
+
+class MetricsRegistry(object):
+    """
+    Db hook aggregating QueryStats by query shape, see
+    SqlBuilder.fingerprint(): counts of calls and errors,
+    histograms of latencies and of row counts.
+
+    Usage:
+        db.add_hook(sql.MetricsRegistry()), or Db(metrics=True)
+        db.metrics.as_dict()
+        db.metrics.write_prometheus(path)
+    """
+    latency_buckets = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+    rows_buckets = (0, 1, 10, 100, 1000, 10000, 100000)
+    # fingerprints of SQL texts seen, it is the same for all executions
+    # of a shape when Params are bound natively
+    max_known_sql = 10000
+
+    def __init__(self):
+        """Initialize empty registry."""
+        self.shapes = {}
+        self.known_sql = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, stats):
+        """Account finished query."""
+        if stats.sql is None:
+            # like INSERT of dicts, SQL differs by their keys, so shape
+            # of each is taken
+            fingerprint = stats.source.fingerprint()
+        else:
+            fingerprint = self.known_sql.get(stats.sql)
+        if fingerprint is None:
+            fingerprint = stats.source.fingerprint()
+            if len(self.known_sql) >= self.max_known_sql:
+                self.known_sql.clear()
+            self.known_sql[stats.sql] = fingerprint
+        with self.lock:
+            shape = self.shapes.get(fingerprint)
+            if shape is None:
+                shape = self.shapes[fingerprint] = {
+                    'query_type': stats.query_type,
+                    'shape': stats.source.shape(),
+                    'calls': 0,
+                    'errors': 0,
+                    'latency': Histogram(self.latency_buckets),
+                    'rows': Histogram(self.rows_buckets),
+                }
+            shape['calls'] += 1
+            if stats.error is not None:
+                shape['errors'] += 1
+            shape['latency'].observe(stats.duration())
+            if stats.rows is not None:
+                shape['rows'].observe(stats.rows)
+
+    def as_dict(self):
+        """
+        Return dict of fingerprint => dict of query_type, shape, calls,
+        errors, and latency and rows histograms, each a dict of sum and
+        buckets, list of (upper bound, cumulative count).
+        """
+        with self.lock:
+            return dict((fingerprint, dict(shape,
+                latency={'sum': shape['latency'].sum,
+                         'buckets': shape['latency'].buckets()},
+                rows={'sum': shape['rows'].sum,
+                      'buckets': shape['rows'].buckets()}))
+                for fingerprint, shape in self.shapes.iteritems())
+
+    def prometheus(self):
+        """Return metrics in Prometheus text exposition format."""
+        lines = []
+        metrics = sorted(self.as_dict().iteritems())
+        for name, kind, doc in (
+                ('sql_queries_total', 'counter', 'Queries executed'),
+                ('sql_query_errors_total', 'counter', 'Queries failed'),
+                ('sql_query_duration_seconds', 'histogram',
+                 'Time to render, execute and fetch query'),
+                ('sql_query_rows', 'histogram',
+                 'Rows fetched or affected by query')):
+            lines.append("# HELP %s %s" % (name, doc))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for fingerprint, shape in metrics:
+                labels = 'fingerprint="%s",type="%s"' % (
+                    fingerprint, shape['query_type'])
+                if kind == 'counter':
+                    lines.append("%s{%s} %d" % (name, labels, shape[
+                        'calls' if name == 'sql_queries_total'
+                        else 'errors']))
+                    continue
+                hist = shape['latency' if name.endswith('seconds')
+                             else 'rows']
+                for bound, count in hist['buckets']:
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (
+                        name, labels, "+Inf" if bound == float('inf')
+                        else repr(bound), count))
+                lines.append("%s_sum{%s} %r" % (name, labels, hist['sum']))
+                lines.append("%s_count{%s} %d" % (
+                    name, labels, shape['calls']))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """
+        Write metrics in Prometheus text format to the file at path.
+        The file is replaced at once, so that collectors never see
+        it half written.
+        """
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.rename(tmp, path)
+
+
+class IndexAdvisor(object):
+    """
+    Db hook recording columns queries filter, join and order by,
+    with number of calls and time taken, and suggesting indexes
+    for those not served by existing ones.
+
+    For each table a query uses, columns compared for equality or joined
+    come first in the suggested index, followed by one column compared
+    by range, or by ORDER BY and GROUP BY columns. Columns of each
+    branch of OR get an index of their own.
     """
-    _settings = {}
+    # predicates of SQL texts seen, see MetricsRegistry
+    max_known_sql = 10000
+
+    def __init__(self, db):
+        """Initialize advisor of Db with nothing recorded."""
+        self.db = db
+        # (table, column, kind) => [calls, seconds]
+        self.columns = {}
+        # (table, equality columns, range column, order columns)
+        # => [calls, seconds]
+        self.patterns = {}
+        self.known_sql = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, stats):
+        """Record predicates of finished query."""
+        if stats.query_type == INSERT:
+            return
+        groups = self.known_sql.get(stats.sql)
+        if groups is None:
+            groups = stats.source.predicate_groups()
+            if len(self.known_sql) >= self.max_known_sql:
+                self.known_sql.clear()
+            self.known_sql[stats.sql] = groups
+        seconds = stats.duration()
+        with self.lock:
+            for key in set(p for group in groups for p in group):
+                usage = self.columns.setdefault(key, [0, 0.0])
+                usage[0] += 1
+                usage[1] += seconds
+            # branches of OR are patterns of their own
+            for group in groups:
+                tables = {}
+                for table, column, kind in group:
+                    tables.setdefault(table, []).append((column, kind))
+                for table, columns in tables.iteritems():
+                    equal = tuple(sorted(set(
+                        c for c, kind in columns
+                        if kind in ('equality', 'join'))))
+                    ranges = [c for c, kind in columns
+                              if kind == 'range' and c not in equal]
+                    order = tuple(c for c, kind in columns
+                                  if kind == 'order')
+                    key = (table, equal, ranges[0] if ranges else None,
+                           order)
+                    usage = self.patterns.setdefault(key, [0, 0.0])
+                    usage[0] += 1
+                    usage[1] += seconds
+
+    def indexes(self, table):
+        """
+        Return list of lists of lowercase columns of table indexes,
+        including INTEGER PRIMARY KEY. Return None for unknown table.
+        """
+        quoted = table.replace('"', '""')
+        with self.db.checkout():
+            info = self.db._execute('PRAGMA table_info("%s")' % quoted
+                                    ).fetchall()
+            if not info:
+                return None
+            res = []
+            keys = [column for column in info if column[5]]
+            if len(keys) == 1 and keys[0][2].upper() == 'INTEGER':
+                res.append([keys[0][1].lower()])
+            for index in self.db._execute(
+                    'PRAGMA index_list("%s")' % quoted).fetchall():
+                res.append([column[2].lower() for column in self.db._execute(
+                    'PRAGMA index_info("%s")'
+                    % index[1].replace('"', '""'))])
+        return res
+
+    def suggestions(self, min_calls=1):
+        """
+        Return list of suggested indexes, most time consuming first.
+        Each is a dict of table, columns, calls and seconds taken by
+        queries it would serve, and index, CreateIndex to apply it.
+        """
+        with self.lock:
+            patterns = self.patterns.items()
+        indexes = {}
+        suggested = {}
+        for (table, equal, ranged, order), usage in patterns:
+            columns = list(equal) + ([ranged] if ranged else list(order))
+            if not columns:
+                continue
+            if table not in indexes:
+                indexes[table] = self.indexes(table)
+            if indexes[table] is None or any(
+                    serves(index, equal, columns[len(equal):])
+                    for index in indexes[table]):
+                continue
+            key = (table, tuple(columns))
+            total = suggested.setdefault(key, [0, 0.0])
+            total[0] += usage[0]
+            total[1] += usage[1]
+        return [{'table': table, 'columns': list(columns),
+                 'calls': calls, 'seconds': seconds,
+                 'index': CreateIndex(table, *columns)}
+                for (table, columns), (calls, seconds) in sorted(
+                    suggested.iteritems(), key=lambda item: -item[1][1])
+                if calls >= min_calls]
+
+
+def serves(index, equal, rest):
+    """
+    Return True if index, list of columns, starts with equal columns,
+    in any order, followed by the first of rest columns, if any.
+    """
+    size = len(equal)
+    if len(index) < size + (1 if rest else 0):
+        return False
+    if set(index[:size]) != set(equal):
+        return False
+    return not rest or index[size] == rest[0]
+
+
+class CreateIndex(object):
+    """
+    Builds CREATE INDEX statement.
+
+    Usage:
+        sql.CreateIndex(db.Users, db.Users.login, db.Users.age
+            ).Unique().FetchFrom(db)
+    """
+    def __init__(self, table, *fields):
+        """Initialize index of given Table or name, on Fields or names."""
+        assert fields, "Index requires columns"
+        self.table = str(table)
+        self.fields = [f.name if isinstance(f, Field) else f for f in fields]
+        self.index_name = "ix_%s_%s" % (self.table.lower(),
+                                        "_".join(self.fields).lower())
+        self.unique = False
+
+    def __repr__(self):
+        return "<CreateIndex:%s>" % self.sql()
+
+    def Name(self, name):
+        """Set name of the index. Return CreateIndex."""
+        self.index_name = name
+        return self
+
+    def Unique(self):
+        """Make the index unique. Return CreateIndex."""
+        self.unique = True
+        return self
+
+    def sql(self):
+        """Construct sql to be executed. Return string."""
+        return "CREATE %sINDEX IF NOT EXISTS %s ON %s (%s)" % (
+            "UNIQUE " if self.unique else "", self.index_name, self.table,
+            ", ".join(self.fields))
+
+    def FetchFrom(self, db):
+        """Create the index in database."""
+        db._execute(self.sql())
+        db._commit()
+
+
+class Future(object):
+    """
+    Result of a call submitted to Executor, available once it is done.
+
+    Callbacks added with .add_done_callback() are called in the worker
+    thread, event loops should pass the result to their own thread,
+    for example with loop.call_soon_threadsafe() or reactor.callFromThread()
+    """
+    def __init__(self):
+        """Initialize pending Future."""
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        """Return True when the call has finished."""
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the call to finish for up to timeout seconds, forever if
+        None. Return its result or raise its exception.
+        """
+        if not self._done.wait(timeout):
+            raise Exception("Call not done in %s seconds" % timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """Wait like .result() does. Return exception raised or None."""
+        if not self._done.wait(timeout):
+            raise Exception("Call not done in %s seconds" % timeout)
+        return self._exc_info[1] if self._exc_info else None
+
+    def add_done_callback(self, func):
+        """Call func(future) once done, or right away if already done."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def _set(self, result=None, exc_info=None):
+        """Store the outcome of the call and run callbacks."""
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            func(self)
+
+
+class Executor(object):
+    """
+    Runs submitted calls on a fixed number of worker threads.
+    """
+    def __init__(self, workers):
+        """Start given number of worker threads."""
+        self.queue = Queue.Queue()
+        self.threads = [threading.Thread(target=self._work)
+                        for i in xrange(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule func(*args, **kwargs) to be called. Return Future."""
+        future = Future()
+        self.queue.put((future, func, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        """Stop workers once calls submitted so far are done."""
+        for thread in self.threads:
+            self.queue.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def _work(self):
+        """Worker thread loop."""
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            future, func, args, kwargs = task
+            try:
+                result = func(*args, **kwargs)
+            except:
+                future._set(exc_info=sys.exc_info())
+            else:
+                future._set(result)
+
+
+class AsyncDb(Db):
+    """
+    Db running queries on a bounded number of worker threads, so that
+    event loop based servers are not blocked by database calls.
+    Queries are run with SqlBuilder.FetchFromAsync(db), returning Future.
+
+    Keyword arguments are the ones of Db, plus:
+        workers: number of worker threads, 4 by default. The pool has the
+            same number of connections, unless pool_size is given.
+    """
+    def __init__(self, **kwargs):
+        workers = kwargs.pop('workers', 4)
+        kwargs.setdefault('pool_size', workers)
+        Db.__init__(self, **kwargs)
+        self.executor = Executor(workers)
+        # queries waiting for a free connection, as (future, query,
+        # batch_size), so that workers are not blocked by them
+        self._waiting = collections.deque()
+        self._waiting_lock = threading.Lock()
+        self._pool.on_release = self._wake
+
+    def _submit(self, query, batch_size):
+        """Schedule the query to be run by a worker. Return Future."""
+        future = Future()
+        self.executor.submit(self._fetch, future, query, batch_size)
+        return future
+
+    def _wake(self):
+        """Schedule a query waiting for connection, once one is released.
+        """
+        with self._waiting_lock:
+            task = self._waiting.popleft() if self._waiting else None
+        if task is not None:
+            self.executor.submit(self._fetch, *task)
+
+    def _fetch(self, future, query, batch_size):
+        """
+        Run the query in worker thread on a connection taken from the pool.
+        Set the future to AsyncResultIterator for SELECT, result of
+        FetchFrom otherwise.
+
+        SELECT keeps the connection until its rows are exhausted,
+        other queries are committed and give it back right away.
+        When all connections are in use, the query waits for one to be
+        released, without the worker, which may be needed to release it.
+        """
+        try:
+            with self._waiting_lock:
+                connection = self._pool.acquire(block=False)
+                if connection is None:
+                    self._waiting.append((future, query, batch_size))
+                    return
+        except:
+            # like when the database can not be opened
+            future._set(exc_info=sys.exc_info())
+            return
+        self._local.connection = connection
+        try:
+            res = query.FetchFrom(self, batch_size)
+            if query.query_type != SELECT:
+                connection.commit()
+                self._committed()
+        except:
+            exc_info = sys.exc_info()
+            self._pool.release(connection)
+            future._set(exc_info=exc_info)
+            return
+        finally:
+            self._local.connection = None
+            self._local.written = None
+        if query.query_type != SELECT:
+            self._pool.release(connection)
+            future._set(res)
+        else:
+            future._set(AsyncResultIterator(self, connection, res))
+
+    def shutdown(self):
+        """Stop worker threads once submitted queries are done."""
+        self.executor.shutdown()
+
+
+class WriteQueue(object):
+    """
+    Runs INSERTs, UPDATEs and DELETEs submitted from many threads on a
+    writer thread, committing those waiting in the queue together, so that
+    they share one transaction and one sync to disk.
+
+    Each write runs in its own savepoint, a failing one is rolled back
+    alone and does not affect others committed with it.
+    The Db must be in pool mode, the writer takes a connection of its own.
+
+    Usage:
+        writer = sql.WriteQueue(db, size=1000)
+        future = writer.submit(sql.SqlBuilder().Update(db.Users).Set(
+            age=30).Where(db.Users.id == 1))
+        future.result() # => number of rows changed
+    """
+    def __init__(self, db, size=1000, batch_size=100):
+        """
+        Start writer thread. Up to size writes wait in the queue,
+        submit() blocks when it is full. Up to batch_size writes are
+        committed at once.
+        """
+        assert db._pool is not None, "WriteQueue requires Db with pool_size"
+        self.db = db
+        self.batch_size = batch_size
+        self.queue = Queue.Queue(size)
+        # set by shutdown(), no writes are queued after the last one
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, query, timeout=None):
+        """
+        Queue the write, waiting up to timeout seconds for room in the
+        queue, forever if None. Return Future of number of rows inserted
+        or changed, done once committed. Raise once shut down.
+        """
+        assert query.query_type in (INSERT, UPDATE, DELETE), \
+            "Only INSERT, UPDATE and DELETE can be queued"
+        future = Future()
+        with self.lock:
+            if self.stopped:
+                raise Exception("WriteQueue is shut down")
+            try:
+                self.queue.put((future, query), timeout=timeout)
+            except Queue.Full:
+                raise Exception("Write not queued in %s seconds" % timeout)
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        Stop the writer once writes submitted so far are committed,
+        submit() raises from now on.
+        """
+        with self.lock:
+            if not self.stopped:
+                self.stopped = True
+                self.queue.put(None)
+        if wait:
+            self.thread.join()
+
+    def _work(self):
+        """Writer thread loop, commits writes in batches."""
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if None in batch:
+                stop = True
+                batch = batch[:batch.index(None)]
+            if batch:
+                self._commit(batch)
+
+    def _commit(self, batch):
+        """Run list of (future, query) in one transaction, set futures."""
+        db = self.db
+        done = []
+        try:
+            with db.checkout():
+                with db.transaction():
+                    for future, query in batch:
+                        try:
+                            with db.transaction():
+                                if query.query_type == INSERT:
+                                    res = query.FetchFrom(db)
+                                else:
+                                    res = query._execute(db).rowcount
+                        except:
+                            future._set(exc_info=sys.exc_info())
+                        else:
+                            done.append((future, res))
+        except:
+            # including those not run, when the transaction could not
+            # be started
+            exc_info = sys.exc_info()
+            for future, query in batch:
+                if not future.done():
+                    future._set(exc_info=exc_info)
+            return
+        for future, res in done:
+            future._set(res)
+
+
+class ShardedDb(object):
+    """
+    Several Dbs holding parts of the same tables, queried at once
+    on worker threads. Returns Tables as its properties, like Db does.
+
+    SELECTs run with FetchFrom, FetchColumns and ExportTo are sent to all
+    shards, or those the key routes them to, and results are merged:
+        - with ORDER BY, rows of shards are merged in order;
+        - LIMIT is applied to each shard, then to the merged rows;
+        - rows are read from shards as they are fetched, unless grouped;
+        - COUNT, SUM, MAX and MIN of shards are combined, per group of
+          GROUP BY, AVG and HAVING can not be.
+    UPDATEs and DELETEs are run on all or routed shards,
+    rows of INSERTs are split between shards by key.
+    Writes are committed on shards once they succeeded on all of them,
+    and rolled back on all when any fails. Shards are committed one by
+    one, so if a commit fails, shards committed before keep the changes.
+    Prepare() and other Db specific features are not available.
+    Tables named like its attributes are returned by .table(name).
+    """
+    sharded = True
+
+    def __init__(self, shards, key=None, bounds=None, workers=None):
+        """
+        Connect to shards, list of keyword arguments of Db.
+
+        key is a name of column tables are split by, bounds are lowest
+        values of key of each shard but the first one, in ascending order.
+        Queries comparing key to values with = or IN in WHERE, at the top
+        level, are run only on shards holding those values.
+        workers is number of threads running queries, one per shard
+        by default. Shards are Dbs with connection pools, of one connection
+        per worker unless pool_size is given, use their .checkout()
+        to run other statements on them.
+        """
+        assert len(shards) > 1, "ShardedDb requires several shards"
+        assert bounds is None or len(bounds) == len(shards) - 1, \
+            "Bound is required for each shard but the first one"
+        self._tables = {}
+        workers = workers or len(shards)
+        self.shards = []
+        for kwargs in shards:
+            kwargs = dict(kwargs)
+            kwargs.setdefault('pool_size', workers)
+            self.shards.append(Db(**kwargs))
+        self.dialect = self.shards[0].dialect
+        self.key = key.lower() if key else None
+        self.bounds = list(bounds) if bounds is not None else None
+        self.executor = Executor(workers)
+
+    def table(self, name):
+        """Return Table with given name, the same one for the same name."""
+        try:
+            return self._tables[name]
+        except KeyError:
+            table = self._tables[name] = Table(name)
+            return table
+
+    def __getattr__(self, name):
+        """Return Table with given name, see .table()"""
+        return self.table(name)
+
+    def shutdown(self):
+        """Stop worker threads once submitted queries are done."""
+        self.executor.shutdown()
+
+    def shard_of(self, value):
+        """Return index of shard holding given value of key."""
+        return bisect.bisect_right(self.bounds, value)
+
+    def route(self, query):
+        """Return list of indexes of shards the query should be run on."""
+        everywhere = range(len(self.shards))
+        if self.key is None or self.bounds is None or not query.where_conds:
+            return everywhere
+        conds = [query.where_conds]
+        while conds:
+            cond = conds.pop()
+            if cond.operator == 'AND':
+                conds.extend(cond.children)
+                continue
+            if cond.operator not in ('=', 'IN') or cond.func:
+                continue
+            field, value = [unwrap(child) for child in cond.children]
+            if not isinstance(field, Field) or field.name.lower() != self.key:
+                continue
+            if isinstance(value, Param):
+                if value.name not in (query.params or {}):
+                    continue
+                value = query.params[value.name]
+            elif isinstance(value, Literal):
+                value = value.value
+            else:
+                continue
+            if cond.operator == 'IN' and isinstance(value, Iterable) \
+                    and not isinstance(value, basestring):
+                return sorted(set(self.shard_of(v) for v in value))
+            # including IN with a single value bound to Param
+            return [self.shard_of(value)]
+        return everywhere
+
+    def _execute(self, query):
+        """
+        Run the query on shards. Return cursor of merged result for SELECT.
+        """
+        shards = self.route(query)
+        if query.query_type != SELECT:
+            def write(db):
+                # the connection is committed once all shards are done
+                connection = db._pool.acquire()
+                db._local.connection = connection
+                try:
+                    cursor = query._execute(db)
+                    return db, connection, cursor.rowcount
+                except:
+                    db._pool.release(connection)
+                    raise
+                finally:
+                    db._local.connection = None
+                    db._local.written = None
+            opened = self._opened([self.executor.submit(write, self.shards[i])
+                                   for i in shards])
+            exc_info = None
+            for db, connection, rowcount in opened:
+                if exc_info is None:
+                    try:
+                        connection.commit()
+                    except:
+                        exc_info = sys.exc_info()
+                    else:
+                        # other connections may have cached old rows
+                        db.invalidate(*query.tables())
+                # those left uncommitted are rolled back
+                db._pool.release(connection)
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            return ShardsCursor(sum(rowcount for db, c, rowcount in opened))
+        plan = MergePlan(query)
+        shard_query = query
+        if plan.grouped and query.limit:
+            # groups are complete only once results of all shards are in
+            shard_query = copy.copy(query)
+            shard_query.limit = None
+
+        def select(db):
+            # the connection stays with the cursor, till rows are read
+            connection = db._pool.acquire()
+            db._local.connection = connection
+            try:
+                return db, connection, shard_query._execute(db)
+            except:
+                db._pool.release(connection)
+                raise
+            finally:
+                db._local.connection = None
+        opened = self._opened([self.executor.submit(select, self.shards[i])
+                               for i in shards])
+        description = opened[0][2].description
+        return MergedCursor(plan.merge(
+            [cursor for db, connection, cursor in opened], description),
+            description, [(db, connection) for db, connection, c in opened])
+
+    def _opened(self, futures):
+        """
+        Return results of futures of calls holding connections of shards,
+        tuples of (Db, connection, ...). When any of them failed, give
+        connections of the others back and raise its exception.
+        """
+        opened = []
+        exc_info = None
+        for future in futures:
+            try:
+                opened.append(future.result())
+            except:
+                exc_info = exc_info or sys.exc_info()
+        if exc_info:
+            for res in opened:
+                res[0]._pool.release(res[1])
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return opened
+
+    def _insert(self, query):
+        """
+        Insert rows of the query into shards holding them, as they are
+        read, in chunks. Each shard inserts in its own transaction,
+        committed once all rows are inserted. Return number of rows inserted.
+        """
+        assert self.key is not None and self.bounds is not None, \
+            "Sharded INSERT requires key and bounds"
+        shard_query = copy.copy(query)
+        # index of shard => rows to insert into it
+        parts = {}
+        # transaction() blocks of shards, entered once rows come for them
+        transactions = {}
+        chunk_size = None
+        pos = None
+        count = 0
+
+        def insert(i, rows):
+            db = self.shards[i]
+            if i not in transactions:
+                transactions[i] = db.transaction()
+                transactions[i].__enter__()
+            shard_query.insert_rows = rows
+            return shard_query._insert(db)
+        exc_info = (None, None, None)
+        try:
+            for n, row in enumerate(query.insert_rows):
+                if isinstance(row, dict):
+                    values = [v for k, v in row.iteritems()
+                              if k.lower() == self.key]
+                    if not values:
+                        raise Exception("Row %d has no value of key %s"
+                                        % (n, self.key))
+                    value = values[0]
+                else:
+                    if pos is None:
+                        fields = [f.lower() for f in query.insert_fields]
+                        if self.key not in fields:
+                            raise Exception("Key %s is not among fields of "
+                                            "Insert()" % self.key)
+                        pos = fields.index(self.key)
+                    value = row[pos]
+                if chunk_size is None:
+                    chunk_size = max(1, query.max_variables // len(row))
+                i = self.shard_of(value)
+                rows = parts.setdefault(i, [])
+                rows.append(row)
+                if len(rows) == chunk_size:
+                    count += insert(i, rows)
+                    parts[i] = []
+            for i, rows in sorted(parts.items()):
+                if rows:
+                    count += insert(i, rows)
+        except:
+            exc_info = sys.exc_info()
+        # commit, or roll back all, and the rest once a commit fails
+        for i, transaction in sorted(transactions.items()):
+            try:
+                transaction.__exit__(*exc_info)
+            except:
+                if exc_info[0] is None:
+                    exc_info = sys.exc_info()
+        if exc_info[0] is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return count
+
+
+class ShardsCursor(object):
+    """Stands for cursor of UPDATE or DELETE run on shards."""
+    def __init__(self, rowcount, description=None):
+        self.rowcount = rowcount
+        self.description = description
+
+
+class MergedCursor(object):
+    """
+    Stands for cursor of SELECT run on shards, with rows merged from
+    cursors of shards as they are fetched, see MergePlan.
+    Connections of shards are given back once rows are exhausted,
+    or on .close().
+    """
+    def __init__(self, rows, description, connections):
+        """
+        Initialize with iterator of merged rows, and list of
+        (Db, connection) the cursors of shards use.
+        """
+        self.rows = rows
+        self.description = description
+        self.connections = connections
+        self.arraysize = 1
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Return next row."""
+        try:
+            return self.rows.next()
+        except StopIteration:
+            self.close()
+            raise
+
+    def fetchmany(self, size=None):
+        """Return list of up to size next rows, arraysize by default."""
+        rows = list(itertools.islice(self.rows, size or self.arraysize))
+        if not rows:
+            self.close()
+        return rows
+
+    def fetchall(self):
+        """Return list of all remaining rows."""
+        rows = list(self.rows)
+        self.close()
+        return rows
+
+    def close(self):
+        """Give connections back to pools of shards."""
+        connections, self.connections = self.connections, []
+        for db, connection in connections:
+            db._pool.release(connection)
+
+    __del__ = close
+
+
+class MergePlan(object):
+    """
+    How results of SELECT run on shards are combined, see ShardedDb.
+    """
+    # functions combining results of aggregates of shards
+    combiners = {
+        'COUNT': sum,
+        'SUM': sum,
+        'MAX': max,
+        'MIN': min,
+    }
+    # aggregates that can not be computed from results of shards
+    uncombinable = ('AVG', 'FIRST', 'LAST', 'GROUP_CONCAT', 'TOTAL')
+
+    def __init__(self, query):
+        """Find aggregates, groups and order of query."""
+        assert not query.having_conds, \
+            "HAVING can not be applied to results of shards"
+        self.query = query
+        self.aggregates = {}
+        for i, f in enumerate(query.select_fields):
+            if isinstance(f, tuple):
+                f = f[0]
+            if not isinstance(f, Expr):
+                continue
+            func = f.func.upper()
+            if func in self.combiners:
+                self.aggregates[i] = self.combiners[func]
+                continue
+            # aggregates are combined only when selected on their own,
+            # not within expressions, like MAX(x) + 1
+            nodes = [f]
+            while nodes:
+                node = nodes.pop()
+                func = node.func.upper()
+                if func in self.uncombinable or func in self.combiners:
+                    raise Exception(
+                        "%s can not be combined from shards" % func)
+                nodes.extend(c for c in node.children if isinstance(c, Expr))
+        # groups may come from several shards
+        self.grouped = bool(self.aggregates or query.group_fields)
+
+    def positions(self, fields, description):
+        """
+        Return list of (column position, descending) of ORDER BY fields.
+        """
+        index = column_index(self.query.select_fields,
+                             ShardsCursor(None, description))
+        res = []
+        for f in fields:
+            descending = False
+            if isinstance(f, tuple):
+                f, descending = f[0], f[1].upper() == 'DESC'
+            names = [f.name.lower()] if isinstance(f, Alias) else \
+                [("%s__%s" % (f.table, f.name)).lower(), f.name.lower()] \
+                if isinstance(f, Field) else []
+            pos = [index[n] for n in names if n in index]
+            if not pos:
+                raise Exception("Shards can only be ordered by selected "
+                                "columns, %s is not" % sqlize(f))
+            res.append((pos[0], descending))
+        return res
+
+    def merge(self, results, description):
+        """Return iterator of rows merged from iterables of rows of shards.
+        """
+        query = self.query
+        order = self.positions(query.order_fields, description) \
+            if query.order_fields else None
+        if self.grouped:
+            rows = self.combine(results)
+            if order:
+                rows.sort(key=lambda row: OrderKey(row, order))
+        elif order:
+            rows = merge_sorted(results, lambda row: OrderKey(row, order))
+        else:
+            rows = itertools.chain.from_iterable(results)
+        if query.limit:
+            return itertools.islice(rows, query.limit)
+        return iter(rows)
+
+    def combine(self, results):
+        """
+        Return rows of aggregates combined per group, that is
+        per values of other columns.
+        """
+        groups = collections.OrderedDict()
+        aggregates = self.aggregates.items()
+        for row in itertools.chain.from_iterable(results):
+            key = tuple(v for i, v in enumerate(row)
+                        if i not in self.aggregates)
+            group = groups.get(key)
+            if group is None:
+                groups[key] = list(row)
+                continue
+            for i, combine in aggregates:
+                values = [v for v in (group[i], row[i]) if v is not None]
+                group[i] = combine(values) if values else None
+        return [tuple(row) for row in groups.itervalues()]
+
+
+class OrderKey(object):
+    """Sort key of row by columns, each ascending or descending."""
+    __slots__ = ('row', 'order')
+
+    def __init__(self, row, order):
+        """Initialize with row and list of (position, descending)."""
+        self.row = row
+        self.order = order
+
+    def __eq__(self, other):
+        return all(self.row[i] == other.row[i] for i, desc in self.order)
+
+    def __lt__(self, other):
+        for i, descending in self.order:
+            a, b = self.row[i], other.row[i]
+            if a != b:
+                return (a > b) if descending else (a < b)
+        return False
 
-    def __init__(self, **kwargs):
-        self._settings['engine'] = kwargs['engine']
-        self._settings['name'] = kwargs['name']
-        # Only sqlite for now
-        if self._settings['engine'] == 'sqlite':
-            self.__connection = sqlite3.connect(self._settings['name'])
-        else:
-            raise Exception("DB Backend not Implemented")
 
-    def _execute(self, query):
-        """Execute given SQL, return cursor."""
-        if self._settings['engine']:
-            return self.__connection.execute(query)
+def merge_sorted(sequences, key):
+    """
+    Yield items of sorted sequences in order of key(item),
+    items of earlier sequences go first among equal ones.
+    """
+    heap = []
+    for i, seq in enumerate(sequences):
+        iterator = iter(seq)
+        for item in iterator:
+            heap.append((key(item), i, item, iterator))
+            break
+    heapq.heapify(heap)
+    while heap:
+        k, i, item, iterator = heap[0]
+        yield item
+        for item in iterator:
+            heapq.heapreplace(heap, (key(item), i, item, iterator))
+            break
         else:
-            raise Exception("DB Backend not Implemented")
-
-    def __getattr__(self, name):
-        """Return Table with given name."""
-        return Table(name)
+            heapq.heappop(heap)
 
 
 class Table(object):
     """
     Used in constructing SQL and also returns Fields as its properties.
     Not checked for presence in database.
+    With Schema given, its Fields are checked, see Db check_schema.
     """
-    def __init__(self, name):
+    __slots__ = ('__name', '_fields', '_schema')
+
+    def __init__(self, name, schema=None):
         # to avoid confusion with pretty common field 'name'
         self.__name = name
+        # Fields are created once per name
+        self._fields = {}
+        self._schema = schema
 
     def __repr__(self):
         return "<Table:%s>" % self.__name
@@ -106,20 +2183,35 @@ class Table(object):
         return self.__name
 
     def __getattr__(self, name):
-        """Return Field with given name."""
-        return Field(self, name)
+        """Return Field with given name, the same one for the same name."""
+        try:
+            return self._fields[name]
+        except KeyError:
+            if self._schema is not None and not name.startswith('__'):
+                self._schema.check_field(self.__name, name)
+            field = self._fields[name] = Field(self, name)
+            return field
 
 UPDATE = 'UPDATE'
 SELECT = 'SELECT'
 DELETE = 'DELETE'
+INSERT = 'INSERT'
 
 BINARY_OPS = ('=', '!=', '<', '<=', '>', '>=', 'IN')
 
+# marks the place of a Param in SQL compiled by PreparedQuery.
+# NUL can never appear in valid SQL text: sqlite3 refuses such queries
+# and other backends get it escaped by Literal, so it is safe to split on.
+PARAM_SLOT = '\0'
+
+# placeholder styles supported in native parameter binding
+PARAMSTYLES = ('qmark', 'named')
+
 # those return expression with function applied
 Max = lambda obj: Expr(obj).apply_func("MAX")
 Min = lambda obj: Expr(obj).apply_func("MIN")
 Avg = lambda obj: Expr(obj).apply_func("AVG")
-Sum = lambda obj: Expr(obj).apply_func("AVG")
+Sum = lambda obj: Expr(obj).apply_func("SUM")
 First = lambda obj: Expr(obj).apply_func("FIRST")
 Last = lambda obj: Expr(obj).apply_func("LAST")
 
@@ -151,42 +2243,131 @@ class Expr(object):
     Expr.sql(..) is used to get representation of given Expr in given Db,
     with given parameter list.
 
+    Exprs are immutable, operations on them return new ones, so they are
+    safe to share between queries and threads. Structurally equal Exprs
+    are the same object, use .same() to compare them and Exprs themselves
+    as cache keys.
     """
+    __slots__ = ('func', '_children', 'operator', 'key', 'prefix', 'last',
+                 '__weakref__')
+    # Exprs are immutable and hash-consed: there is only one Expr
+    # of given structure alive, so identity is structural equality,
+    # and default hash is a structural one.
+    # Maps structure key => weak reference to Expr.
+    _nodes = {}
+    _nodes_lock = threading.Lock()
+
     def __new__(cls, *args, **kwargs):
         """
-        Create new Expr object or return existing,
-        if called with single parameter of type Expr.
+        Return Expr with given children, connected with given operator.
+        Return the argument itself if called with single Expr.
         """
         if len(args) == 1 and isinstance(args[0], Expr):
             return args[0]
-        # default object
-        obj = object.__new__(cls)
-        obj.func = ''  # there can be a function to be applied to the result
-        obj.children = []  # sub-expressions or literals
-        obj.operator = None  # what connects them
-        return obj
+        return cls.make(
+            tuple(child if isinstance(child, (Expr, Overloaded))
+                  else Literal(child) for child in args),
+            kwargs.get('operator'))
 
     def __init__(self, *args, **kwargs):
         """
-        Initialize the Expression, accepting parameters as its children.
+        Everything is done in __new__, since the Expr might already exist.
         Simple types are treated as Literals for future SQL representation.
         """
-        # except the case where just one expression was passed.
-        # this situation is handled in __new__
-        if args and (len(args) != 1 or not isinstance(args[0], Expr)):
-            children = []
-            for child in args:
-                if not isinstance(child, (Expr, Param, Field, Alias)):
-                    child = Literal(child)
-                children.append(child)
-            self.children = children
-            self.operator = kwargs.get('operator')
+
+    @classmethod
+    def make(cls, children, operator=None, func=''):
+        """
+        Return Expr of given structure, existing one if there is any.
+        children is a tuple of Exprs, Literals, Params, Fields and Aliases.
+        """
+        if len(children) > 2 and operator is not None \
+                and operator not in BINARY_OPS:
+            prefix = cls.make(children[:2], operator)
+            for child in itertools.islice(children, 2, len(children) - 1):
+                prefix = cls.chain(prefix, child)
+            return cls.chain(prefix, children[-1], func, children)
+        # Exprs are unique, so their identity stands for the structure
+        key = (func, operator) + tuple([child_key(c) for c in children])
+        return cls.intern(key, func, operator, children)
+
+    @classmethod
+    def chain(cls, prefix, last, func='', children=None):
+        """
+        Return Expr of children of prefix Expr followed by last one,
+        connected with the same operator, existing one if there is any.
+        children of the result may be given, if known.
+
+        Such Exprs, like (a OR b OR c), are keyed by their prefix,
+        that is (a OR b), so a chain of n operations takes O(n) time,
+        children are collected only when asked for.
+        """
+        # string marks the key of chain, children keys are never strings
+        key = (func, prefix.operator, 'chain', id(prefix), child_key(last))
+        return cls.intern(key, func, prefix.operator, children, prefix, last)
+
+    @classmethod
+    def intern(cls, key, func, operator, children, prefix=None, last=None):
+        """Return Expr with given key, creating it if there is none."""
+        ref = cls._nodes.get(key)
+        obj = ref() if ref is not None else None
+        if obj is None:
+            with cls._nodes_lock:
+                ref = cls._nodes.get(key)
+                obj = ref() if ref is not None else None
+                if obj is None:
+                    obj = object.__new__(cls)
+                    # there can be a function to be applied to the result
+                    object.__setattr__(obj, 'func', func)
+                    # sub-expressions or literals, None till asked for
+                    object.__setattr__(obj, '_children', children)
+                    # what connects them
+                    object.__setattr__(obj, 'operator', operator)
+                    object.__setattr__(obj, 'key', key)
+                    # Expr of all children but the last one, and the last
+                    object.__setattr__(obj, 'prefix', prefix)
+                    object.__setattr__(obj, 'last', last)
+                    cls._nodes[key] = weakref.KeyedRef(obj, cls.forget, key)
+        return obj
+
+    @property
+    def children(self):
+        """Return tuple of sub-expressions and literals of this Expr."""
+        children = self._children
+        if children is None:
+            # walk down the prefixes till one knowing its children
+            tail = []
+            node = self
+            while node._children is None:
+                tail.append(node.last)
+                node = node.prefix
+            tail.reverse()
+            children = node._children + tuple(tail)
+            object.__setattr__(self, '_children', children)
+        return children
+
+    @classmethod
+    def forget(cls, ref):
+        """
+        Remove reference to collected Expr from the table of nodes.
+        No locking here, since collection may happen while .make() holds it.
+        """
+        if cls._nodes.get(ref.key) is ref:
+            cls._nodes.pop(ref.key, None)
+
+    def __setattr__(self, name, value):
+        """Prevent changes, Exprs are shared."""
+        raise AttributeError("Expr is immutable")
+
+    def same(self, other):
+        """Return True when other is structurally the same Expr."""
+        return self is other
 
     def join(self, other, operator):
         """
-        Joins this Expression with other one. Return Expr, self or new.
+        Joins this Expression with other one. Return new Expr.
 
-        If current is a leaf object, then it is moved downwards as first child
+        If current is a leaf object, then it becomes first child
         and other one is added as second child
 
         Also that is performed when they are of different types,
@@ -206,19 +2387,48 @@ class Expr(object):
                      or not other.is_multi())):
                 # if multicond, we merge his kids with ours
                 if other.is_multi():
-                    self.children.extend(other.children)
+                    res = self
+                    for child in other.children:
+                        res = Expr.chain(res, child)
+                    return res
                 # if a leaf, we add it to list of our children
                 else:
-                    self.children.append(other)
-                return self
+                    return Expr.chain(self, other)
         else:
-            # shallowcopy ourselves into a new object, to be moved downside
-            obj = copy.copy(self)
-            # that is brand new me, with new operator and kids
-            self.func = ''
-            self.operator = operator
-            self.children = [obj, other]
-            return self
+            return Expr.make((self, other), operator)
+
+    @classmethod
+    def combine(cls, operator, items):
+        """
+        Join items with logical operator, AND or OR. Return Expr.
+
+        Result is the same as reduce() over .join() gives,
+        but children of operands are collected in one pass.
+        """
+        items = iter(items)
+        res = Expr(next(items))
+        # children of the group being built, once there is one
+        children = None
+        for other in items:
+            other = Expr(other)
+            if children is None:
+                if res.operator == operator and not res.func:
+                    children = list(res.children)
+                else:
+                    children = [res, other]
+                    continue
+            # same conditions of merging as in .join()
+            if other.operator == operator and not other.func \
+                    or not other.is_multi():
+                if other.is_multi():
+                    children.extend(other.children)
+                else:
+                    children.append(other)
+            else:
+                children = [Expr.make(tuple(children), operator), other]
+        if children is None:
+            return res
+        return Expr.make(tuple(children), operator)
 
     def is_multi(self):
         """Return True when this Expr contains other Exprs."""
@@ -226,18 +2436,14 @@ class Expr(object):
 
     def apply_func(self, func):
         """
-        Apply given SQL function to children. Return Expr, self or new.
+        Apply given SQL function to children. Return new Expr.
         If this node already have a function, then it is shifted downward,
         and new one with needed function is added in its place
         """
         if not self.func:
-            self.func = func
-            return self
+            return Expr.make(self.children, self.operator, func)
         else:
-            obj = Expr()
-            obj.children.append(self)
-            obj.func = func
-            return obj
+            return Expr.make((self, ), None, func)
 
     def __or__(self, other):
         return self.join(other, "OR")
@@ -295,68 +2501,103 @@ class Expr(object):
         Accepts anything and passes it down the rendering stack,
         let the children pick what they need.
         Namely, Param needs params dict, Literal needs db string (engine type)
+
+        The tree is walked with explicit stack into a single buffer,
+        so arbitrarily deep and wide Exprs are rendered in linear time.
         """
-        def sqlize(obj, **kwargs):
-            """
-            Call specialized .sql() on the object supporting it.
-            Call str() otherwise.
-            """
-            if callable(getattr(obj, 'sql', None)):
-                return obj.sql(**kwargs)
-            else:
-                return str(obj)
-
-        # That indicates that this is a leaf, or even special leaf *
-        if self.operator is None:
-            assert len(self.children) <= 1 or self.func, \
-                "Only function calls on * or Literal can omit operator"
-            if self.children:
-                # that's the only child
-                res = sqlize(self.children[0], **kwargs)
-            else:
+        res = []
+        # holds nodes to be rendered and strings to be output as is,
+        # in reverse order
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.__class__ is str:
+                res.append(node)
+            elif not isinstance(node, Expr):
+                res.append(sqlize(node, **kwargs))
+            # That indicates that this is a leaf, or even special leaf *
+            elif node.operator is None:
+                assert len(node.children) <= 1 or node.func, \
+                    "Only function calls on * or Literal can omit operator"
+                if node.func:
+                    stack.append(")")
+                # that's the only child.
                 # childless node. If we got there, assume user wants a star.
-                res = "*"
-            if self.func:
-                res = "%s(%s)" % (self.func, res)
-            return res
-        else:
-            # special handling of IS NULL and IS NOT NULL cases
-            if self.operator in ('=', '!=') and len(self.children) == 2 \
-                    and sqlize(self.children[1], **kwargs) == 'NULL':
-                operator = 'IS' if self.operator == '=' else 'IS NOT'
+                stack.append(node.children[0] if node.children else "*")
+                if node.func:
+                    stack.append("%s(" % node.func)
             else:
-                operator = self.operator
-            return "%(func)s(%(expr)s)" % {
-                'func': self.func,
-                'expr': (" %s " % operator).join(
-                    [sqlize(c, **kwargs) for c in self.children])
-                }
+                # special handling of IS NULL and IS NOT NULL cases
+                if node.operator in ('=', '!=') and len(node.children) == 2 \
+                        and is_null(node.children[1], kwargs):
+                    operator = " IS " if node.operator == '=' else " IS NOT "
+                else:
+                    operator = " %s " % node.operator
+                stack.append(")")
+                children = node.children
+                for i in xrange(len(children) - 1, 0, -1):
+                    stack.append(children[i])
+                    stack.append(operator)
+                stack.append(children[0])
+                stack.append("%s(" % node.func)
+        return "".join(res)
+
     # str() is not really used in SqlBuilder, but it is handy for testing
     __str__ = sql
 
 
+def sqlize(obj, **kwargs):
+    """
+    Call specialized .sql() on the object supporting it.
+    Call str() otherwise.
+    """
+    if callable(getattr(obj, 'sql', None)):
+        return obj.sql(**kwargs)
+    else:
+        return str(obj)
+
+
+def is_null(obj, kwargs):
+    """Return True if obj is rendered as NULL with given .sql() kwargs."""
+    # leaves are wrapped into Exprs, like E(None)
+    obj = unwrap(obj)
+    if isinstance(obj, Literal):
+        return obj.value is None
+    if isinstance(obj, Param) and 'slots' not in kwargs \
+            and not kwargs.get('fingerprint'):
+        params = kwargs.get('params') or {}
+        return obj.name in params and params[obj.name] is None
+    return False
+
+
 class Overloaded(object):
     """
     Replaces logical and arithmetic operations with Expr's implementation.
     Adds ._in_() function for issuing IN (...) condition
     """
+    __slots__ = ()
+
+    def _compare(self, other, operator):
+        """Return Expr comparing to other, subclasses may check it first."""
+        return Expr(self, other, operator=operator)
+
     def __eq__(self, other):
-        return Expr(self, other, operator='=')
+        return self._compare(other, '=')
 
     def __ne__(self, other):
-        return Expr(self, other, operator='!=')
+        return self._compare(other, '!=')
 
     def __lt__(self, other):
-        return Expr(self, other, operator='<')
+        return self._compare(other, '<')
 
     def __le__(self, other):
-        return Expr(self, other, operator='<=')
+        return self._compare(other, '<=')
 
     def __gt__(self, other):
-        return Expr(self, other, operator='>')
+        return self._compare(other, '>')
 
     def __ge__(self, other):
-        return Expr(self, other, operator='>=')
+        return self._compare(other, '>=')
 
     def __add__(self, other):
         return Expr(self, other, operator='+')
@@ -371,7 +2612,189 @@ class Overloaded(object):
         return Expr(self, other, operator='/')
 
     def _in_(self, other):
-        return Expr(self, other, operator='IN')
+        return self._compare(other, 'IN')
+
+
+# types of values that are hashable and never sequences
+SCALAR_TYPES = frozenset([int, long, float, bool, str, unicode, NoneType,
+                          datetime.date, datetime.time, datetime.datetime])
+
+
+def child_key(child):
+    """Return hashable value identifying child in the key of Expr."""
+    return id(child) if isinstance(child, Expr) else child.key()
+
+
+def frozen_value(value):
+    """
+    Return value with iterables in it, but strings, copied into tuples.
+    Literals hold such copies, so generators are not used up and lists
+    changed by the caller do not change Exprs built of them.
+    """
+    if type(value) in SCALAR_TYPES or isinstance(value, basestring) \
+            or not isinstance(value, Iterable):
+        return value
+    return tuple([frozen_value(v) for v in value])
+
+
+def value_key(value):
+    """
+    Return hashable tuple of value's type and value itself,
+    sequences are converted to tuples of their items' keys.
+    """
+    if type(value) in SCALAR_TYPES:
+        return (type(value), value)
+    if isinstance(value, Iterable) and not isinstance(value, basestring):
+        return (type(value), tuple(value_key(v) for v in value))
+    try:
+        hash(value)
+    except TypeError:
+        # no way to compare it, so never equal to anything else
+        return (type(value), object())
+    return (type(value), value)
+
+
+INTEGER_TYPES = frozenset([int, long])
+
+
+def json_values(value_sql):
+    """
+    Return SQL of subquery selecting values from JSON array.
+    It replaces long lists in IN (...): the array is a single value,
+    so database does not have to parse them one by one.
+    """
+    return "(SELECT value FROM json_each(%s))" % value_sql
+
+
+class Dialect(object):
+    """
+    Conventions of database backend for representing literal values.
+    Holds table of converters, by type of value, precomputed on creation.
+    """
+    def __init__(self, name, escapes=(("'", "''"), ), true='1', false='0',
+                 json_arrays=False):
+        """
+        Initialize the dialect.
+
+        escapes are pairs of (char, replacement) for string literals,
+        true and false are representations of booleans,
+        json_arrays tells whether database can select from JSON array.
+        """
+        self.name = name
+        self.escapes = tuple(escapes)
+        self.true = true
+        self.false = false
+        self.json_arrays = json_arrays
+        self.converters = {
+            int: str,
+            long: str,
+            float: str,
+            decimal.Decimal: str,
+            bool: self.bool_converter,
+            str: self.escape_string,
+            unicode: self.escape_string,
+            datetime.date:
+                lambda value: "'%04d-%02d-%02d'" % (
+                    value.year, value.month, value.day),
+            datetime.time:
+                lambda value: "'%02d:%02d:%02d'" % (
+                    value.hour, value.minute, value.second),
+            datetime.datetime:
+                lambda value: "'%04d-%02d-%02d %02d:%02d:%02d'" % (
+                    value.year, value.month, value.day,
+                    value.hour, value.minute, value.second),
+            datetime.timedelta:
+                lambda value: "INTERVAL '%d days %d seconds'" % (
+                    value.days, value.seconds),
+            NoneType: lambda value: "NULL",
+        }
+        # converters found for types, including subclasses
+        self.dispatch = dict(self.converters)
+
+    def __repr__(self):
+        return "<Dialect:%s>" % self.name
+
+    def bool_converter(self, value):
+        """Convert boolean value for use in database. Return string."""
+        return self.true if value else self.false
+
+    def escape_string(self, value):
+        """Convert string value for use in database. Return string."""
+        # replacements never produce characters escaped after them,
+        # so chars absent from value are just skipped
+        for c, repl in self.escapes:
+            if c in value:
+                value = value.replace(c, repl)
+        return "'%s'" % value
+
+    def converter(self, cls):
+        """
+        Return function converting values of given type, or None.
+        Converter of the closest base class is used for subclasses.
+        """
+        try:
+            return self.dispatch[cls]
+        except KeyError:
+            res = self.dispatch[cls] = next(
+                (self.converters[base] for base in cls.__mro__
+                 if base in self.converters), None)
+            return res
+
+    def literals(self, values):
+        """
+        Convert sequence of values for use in database, comma separated.
+        Return string.
+        """
+        types = set(map(type, values))
+        if types <= INTEGER_TYPES:
+            return ", ".join(map(str, values))
+        if len(types) == 1:
+            converter = self.converter(types.pop())
+            if converter:
+                return ", ".join([converter(v) for v in values])
+        converters = dict((cls, self.converter(cls)) for cls in types)
+        return ", ".join([converters[type(v)](v) if converters[type(v)]
+                          else Literal(v).sql(db=self) for v in values])
+
+
+# Dialects by name of database engine
+DIALECTS = {}
+
+
+def register_dialect(dialect, *names):
+    """Make dialect available under its own and other given names."""
+    for name in (dialect.name, ) + names:
+        DIALECTS[name] = dialect
+
+
+def get_dialect(db):
+    """Return Dialect for given engine name or Dialect itself."""
+    if isinstance(db, Dialect):
+        return db
+    if not db:
+        raise Exception("Undefined db")
+    try:
+        return DIALECTS[db]
+    except KeyError:
+        raise Exception("Database %s unknown" % db)
+
+
+register_dialect(Dialect('sqlite', json_arrays=True))
+register_dialect(Dialect('firebird'))
+register_dialect(Dialect('sybase'))
+register_dialect(Dialect('maxdb'))
+register_dialect(Dialect('mssql'))
+register_dialect(Dialect('mysql', escapes=(
+    ("'", "''"),
+    ('\\', '\\\\'),
+    ('\000', '\\0'),
+    ('\b', '\\b'),
+    ('\n', '\\n'),
+    ('\r', '\\r'),
+    ('\t', '\\t'),
+)))
+register_dialect(Dialect('postgres', escapes=DIALECTS['mysql'].escapes,
+                         true="'t'", false="'f'"), 'rdbhost')
 
 
 class Literal(Overloaded):
@@ -379,80 +2802,45 @@ class Literal(Overloaded):
     Represents object of a simple type passed to the query.
     .sql() does the transformation according to database conventions.
     """
+    __slots__ = ('value', )
     # good for testing, but in general case should be unnecessary
     default_db = None
 
     def __init__(self, value):
-        self.value = value
+        self.value = frozen_value(value)
 
     def __repr__(self):
         return "<Literal:%s>" % self.sql()
 
-    def bool_converter(value, db):
-        """Convert boolean value for use in database. Return string."""
-        if db in ('postgres', 'rdbhost'):
-            return "'t'" if value else "'f'"
-        else:
-            return '1' if value else '0'
-
-    def string_converter(value, db):
-        """Convert string value for use in database. Return string."""
-        replaces = [
-            ("'", "''"),
-            ('\\', '\\\\'),
-            ('\000', '\\0'),
-            ('\b', '\\b'),
-            ('\n', '\\n'),
-            ('\r', '\\r'),
-            ('\t', '\\t'),
-        ]
-        if db in ('mysql', 'postgres', 'rdbhost'):
-            for orig, repl in replaces:
-                value = value.replace(orig, repl)
-        elif db in ('sqlite', 'firebird', 'sybase', 'maxdb', 'mssql'):
-            value = value.replace("'", "''")
-        else:
-            raise Exception("Database %s unknown" % db)
-        return "'%s'" % value
-
-    converters = {
-        int: lambda value, db: str(value),
-        long: lambda value, db: str(value),
-        float: lambda value, db: str(value),
-        bool: bool_converter,
-        str: string_converter,
-        unicode: string_converter,
-        datetime.date:
-            lambda value, db: "'%04d-%02d-%02d'" % (
-                value.year, value.month, value.day),
-        datetime.time:
-            lambda value, db: "'%02d:%02d:%02d'" % (
-                value.hour, value.minute, value.second),
-        datetime.datetime:
-            lambda value, db: "'%04d-%02d-%02d %02d:%02d:%02d'" % (
-                value.year, value.month, value.day,
-                value.hour, value.minute, value.second),
-        datetime.timedelta:
-            lambda value, db: "INTERVAL '%d days %d seconds'" % (
-                value.days, value.seconds),
-        NoneType: lambda value, db: "NULL",
-    }
+    def key(self):
+        """Return hashable value identifying this Literal in Expr."""
+        return ('L', ) + value_key(self.value)
 
     def sql(self, **kwargs):
         """Convert self.value to its string representation,
         fit for passing to database. Return string.
         """
-        db = kwargs.get('db', self.default_db)
-        if not db:
-            raise Exception("Undefined db")
+        if kwargs.get('fingerprint'):
+            return "NULL" if self.value is None else "?"
+        dialect = kwargs.get('db', self.default_db)
+        if not isinstance(dialect, Dialect):
+            dialect = get_dialect(dialect)
         # find one in our list
-        if type(self.value) in self.converters:
-            return self.converters[type(self.value)](self.value, db)
+        try:
+            converter = dialect.dispatch[type(self.value)]
+        except KeyError:
+            converter = dialect.converter(type(self.value))
+        if converter:
+            return converter(self.value)
         else:
             # may be it is iterable?
             if isinstance(self.value, Iterable):
-                return "(%s)" % ", ".join(
-                    [Literal(v).sql(db=db) for v in self.value])
+                values = self.value
+                if kwargs.get('in_threshold') and dialect.json_arrays \
+                        and len(values) > kwargs['in_threshold']:
+                    return json_values(dialect.escape_string(json.dumps(
+                        list(values), default=str)))
+                return "(%s)" % dialect.literals(values)
             else:
                 raise Exception("No converter for %s" % type(self.value))
 
@@ -461,6 +2849,8 @@ class Param(Overloaded):
     """
      A parameter that can be passed to Expr and thus to SqlBuilder.
     """
+    __slots__ = ('name', )
+
     def __init__(self, name):
         self.name = name
 
@@ -468,20 +2858,65 @@ class Param(Overloaded):
         """
         Substitute the parameter with value in passed params,
         then get SQL representation with Literal's help. Return string.
+
+        When compiling a PreparedQuery a 'slots' list is passed instead:
+        the name is recorded there and PARAM_SLOT marker is returned.
         """
+        if 'slots' in kwargs:
+            kwargs['slots'].append(self.name)
+            return PARAM_SLOT
+        if kwargs.get('fingerprint'):
+            return "?"
         if 'params' not in kwargs or self.name not in kwargs['params']:
             raise Exception('parameter "%s" not found' % self.name)
+        if kwargs.get('paramstyle'):
+            return bind_param(self.name, kwargs['params'][self.name],
+                              kwargs['paramstyle'], kwargs['args'],
+                              kwargs.get('in_threshold'))
         return Literal(kwargs['params'][self.name]).sql(**kwargs)
 
     def __repr__(self):
         return "<Param:%s>" % self.name
 
+    def key(self):
+        """Return hashable value identifying this Param in Expr."""
+        return ('P', self.name)
+
+
+def bind_param(name, value, paramstyle, args, in_threshold=None):
+    """
+    Add value of the parameter to DB-API args. Return placeholder string.
+
+    paramstyle is 'qmark' (args is a list) or 'named' (args is a dict).
+    Sequences get a placeholder per element, to be used with IN.
+    Sequences longer than in_threshold are passed as single JSON array.
+    """
+    if isinstance(value, Iterable) and not isinstance(value, basestring):
+        if not hasattr(value, '__len__'):
+            value = list(value)
+        if in_threshold and len(value) > in_threshold:
+            return json_values(bind_param(
+                name, json.dumps(list(value), default=str), paramstyle, args))
+        return "(%s)" % ", ".join(
+            [bind_param("%s_%d" % (name, i), v, paramstyle, args)
+                for i, v in enumerate(value)])
+    if paramstyle == 'qmark':
+        args.append(value)
+        return '?'
+    elif paramstyle == 'named':
+        args[str(name)] = value
+        return ':%s' % name
+    else:
+        raise Exception("Paramstyle %s unknown" % paramstyle)
+
 
 class Alias(Overloaded):
     """
     Field alias that can be used in expressions.
     Does not get escaped at all.
     """
+    __slots__ = ('name', )
+
     def __init__(self, name):
         self.name = name
 
@@ -495,11 +2930,17 @@ class Alias(Overloaded):
     def __repr__(self):
         return "<Alias:%s>" % self.name
 
+    def key(self):
+        """Return hashable value identifying this Alias in Expr."""
+        return ('A', self.name)
+
 
 class Field(Overloaded):
     """
     Represents table field. Used in SQL expressions.
     """
+    __slots__ = ('table', 'name')
+
     def __init__(self, table, name):
         self.table = table
         self.name = name
@@ -510,6 +2951,19 @@ class Field(Overloaded):
     def __repr__(self):
         return "<Field:%s>" % str(self)
 
+    def key(self):
+        """Return hashable value identifying this Field in Expr."""
+        return ('F', str(self.table), self.name)
+
+    def _compare(self, other, operator):
+        """Return Expr, checked against the schema of the table if any."""
+        if operator == 'IN' and not isinstance(other, (Expr, Overloaded)):
+            # iterables are read once, into the Literal
+            other = Literal(other)
+        if self.table._schema is not None:
+            self.table._schema.check(self, other, operator)
+        return Expr(self, other, operator=operator)
+
 
 class SqlBuilder(object):
     """
@@ -524,13 +2978,21 @@ class SqlBuilder(object):
 
     Update(table).Set((Field, Expr),..).Where(Expr, ..)
 
+    Insert(table, field, ..).Values(iterable of rows)
+
     NOTE: Presense of all fields and table.fields currently is not enforced, so
     if you pass db.x.y when table x does not exist and is not present in any
-    FROM clauses the query will still be executed.
+    FROM clauses the query will still be executed. Columns of existing tables
+    are checked with Db(check_schema=True)
 
     Query is evaluated when you issue .FetchRows(db)
     where db is open database connection of type Db()
+
+    Queries executed many times can be compiled once with .Prepare(db)
     """
+    # SQLITE_MAX_VARIABLE_NUMBER of older sqlite builds,
+    # INSERT statements are chunked to have no more bound values than that
+    max_variables = 999
 
     def __init__(self):
         """Initialize the sql with empty values, to make checking simpler."""
@@ -540,10 +3002,16 @@ class SqlBuilder(object):
         self.where_conds = []
         self.having_conds = []
         self.group_fields = []
+        self.order_fields = []
         self.set_fields = []
+        self.insert_fields = []
+        self.insert_rows = None
         self.joins = []
         self.limit = None
         self.params = []
+        # to report time taken by building the query, see QueryStats
+        self.created = time.time()
+        self.executed = False
 
     def Select(self, *args):
         """
@@ -590,6 +3058,36 @@ class SqlBuilder(object):
                            in (list(args) + list(kwargs.items()))]
         return self
 
+    def Insert(self, insert_table, *fields):
+        """
+        Set the query type to INSERT into given table. Return SqlBuilder.
+
+        Parameters following the table are Fields or column names.
+        When omitted, Values() rows should be dicts, and columns are taken
+        from the keys of the first row.
+        """
+        assert self.query_type is None, \
+            ".Insert() can not be called once query type has been set"
+        assert isinstance(insert_table, Table), "Insert accepts only tables"
+        self.query_type = INSERT
+        self.insert_table = insert_table
+        self.insert_fields = [f.name if isinstance(f, Field) else f
+                              for f in fields]
+        return self
+
+    def Values(self, rows):
+        """
+        Set the rows to be inserted. Return SqlBuilder.
+
+        rows is any iterable, including generators, it is consumed lazily
+        on execution. Each row is a sequence of values in the order of
+        Insert() fields, or a dict of column name => value.
+        """
+        assert self.query_type == INSERT, \
+            ".Values() is only available for Insert() queries"
+        self.insert_rows = rows
+        return self
+
     def Delete(self):
         """
         Sets the query type to DELETE. Return SqlBuilder.
@@ -621,7 +3119,7 @@ class SqlBuilder(object):
 
         Conditions are expected to be of Expr type and are ANDed together.
         """
-        self.where_conds = reduce(operator.and_, args)
+        self.where_conds = Expr.combine('AND', args)
         return self
 
     def And(self, *args):
@@ -635,9 +3133,9 @@ class SqlBuilder(object):
         assert self.where_conds or self.having_conds, \
             ".And() can be called only after .Where() or .Having()"
         if not self.having_conds:
-            self.where_conds &= reduce(operator.and_, args)
+            self.where_conds &= Expr.combine('AND', args)
         else:
-            self.having_conds &= reduce(operator.and_, args)
+            self.having_conds &= Expr.combine('AND', args)
         return self
 
     def Or(self, *args):
@@ -651,9 +3149,9 @@ class SqlBuilder(object):
         assert self.where_conds or self.having_conds, \
             ".Or() can be called only after .Where() or .Having()"
         if not self.having_conds:
-            self.where_conds |= reduce(operator.or_, args)
+            self.where_conds |= Expr.combine('OR', args)
         else:
-            self.having_conds |= reduce(operator.or_, args)
+            self.having_conds |= Expr.combine('OR', args)
         return self
 
     def Join(self, table, join_type, *args):
@@ -667,7 +3165,8 @@ class SqlBuilder(object):
         """
         self.joins.append({
             'table': table if isinstance(table, Table) else "%s %s" % table,
-            'conds': reduce(operator.and_, args) if args else None,
+            'alias': table if isinstance(table, Table) else table[:2],
+            'conds': Expr.combine('AND', args) if args else None,
             'type': join_type,
             })
         return self
@@ -722,15 +3221,16 @@ class SqlBuilder(object):
         Parameters are Exprs.
         """
         assert self.group_fields, "Having can only be used after GroupBy"
-        self.having_conds = reduce(operator.and_, args)
+        self.having_conds = Expr.combine('AND', args)
         return self
 
     def OrderBy(self, *args):
         """Construct ORDER BY clause. Return SqlBuilder.
 
-        Parameters are Fields and Aliases.
+        Parameters are Fields, Aliases and Exprs,
+        or tuples of (Field, 'ASC' or 'DESC').
         """
-        self.order_fields = args
+        self.order_fields = list(args)
         return self
 
     def Limit(self, num_rows):
@@ -741,11 +3241,14 @@ class SqlBuilder(object):
         self.limit = num_rows
         return self
 
-    def sql(self, db=None):
+    def sql(self, db=None, **kwargs):
         """Construct sql to be executed. Return string.
         db parameter indicates type of database engine.
+        Other keyword arguments are passed down to Exprs being rendered.
         """
-        opts = {'params': self.params, 'db': db}
+        opts = {'params': self.params,
+                'db': get_dialect(db) if db is not None else None}
+        opts.update(kwargs)
         if self.query_type == UPDATE:
             assert self.set_fields, "No field setting rules issued, use Set()"
             res = "UPDATE %s SET %s" % (
@@ -761,15 +3264,20 @@ class SqlBuilder(object):
                     str_fields = []
                     for f in self.select_fields:
                         if isinstance(f, (Field, Expr)):
-                            str_fields.append(str(f))
+                            str_fields.append(sqlize(f, **opts))
                         elif isinstance(f, Table):
                             str_fields.append("%s.*" % str(f))
                         elif isinstance(f, Iterable):
-                            str_fields.append("%s AS %s" % f)
+                            str_fields.append("%s AS %s" % (
+                                sqlize(f[0], **opts), f[1]))
                     res += ", ".join(str_fields)
 
         elif self.query_type == DELETE:
                 res = "DELETE"
+        elif self.query_type == INSERT:
+            assert self.insert_fields, \
+                "Columns are required to render INSERT, pass them to Insert()"
+            return self._insert_sql(self.insert_fields, 1)
         else:
             raise Exception("Unknown query type")
         if self.query_type in (SELECT, DELETE):
@@ -788,22 +3296,752 @@ class SqlBuilder(object):
 
         if self.query_type == SELECT:
             if self.group_fields:
-                res += " GROUP_BY %s" % (", ".join(
+                res += " GROUP BY %s" % (", ".join(
                     [str(field) for field in self.group_fields]))
             if self.having_conds:
                 res += " HAVING %s" % self.having_conds.sql(**opts)
+            if self.order_fields:
+                res += " ORDER BY %s" % ", ".join([
+                    sqlize(f, **opts) if not isinstance(f, tuple)
+                    else "%s %s" % (sqlize(f[0], **opts), f[1])
+                    for f in self.order_fields])
 
         if self.limit:
-            res += " LIMIT %s" % self.limit
+            res += " LIMIT %s" % ("?" if kwargs.get('fingerprint')
+                                  else self.limit)
         return res
 
-    def FetchFrom(self, db):
+    def shape(self):
+        """
+        Return SQL of the query with values of Literals, Params and LIMIT
+        replaced by ?, the same for all executions of the query.
+        """
+        if self.query_type == INSERT and not self.insert_fields:
+            # columns are known only once rows are
+            return "INSERT INTO %s" % self.insert_table
+        return self.sql(fingerprint=True)
+
+    def fingerprint(self):
+        """
+        Return hex string identifying the shape of the query, see .shape()
+        """
+        return hashlib.sha1(self.shape()).hexdigest()[:16]
+
+    def tables(self):
+        """Return set of lowercase names of tables query refers to."""
+        return set(name.lower() for name in self.aliases().itervalues())
+
+    def aliases(self):
+        """
+        Return dict of lowercase alias or name of table => name of table,
+        for tables query refers to.
+        """
+        tables = list(self.from_tables)
+        tables.extend(j['alias'] for j in self.joins)
+        if self.query_type == UPDATE:
+            tables.append(self.update_table)
+        elif self.query_type == INSERT:
+            tables.append(self.insert_table)
+        res = {}
+        for t in tables:
+            table, alias = (t, t) if isinstance(t, Table) else t[:2]
+            res[str(alias).lower()] = str(table)
+        return res
+
+    def predicates(self):
+        """
+        Return list of (table, column, kind) of Fields the query filters,
+        joins or orders by, kind is 'equality', 'range', 'join' or 'order'.
+        Tables are resolved from their aliases, column names are lowercase.
+        """
+        return [p for group in self.predicate_groups() for p in group]
+
+    def predicate_groups(self):
+        """
+        Return lists of predicates, like .predicates() does, each to be
+        served by an index of its own: first one of those not within OR,
+        including ORDER BY and GROUP BY, then one for each branch of OR.
+        """
+        aliases = self.aliases()
+        res = []
+        branches = []
+        for conds in [self.where_conds] + [j['conds'] for j in self.joins]:
+            if conds:
+                res.extend(expr_predicates(conds, branches))
+        for f in list(self.order_fields) + list(self.group_fields):
+            if isinstance(f, tuple):
+                f = f[0]
+            if isinstance(f, Field):
+                res.append((f, 'order'))
+        return [[(aliases.get(str(f.table).lower(), str(f.table)),
+                  f.name.lower(), kind) for f, kind in group]
+                for group in [res] + branches if group]
+
+    def _insert_sql(self, columns, num_rows):
+        """Construct INSERT of num_rows rows with placeholders. Return string.
+        """
+        row = "(%s)" % ", ".join(['?'] * len(columns))
+        return "INSERT INTO %s (%s) VALUES %s" % (
+            self.insert_table, ", ".join(columns),
+            ", ".join([row] * num_rows))
+
+    def _insert(self, db):
+        """
+        Insert rows in chunks of multi-row statements, in one transaction,
+        or savepoint within transaction() block.
+        Return number of rows inserted.
+        """
+        assert self.insert_rows is not None, "No rows issued, use Values()"
+        rows = iter(self.insert_rows)
+        columns = self.insert_fields
+        if not columns:
+            # peek the first row for column names
+            for first in rows:
+                assert isinstance(first, dict), \
+                    "Pass columns to Insert() for rows other than dicts"
+                columns = list(first)
+                rows = itertools.chain([first], rows)
+                break
+            else:
+                return 0
+        width = len(columns)
+        chunk_size = max(1, self.max_variables // width)
+        chunk_sql = self._insert_sql(columns, chunk_size)
+        count = 0
+        with db.transaction():
+            while True:
+                args = []
+                num_rows = 0
+                for row in itertools.islice(rows, chunk_size):
+                    if isinstance(row, dict):
+                        row = [row[c] for c in columns]
+                    elif len(row) != width:
+                        raise Exception("Row %d has %d values, %d expected"
+                                        % (count + num_rows, len(row), width))
+                    args.extend(row)
+                    num_rows += 1
+                if not num_rows:
+                    break
+                db._execute(chunk_sql if num_rows == chunk_size
+                            else self._insert_sql(columns, num_rows), args)
+                count += num_rows
+            db._wrote(self.tables())
+        return count
+
+    def _stats(self, db, started):
+        """Return QueryStats for execution started now, None without hooks.
+        """
+        if not db._hooks:
+            return None
+        stats = QueryStats(self, self.params)
+        if not self.executed:
+            stats.build = started - self.created
+        self.executed = True
+        return stats
+
+    def FetchFrom(self, db, batch_size=None):
         """Actually execute the query. Return None or ResultIterator for SELECT
-        For SELECTs return ResultIterator for easy field retrieval
+        For SELECTs return ResultIterator for easy field retrieval,
+        for INSERTs return number of rows inserted.
+
+        With batch_size given, rows are fetched from the cursor
+        by that many at once, and not stored in the result cache of Db.
+        """
+        if self.query_type == INSERT:
+            if db.sharded:
+                return db._insert(self)
+            if not db._hooks:
+                return self._insert(db)
+            started = time.time()
+            stats = self._stats(db, started)
+            if self.insert_fields:
+                stats.sql = self._insert_sql(self.insert_fields, 1)
+            try:
+                stats.rows = self._insert(db)
+            except Exception, e:
+                stats.error = e
+                raise
+            finally:
+                stats.execute = time.time() - started
+                db._report(stats)
+            return stats.rows
+        res = self._execute(db, store=not batch_size)
+        if self.query_type == SELECT:
+            return ResultIterator(self.select_fields, res, batch_size)
+
+    def FetchFromAsync(self, db, batch_size=None):
+        """
+        Execute the query on worker thread of AsyncDb. Return Future.
+
+        For SELECT future's result is AsyncResultIterator,
+        fetching rows in batches of batch_size on the workers as well.
+        For other queries it is the same as FetchFrom() returns.
+        """
+        return db._submit(self, batch_size)
+
+    def _render(self, db):
+        """Render the query for given Db. Return SQL and DB-API args."""
+        paramstyle = db._settings['paramstyle']
+        opts = {'in_threshold': db._settings['in_threshold']}
+        if paramstyle:
+            args = [] if paramstyle == 'qmark' else {}
+            return self.sql(db=db.dialect, paramstyle=paramstyle,
+                            args=args, **opts), args
+        else:
+            return self.sql(db=db.dialect, **opts), ()
+
+    def _execute(self, db, store=True):
+        """
+        Render the query for given Db and execute it. Return cursor.
+        SELECTs go through the result cache of Db, other queries
+        invalidate results of tables they touch.
+        With store False, results are not stored in the cache.
+        """
+        if db.sharded:
+            return db._execute(self)
+        started = time.time() if db._hooks else None
+        query, args = self._render(db)
+        if started is None:
+            return db._run(query, args, self, store=store)
+        stats = self._stats(db, started)
+        stats.render = time.time() - started
+        return db._run(query, args, self, stats, store)
+
+    def Explain(self, db):
+        """
+        Return plan database would use to execute the query, tree of
+        PlanNodes, see .full_scans() and .dump() of it.
+        """
+        assert self.query_type != INSERT or self.insert_fields, \
+            "Columns are required to explain INSERT, pass them to Insert()"
+        query, args = self._render(db)
+        if self.query_type == INSERT:
+            args = [None] * len(self.insert_fields)
+        return explain_plan(db, query, args)
+
+    def ExportTo(self, db, fileobj, format='csv', batch_size=1000):
+        """
+        Execute SELECT and write its rows to file object.
+        Return dict of rows written, seconds taken and rows_per_second.
+
+        Rows are taken from the cursor in batches, and each batch is
+        written at once, memory used does not depend on number of rows,
+        they are not stored in the result cache of Db either.
+        Columns are named by aliases or names of selected fields,
+        or as the database reports them. Formats are those of EXPORTERS:
+            csv: header line, then rows, strings encoded in UTF-8
+            jsonl: JSON object of column name => value per line
+            columns: JSON list of column names on the first line,
+                then JSON list of columns, lists of values, per batch
+        """
+        assert self.query_type == SELECT, \
+            ".ExportTo() is only available for Select() queries"
+        if format not in EXPORTERS:
+            raise Exception("Export format %s unknown" % format)
+        started = time.time()
+        cursor = self._execute(db, store=False)
+        labels = column_labels(self.select_fields) if self.select_fields \
+            else None
+        headers = [(labels and labels[i]) or d[0]
+                   for i, d in enumerate(cursor.description or ())]
+        batches = iter(lambda: cursor.fetchmany(batch_size), [])
+        rows = EXPORTERS[format](fileobj, headers, batches)
+        seconds = time.time() - started
+        return {'rows': rows, 'seconds': seconds,
+                'rows_per_second': rows / seconds if seconds else None}
+
+    def Paginate(self, db, key, page_size=1000, token=None):
+        """
+        Walk the result of SELECT page by page, ordered by key.
+        Return Pages, iterable over lists of RowWrappers.
+
+        key is a Field with unique values, preferably indexed. Pages after
+        the first one are selected by "key > last key seen", so each
+        costs the same regardless of its depth. When key is not among
+        the selected fields, it is added as the last column.
+        token of Pages allows to resume from the page following
+        the last one returned, in another process as well:
+            pages = query.Paginate(db, db.Users.id, 1000, token=saved)
+            for page in pages:
+                process(page)
+                saved = pages.token
+        """
+        assert self.query_type == SELECT, \
+            ".Paginate() is only available for Select() queries"
+        assert not (self.order_fields or self.group_fields or self.limit), \
+            ".Paginate() orders and limits the query itself"
+        return Pages(self, db, key, page_size, token)
+
+    def FetchColumns(self, db, batch_size=1000, as_numpy=False):
+        """
+        Execute SELECT and return its result column by column.
+        Return dict of column name => column values.
+
+        Columns are keyed by the same names rows of ResultIterator have,
+        all names of the column refer to the same object. Integer and float
+        columns are returned as array.array of 'l' and 'd' type, other ones,
+        including columns with NULLs, as lists.
+        With as_numpy=True, they are converted to numpy arrays.
+        """
+        assert self.query_type == SELECT, \
+            ".FetchColumns() is only available for Select() queries"
+        cursor = self._execute(db, store=False)
+        columns = None
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                break
+            if columns is None:
+                columns = [None] * len(batch[0])
+            for i, values in enumerate(zip(*batch)):
+                columns[i] = extend_column(columns[i], values)
+        if columns is None:
+            columns = [[] for d in cursor.description or ()]
+        if as_numpy:
+            import numpy
+            columns = [numpy.frombuffer(c, dtype=numpy.dtype(c.typecode))
+                       if isinstance(c, array.array)
+                       else numpy.array(c, dtype=object)
+                       for c in columns]
+        return dict((name, columns[pos]) for name, pos in column_index(
+            self.select_fields, cursor).iteritems())
+
+    def Prepare(self, db):
+        """
+        Compile the query once for given Db. Return PreparedQuery.
+
+        Tree of Exprs is rendered only here, later executions
+        of PreparedQuery just substitute parameter values into the template.
+        """
+        return PreparedQuery(self, db)
+
+    def ExecuteMany(self, db, param_sets):
+        """
+        Execute UPDATE or DELETE once for each of params dicts.
+        Return number of rows affected.
+
+        SQL is rendered only once, param_sets may be a generator,
+        it is consumed lazily by the database driver.
+        """
+        return self.Prepare(db).ExecuteMany(db, param_sets)
+
+
+class PreparedQuery(object):
+    """
+    SqlBuilder compiled into SQL template with slots for Params.
+
+    Usage:
+        prepared = query.Prepare(db)
+        rows = prepared.FetchFrom(db, {'since': since})
+
+    Changes to the SqlBuilder made after .Prepare() are not seen here.
+    Since values are unknown at compile time, Param compared to None
+    is rendered as "= NULL" rather than "IS NULL".
+    """
+    def __init__(self, query, db):
+        """Render the query leaving slots for Params, split it by them."""
+        self.query_type = query.query_type
+        self.select_fields = list(query.select_fields)
+        self.dialect = db.dialect
+        self.in_threshold = db._settings['in_threshold']
+        self.table_names = query.tables()
+        self.table_aliases = query.aliases()
+        self.query_predicate_groups = query.predicate_groups()
+        self.query_shape = query.shape()
+        self.slots = []
+        self.fragments = query.sql(db=self.dialect, slots=self.slots,
+            in_threshold=self.in_threshold).split(PARAM_SLOT)
+        if len(self.fragments) != len(self.slots) + 1:
+            raise Exception("NUL character found in query text")
+
+    def tables(self):
+        """Return set of lowercase names of tables query refers to."""
+        return self.table_names
+
+    def aliases(self):
+        """Return dict of lowercase alias or name of table => its name."""
+        return self.table_aliases
+
+    def predicates(self):
+        """Return list of (table, column, kind) of Fields used by query."""
+        return [p for group in self.query_predicate_groups for p in group]
+
+    def predicate_groups(self):
+        """Return lists of predicates served by an index each."""
+        return self.query_predicate_groups
+
+    def shape(self):
+        """Return SQL of the query with values replaced by ?"""
+        return self.query_shape
+
+    def fingerprint(self):
+        """Return hex string identifying the shape of the query."""
+        return hashlib.sha1(self.query_shape).hexdigest()[:16]
+
+    def sql(self, params, paramstyle=None, args=None):
+        """
+        Substitute params into the template. Return string.
+
+        With paramstyle given, placeholders are substituted instead,
+        while values are added to args (list for 'qmark', dict for 'named')
+        """
+        fragments = self.fragments
+        res = [fragments[0]]
+        for i, name in enumerate(self.slots):
+            if name not in params:
+                raise Exception('parameter "%s" not found' % name)
+            if paramstyle:
+                res.append(bind_param(name, params[name], paramstyle, args,
+                                      self.in_threshold))
+            else:
+                res.append(Literal(params[name]).sql(
+                    db=self.dialect, in_threshold=self.in_threshold))
+            res.append(fragments[i + 1])
+        return "".join(res)
+
+    def FetchFrom(self, db, params=None, batch_size=None):
+        """Execute the query with given params dict.
+        Return None or ResultIterator for SELECT, same as SqlBuilder does.
         """
-        res = db._execute(self.sql(db=db._settings['engine']))
+        started = time.time() if db._hooks else None
+        paramstyle = db._settings['paramstyle']
+        if paramstyle:
+            args = [] if paramstyle == 'qmark' else {}
+            query = self.sql(params or {}, paramstyle, args)
+        else:
+            args = ()
+            query = self.sql(params or {})
+        stats = None
+        if started is not None:
+            stats = QueryStats(self, params)
+            stats.render = time.time() - started
+        res = db._run(query, args, self, stats, not batch_size)
         if self.query_type == SELECT:
-            return ResultIterator(self.select_fields, res)
+            return ResultIterator(self.select_fields, res, batch_size)
+
+    def ExecuteMany(self, db, param_sets):
+        """
+        Execute the query once for each of params dicts in param_sets.
+        Return number of rows affected.
+
+        Values are always bound natively, using Db paramstyle or 'qmark'.
+        Sequence values are not allowed, since all executions share the SQL.
+        """
+        assert self.query_type != SELECT, \
+            ".ExecuteMany() is not available for Select() queries"
+        paramstyle = db._settings['paramstyle'] or 'qmark'
+        slots = self.slots
+
+        def bind(params):
+            """Return DB-API args for single execution."""
+            for name in slots:
+                if name not in params:
+                    raise Exception('parameter "%s" not found' % name)
+                value = params[name]
+                if isinstance(value, Iterable) \
+                        and not isinstance(value, basestring):
+                    raise Exception(
+                        'parameter "%s" can not be a sequence' % name)
+            if paramstyle == 'qmark':
+                return [params[name] for name in slots]
+            else:
+                return dict((str(name), params[name]) for name in slots)
+
+        if paramstyle == 'qmark':
+            query = '?'.join(self.fragments)
+        else:
+            query = self.sql(dict.fromkeys(slots), paramstyle, {})
+        if not db._hooks:
+            res = db._executemany(query, (bind(p) for p in param_sets))
+            db._wrote(self.table_names)
+            return res.rowcount
+        stats = QueryStats(self)
+        stats.sql = query
+        started = time.time()
+        try:
+            stats.rows = db._executemany(
+                query, (bind(p) for p in param_sets)).rowcount
+        except Exception, e:
+            stats.error = e
+            raise
+        finally:
+            stats.execute = time.time() - started
+            db._report(stats)
+        db._wrote(self.table_names)
+        return stats.rows
+
+
+class Pages(object):
+    """
+    Pages of SELECT walked by keyset pagination, see SqlBuilder.Paginate()
+
+    .token is a string identifying the position after the last page
+    returned, None before the first one. Changes to the SqlBuilder made
+    after .Paginate() are not seen here.
+    """
+    # name of Param holding the last key seen
+    after_param = '__after__'
+
+    def __init__(self, query, db, key, page_size, token=None):
+        """Prepare queries of the first page and of the following ones."""
+        self.db = db
+        self.params = dict(query.params or {})
+        self.page_size = page_size
+        fields = list(query.select_fields)
+        if not fields:
+            # "*" can not be followed by the key, select tables instead
+            fields = [t if isinstance(t, Table) else Table(t[1])
+                      for t in query.from_tables]
+            fields.extend(j['alias'] if isinstance(j['alias'], Table)
+                          else Table(j['alias'][1]) for j in query.joins)
+        self.key_pos = -1
+        if not any(isinstance(f, Table) for f in fields):
+            for i, f in enumerate(fields):
+                if f is key or isinstance(f, tuple) and f[0] is key:
+                    self.key_pos = i
+        if self.key_pos == -1:
+            fields.append(key)
+        page = SqlBuilder().Select(*fields)
+        page.from_tables = query.from_tables
+        page.joins = query.joins
+        page.OrderBy(key).Limit(page_size)
+        page.where_conds = query.where_conds
+        self.first = page.Prepare(db)
+        after = key > Param(self.after_param)
+        page.where_conds = query.where_conds & after \
+            if query.where_conds else Expr(after)
+        self.following = page.Prepare(db)
+        self.token = token
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Fetch the next page. Return list of RowWrappers."""
+        if self.done:
+            raise StopIteration
+        if self.token is None:
+            rows = self.first.FetchFrom(self.db, self.params)
+        else:
+            params = dict(self.params)
+            params[self.after_param] = self.decode(self.token)
+            rows = self.following.FetchFrom(self.db, params)
+        page = list(rows)
+        if len(page) < self.page_size:
+            self.done = True
+        if not page:
+            raise StopIteration
+        self.token = self.encode(page[-1][self.key_pos])
+        return page
+
+    @staticmethod
+    def encode(value):
+        """Return token for given key value."""
+        return base64.urlsafe_b64encode(json.dumps(value, default=str))
+
+    @staticmethod
+    def decode(token):
+        """Return key value of given token."""
+        try:
+            return json.loads(base64.urlsafe_b64decode(str(token)))
+        except (TypeError, ValueError):
+            raise Exception("Invalid page token %r" % token)
+
+
+# kinds of predicates Fields are used in by comparison operators
+PREDICATE_KINDS = {
+    '=': 'equality',
+    'IN': 'equality',
+    '<': 'range',
+    '<=': 'range',
+    '>': 'range',
+    '>=': 'range',
+}
+
+
+def expr_predicates(expr, branches):
+    """
+    Return list of (Field, kind) of Fields compared in the Expr,
+    see SqlBuilder.predicates()
+    Fields of each branch of OR are listed on their own, in a list
+    appended to branches, since they are not used together.
+    """
+    res = []
+    # nodes with lists their Fields go to
+    stack = [(expr, res)]
+    while stack:
+        node, group = stack.pop()
+        if not isinstance(node, Expr) or node.func:
+            continue
+        if node.operator == 'AND':
+            stack.extend((child, group) for child in node.children)
+            continue
+        if node.operator == 'OR':
+            for child in node.children:
+                branches.append([])
+                stack.append((child, branches[-1]))
+            continue
+        kind = PREDICATE_KINDS.get(node.operator)
+        if kind is None or len(node.children) != 2:
+            continue
+        left, right = [unwrap(child) for child in node.children]
+        if isinstance(left, Field) and isinstance(right, Field):
+            if node.operator == '=':
+                group.extend([(left, 'join'), (right, 'join')])
+        elif isinstance(left, Field):
+            group.append((left, kind))
+        elif isinstance(right, Field):
+            group.append((right, kind))
+    return res
+
+
+def unwrap(obj):
+    """Return leaf wrapped into Expr, like E(field), or obj itself."""
+    while isinstance(obj, Expr) and obj.operator is None and not obj.func \
+            and len(obj.children) == 1:
+        obj = obj.children[0]
+    return obj
+
+
+def column_names(fields):
+    """
+    Return list of (short, long, alias) names of selected fields,
+    one per column, lowercased. Unknown names are None.
+
+    short is a field name, long is table__name, alias is the one given in
+    Select() tuple, or field name otherwise. Return None when the number
+    of columns is unknown, that is when Table.* is selected.
+    """
+    res = []
+    for f in fields:
+        if isinstance(f, Table):
+            return None
+        alias = None
+        if not isinstance(f, (Field, Expr)):
+            f, alias = f
+        if isinstance(f, Field):
+            short = f.name.lower()
+            res.append((short, ("%s__%s" % (f.table, f.name)).lower(),
+                        alias.lower() if alias else short))
+        else:
+            res.append((None, None, alias.lower() if alias else None))
+    return res
+
+
+def column_labels(fields):
+    """
+    Return list of aliases given in Select() tuples, or names of fields
+    otherwise, as they were given, one per column. Unknown ones are None.
+    Return None when the number of columns is unknown, like column_names().
+    """
+    res = []
+    for f in fields:
+        if isinstance(f, Table):
+            return None
+        if not isinstance(f, (Field, Expr)):
+            res.append(f[1])
+        else:
+            res.append(f.name if isinstance(f, Field) else None)
+    return res
+
+
+def column_index(fields, cursor):
+    """
+    Return dict of lowercase column name => position in result row.
+
+    Short names take precedence over long ones, and those over aliases,
+    the first column wins among the same kind of names.
+    When names are unknown, those reported by the cursor are used.
+    """
+    names = column_names(fields) if fields else None
+    if names is None:
+        names = [(d[0].lower(), None, None)
+                 for d in cursor.description or ()]
+    res = {}
+    for kind in (2, 1, 0):
+        for i in reversed(xrange(len(names))):
+            if names[i][kind]:
+                res[names[i][kind]] = i
+    return res
+
+
+def extend_column(column, values):
+    """
+    Append values to column, creating it when None. Return column.
+
+    Integers and floats are kept in array.array, which turns into a list
+    once a value of other type or NULL comes in.
+    """
+    if column is None:
+        if type(values[0]) in (int, long):
+            column = array.array('l')
+        elif type(values[0]) is float:
+            column = array.array('d')
+        else:
+            column = []
+    if isinstance(column, array.array):
+        size = len(column)
+        try:
+            column.extend(values)
+            return column
+        except (TypeError, OverflowError):
+            # array keeps values added before the failing one
+            del column[size:]
+            column = column.tolist()
+    column.extend(values)
+    return column
+
+
+def export_csv(fileobj, headers, batches):
+    """Write header and batches of rows as CSV. Return number of rows."""
+    buf = cStringIO.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([h.encode('utf-8') for h in headers])
+    count = 0
+    for batch in batches:
+        writer.writerows([[v.encode('utf-8') if type(v) is unicode else v
+                           for v in row] for row in batch])
+        fileobj.write(buf.getvalue())
+        buf.seek(0)
+        buf.truncate()
+        count += len(batch)
+    fileobj.write(buf.getvalue())
+    return count
+
+
+def export_jsonl(fileobj, headers, batches):
+    """Write batches of rows as JSON objects, one per line.
+    Return number of rows.
+    """
+    encode = json.JSONEncoder(default=str).encode
+    count = 0
+    for batch in batches:
+        fileobj.write("".join([encode(dict(zip(headers, row))) + "\n"
+                               for row in batch]))
+        count += len(batch)
+    return count
+
+
+def export_columns(fileobj, headers, batches):
+    """Write column names, then each batch of rows as list of columns,
+    a line of JSON each. Return number of rows.
+    """
+    encode = json.JSONEncoder(default=str).encode
+    fileobj.write(encode(headers) + "\n")
+    count = 0
+    for batch in batches:
+        fileobj.write(encode(zip(*batch)) + "\n")
+        count += len(batch)
+    return count
+
+
+# formats of SqlBuilder.ExportTo(), functions writing them
+EXPORTERS = {
+    'csv': export_csv,
+    'jsonl': export_jsonl,
+    'columns': export_columns,
+}
 
 
 class ResultIterator(object):
@@ -812,65 +4050,165 @@ class ResultIterator(object):
     for each row returned from it, wraps it into RowWrapper,
     which allows accessing columns by their names or aliases.
 
-    Will silently fail for most cases where * is involved.
+    Column names are resolved once per query into a name => position
+    mapping shared by all rows. When * is selected, column names
+    reported by the cursor are used.
+
+    When batch_size is given, rows are fetched with cursor.fetchmany().
+    Consumers processing rows in blocks may use .iter_batches() instead.
     """
-    def __init__(self, fields, cursor):
-        """Initialize, pregenerate lowercase column name arrays."""
-        short_fields = []
-        long_fields = []
-        alias_fields = []
-        for f in fields:
-            if isinstance(f, Field):
-                short_fields.append(f.name)
-                long_fields.append(("%s__%s" % (str(f.table), f.name)))
-                alias_fields.append(f.name)
-            elif isinstance(f, Iterable):
-                f, alias = f
-                short_fields.append(f.name)
-                long_fields.append(("%s__%s" % (str(f.table), f.name)))
-                alias_fields.append(alias)
-
-        self.short_fields = [f.lower() for f in short_fields]
-        self.long_fields = [f.lower() for f in long_fields]
-        self.alias_fields = [f.lower() for f in alias_fields]
+    # size of batches when neither it nor batch_size were given
+    default_batch_size = 500
+
+    def __init__(self, fields, cursor, batch_size=None):
+        """Initialize, pregenerate row class with lowercase column mapping.
+        """
+        self.row_class = RowWrapper.subclass(column_index(fields, cursor))
         self.cursor = cursor
+        self.batch_size = batch_size
+        # rows fetched in batch mode, but not returned yet
+        self.buffer = iter(())
+        if batch_size:
+            cursor.arraysize = batch_size
 
     def next(self):
         """Return RowWrapper for given row."""
-        return RowWrapper(self.cursor.next(),
-            self.short_fields, self.long_fields, self.alias_fields)
+        if not self.batch_size:
+            return self.row_class(self.cursor.next())
+        try:
+            return self.buffer.next()
+        except StopIteration:
+            self.buffer = iter(map(
+                self.row_class, self.cursor.fetchmany(self.batch_size)))
+            return self.buffer.next()
+
+    def iter_batches(self, size=None):
+        """
+        Yield lists of RowWrappers of given size, last one may be shorter.
+        Size defaults to batch_size, or default_batch_size.
+        """
+        size = size or self.batch_size or self.default_batch_size
+        rest = list(self.buffer)
+        if rest:
+            yield rest
+        fetchmany = self.cursor.fetchmany
+        row_class = self.row_class
+        while True:
+            batch = fetchmany(size)
+            if not batch:
+                return
+            yield map(row_class, batch)
 
     def __iter__(self):
-        """Indicate object as iterable"""
+        """Indicate object as iterable.
+        In batch mode return iterator over batches' rows, it is faster.
+        """
+        if self.batch_size:
+            return itertools.chain.from_iterable(self.iter_batches())
         return self
 
+    def close(self):
+        """Close the cursor, rows left unread are dropped."""
+        close = getattr(self.cursor, 'close', None)
+        if close is not None:
+            close()
+
+
+class AsyncResultIterator(object):
+    """
+    Rows of SELECT run by AsyncDb, fetched in batches on its workers.
+
+    Usage:
+        rows = query.FetchFromAsync(db).result()
+        batch = rows.fetch_batch().result()
+        while batch:
+            ...
+            batch = rows.fetch_batch().result()
+
+    Pooled connection is held until rows are exhausted or .close() is called.
+    """
+    def __init__(self, db, connection, rows):
+        """Initialize with AsyncDb, connection in use and ResultIterator."""
+        self.db = db
+        self.connection = connection
+        self.rows = rows
+        self.batches = rows.iter_batches()
+
+    def fetch_batch(self):
+        """
+        Schedule fetching of the next batch, to be called once the previous
+        one is done. Return Future of list of RowWrappers, empty at the end.
+        """
+        return self.db.executor.submit(self._next_batch)
+
+    def _next_batch(self):
+        """Fetch next batch in worker thread. Return list of RowWrappers."""
+        if self.connection is None:
+            return []
+        try:
+            batch = next(self.batches, [])
+        except:
+            self.close()
+            raise
+        if not batch:
+            self.close()
+        return batch
+
+    def close(self):
+        """Give the connection back to the pool."""
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            self.rows.close()
+            self.db._pool.release(connection)
+
 
 class RowWrapper(object):
     """
     A wrapper over cursor row returned from database.
     Allows accessing it by name, table__name and alias.
+
+    ResultIterator generates a subclass per query,
+    holding mapping of lowercase column names to positions in _columns.
     """
-    def __init__(self, values, short_fields, long_fields, alias_fields):
-        """Initialize, save values and column name arrays."""
+    __slots__ = ('values', )
+    _columns = {}
+    # subclasses already generated, by their columns, least recently used
+    # first, up to max_subclasses of them
+    _subclasses = collections.OrderedDict()
+    _subclasses_lock = threading.Lock()
+    max_subclasses = 1000
+
+    def __init__(self, values):
+        """Initialize, save values."""
         self.values = values
-        self.short_fields = short_fields
-        self.long_fields = long_fields
-        self.alias_fields = alias_fields
+
+    @classmethod
+    def subclass(cls, columns):
+        """
+        Return subclass for given column mapping, generated once
+        while it is among max_subclasses recently used ones.
+        """
+        key = tuple(sorted(columns.iteritems()))
+        with cls._subclasses_lock:
+            res = cls._subclasses.pop(key, None)
+            if res is None:
+                res = type('RowWrapper', (cls, ),
+                           {'__slots__': (), '_columns': columns})
+                if len(cls._subclasses) >= cls.max_subclasses:
+                    cls._subclasses.popitem(last=False)
+            cls._subclasses[key] = res
+        return res
 
     def __getattr__(self, attr):
         """
-        Attempt to find given column name in our arrays.
+        Attempt to find given column name in our mapping.
         If successful, return it.
         """
-        attr = attr.lower()
         if not self.values:
             return
-        if attr in self.short_fields:
-            return self.values[self.short_fields.index(attr)]
-        if attr in self.long_fields:
-            return self.values[self.long_fields.index(attr)]
-        if attr in self.alias_fields:
-            return self.values[self.alias_fields.index(attr)]
+        pos = self._columns.get(attr.lower())
+        if pos is not None:
+            return self.values[pos]
 
     # this here to provide user with methods available in original value tuple
     def __repr__(self):
@@ -3,7 +3,17 @@
 # run with nosetest
 
 import sql
+import cStringIO
+import csv
 import datetime
+import decimal
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import warnings
 from sql import Expr as E, Param as P, Literal as L, Alias as A
 
 # we need to initialize it to get access to Table generation
@@ -14,6 +24,15 @@ def test_table_field_repr():
     assert repr(db.Users) == "<Table:Users>"
     assert repr(db.aa.bb) == "<Field:aa.bb>"
 
+def test_interning():
+    assert db.Users is db.Users
+    assert db.Users.id is db.Users.id
+    assert db.Users is not sql.Db(engine='sqlite', name=':memory:').Users
+    # nodes are slotted, no instance __dict__ in any of their classes
+    for node in (db.Users, db.Users.id, E(1), L(1), P('x'), A('x')):
+        assert not [cls for cls in type(node).__mro__
+                    if '__dict__' in vars(cls) and cls is not object]
+
 def test_exprs():
     # monkeypatch Literal to make it work without db provided
     sql.Literal.default_db = 'sqlite'
@@ -22,7 +41,7 @@ def test_exprs():
     assert str(E(E(db.z.i, 1, operator='='))) == "(z.i = 1)"
     # representation of simple ones
     assert repr(E(db.a.b == 1, db.b.c != 1).children) == \
-      "[<Expr: <Field:a.b> = <Literal:1>>, <Expr: <Field:b.c> != <Literal:1>>]"
+      "(<Expr: <Field:a.b> = <Literal:1>>, <Expr: <Field:b.c> != <Literal:1>>)"
     # a group is represented by its operator
     assert repr(E((db.a.b == 1) & (db.b.c != 1))) == "<Expr: AND>"
     # Literals can be passed in
@@ -135,13 +154,14 @@ def test_select():
         ).Having(sql.Count() > 4
         ).OrderBy(db.Users.name).Limit(5).sql(db="sqlite") == \
             "SELECT COUNT(*) FROM Users WHERE (Users.id > 12) "\
-            "GROUP_BY Users.name HAVING (COUNT(*) > 4) LIMIT 5"
+            "GROUP BY Users.name HAVING (COUNT(*) > 4) " \
+            "ORDER BY Users.name LIMIT 5"
 
     assert sql.SqlBuilder().Select((sql.Count(),'X')).From(db.Users
         ).Where(db.Users.id > 12).GroupBy(db.Users.name).Having(A('X') > 4
         ).OrderBy(db.Users.name).Limit(5).sql(db="sqlite") == \
             "SELECT COUNT(*) AS X FROM Users WHERE (Users.id > 12) "\
-            "GROUP_BY Users.name HAVING (X > 4) LIMIT 5"
+            "GROUP BY Users.name HAVING (X > 4) ORDER BY Users.name LIMIT 5"
 
     assert sql.SqlBuilder().Select(db.z).From(db.z, db.e
         ).Where(db.z.id == db.e.xid).sql(db="sqlite") == \
@@ -216,3 +236,1112 @@ def test_fetch():
     assert u'joe' == query.FetchFrom(db).next()[1]
     # third call, access by alias
     assert u'joe' == query.FetchFrom(db).next().lgn
+
+def test_prepare():
+    db = sql.Db(engine='sqlite', name=':memory:')
+    db._execute("CREATE TABLE Users (id integer, login varchar(35))")
+    db._execute("INSERT INTO Users(id, login) VALUES(1, 'joe')")
+    db._execute("INSERT INTO Users(id, login) VALUES(2, 'bill')")
+
+    query = sql.SqlBuilder().Select(db.Users.id, db.Users.login
+        ).From(db.Users).Where(db.Users.id == P('id'))
+    prepared = query.Prepare(db)
+    assert prepared.slots == ['id']
+    assert prepared.sql({'id': 2}) == \
+        "SELECT Users.id, Users.login FROM Users WHERE (Users.id = 2)"
+    assert prepared.FetchFrom(db, {'id': 1}).next().login == u'joe'
+    assert prepared.FetchFrom(db, {'id': 2}).next().login == u'bill'
+    # values get escaped as usual
+    assert prepared.sql({'id': "'x"}) == \
+        "SELECT Users.id, Users.login FROM Users WHERE (Users.id = '''x')"
+    try:
+        prepared.sql({})
+        assert False, "missing parameter must raise"
+    except Exception, e:
+        assert 'parameter "id" not found' in str(e)
+
+def test_bind_params():
+    query = sql.SqlBuilder().Select(db.Users.id).From(db.Users
+        ).Where(db.Users.login == P('login')).And(db.Users.id._in_(P('ids')))
+    query.params = {'login': "jo'e", 'ids': [1, 2]}
+    args = []
+    assert query.sql(db='sqlite', paramstyle='qmark', args=args) == \
+        "SELECT Users.id FROM Users " \
+        "WHERE ((Users.login = ?) AND (Users.id IN (?, ?)))"
+    assert args == ["jo'e", 1, 2]
+    args = {}
+    assert query.sql(db='sqlite', paramstyle='named', args=args) == \
+        "SELECT Users.id FROM Users " \
+        "WHERE ((Users.login = :login) AND (Users.id IN (:ids_0, :ids_1)))"
+    assert args == {'login': "jo'e", 'ids_0': 1, 'ids_1': 2}
+
+    for paramstyle in sql.PARAMSTYLES:
+        bdb = sql.Db(engine='sqlite', name=':memory:', paramstyle=paramstyle)
+        bdb._execute("CREATE TABLE Users (id integer, login varchar(35))")
+        bdb._execute("INSERT INTO Users(id, login) VALUES(1, 'jo''e')")
+        bdb._execute("INSERT INTO Users(id, login) VALUES(2, 'bill')")
+        assert [row.id for row in query.FetchFrom(bdb)] == [1]
+        prepared = query.Prepare(bdb)
+        assert [row.id for row in prepared.FetchFrom(
+            bdb, {'login': 'bill', 'ids': (2, 3, 4)})] == [2]
+
+def test_execute_many():
+    for paramstyle in (None, ) + sql.PARAMSTYLES:
+        mdb = sql.Db(engine='sqlite', name=':memory:', paramstyle=paramstyle)
+        mdb._execute("CREATE TABLE Users (id integer, login varchar(35))")
+        for i in range(10):
+            mdb._execute("INSERT INTO Users(id, login) VALUES(?, 'x')", (i,))
+
+        query = sql.SqlBuilder().Update(mdb.Users).Set(login=P('login')
+            ).Where(mdb.Users.id == P('id'))
+        assert query.ExecuteMany(mdb, ({'id': i, 'login': 'u%d' % i}
+                                       for i in range(5))) == 5
+        rows = sql.SqlBuilder().Select(mdb.Users.login).From(mdb.Users
+            ).FetchFrom(mdb)
+        assert [row.login for row in rows] == \
+            ['u0', 'u1', 'u2', 'u3', 'u4', 'x', 'x', 'x', 'x', 'x']
+
+        query = sql.SqlBuilder().Delete().From(mdb.Users
+            ).Where(mdb.Users.id > P('id'))
+        assert query.ExecuteMany(mdb, iter([{'id': 7}, {'id': 2}])) == 7
+        try:
+            query.ExecuteMany(mdb, [{'id': (1, 2)}])
+            assert False, "sequence parameter must raise"
+        except Exception, e:
+            assert 'can not be a sequence' in str(e)
+
+def test_insert():
+    assert sql.SqlBuilder().Insert(db.Users, db.Users.id, 'login'
+        ).sql(db='sqlite') == "INSERT INTO Users (id, login) VALUES (?, ?)"
+
+    idb = sql.Db(engine='sqlite', name=':memory:')
+    idb._execute("CREATE TABLE Users (id integer, login varchar(35))")
+    query = sql.SqlBuilder().Insert(idb.Users, idb.Users.id, idb.Users.login)
+    query.max_variables = 10  # 5 rows per statement
+    assert query.Values((i, 'u%d' % i) for i in range(12)).FetchFrom(idb) \
+        == 12
+    assert sql.SqlBuilder().Insert(idb.Users).Values(
+        [{'login': 'x', 'id': 12}, {'id': 13, 'login': 'y'}]
+        ).FetchFrom(idb) == 2
+    assert sql.SqlBuilder().Insert(idb.Users).Values([]).FetchFrom(idb) == 0
+    rows = sql.SqlBuilder().Select(idb.Users.id, idb.Users.login
+        ).From(idb.Users).FetchFrom(idb)
+    assert [tuple(row) for row in rows] == \
+        [(i, 'u%d' % i) for i in range(12)] + [(12, 'x'), (13, 'y')]
+
+    # a failing chunk rolls back the whole insert
+    query = sql.SqlBuilder().Insert(idb.Users, 'id', 'login')
+    query.max_variables = 2
+    try:
+        query.Values([(20, 'a')] * 3 + [(21, )]).FetchFrom(idb)
+        assert False, "row of wrong width must raise"
+    except Exception, e:
+        assert 'Row 3 has 1 values, 2 expected' in str(e)
+    assert idb._execute("SELECT COUNT(*) FROM Users").fetchone()[0] == 14
+
+def test_row_columns():
+    rdb = sql.Db(engine='sqlite', name=':memory:')
+    rdb._execute("CREATE TABLE Users (id integer, login varchar(35))")
+    rdb._execute("CREATE TABLE Profiles (id integer, login varchar(35))")
+    rdb._execute("INSERT INTO Users(id, login) VALUES(1, 'joe')")
+    rdb._execute("INSERT INTO Profiles(id, login) VALUES(1, 'joe2')")
+
+    row = sql.SqlBuilder().Select(sql.Count(), (sql.Max(rdb.Users.id), 'mx'),
+        rdb.Users.login, (rdb.Profiles.login, 'id')
+        ).From(rdb.Users, rdb.Profiles).FetchFrom(rdb).next()
+    # unnamed expressions keep positions of the following columns
+    assert (row.mx, row.login, row.profiles__login) == (1, 'joe', 'joe2')
+    # first of the same field names wins, aliases work too
+    assert (row.login, row.id) == ('joe', 'joe2')
+    assert row.missing is None
+
+    # for * names come from the cursor
+    row = sql.SqlBuilder().Select().From(rdb.Users).FetchFrom(rdb).next()
+    assert (row.ID, row.login) == (1, 'joe')
+    # row classes are shared by queries of the same columns, up to a limit
+    assert type(row) is type(
+        sql.SqlBuilder().Select().From(rdb.Users).FetchFrom(rdb).next())
+    for i in range(sql.RowWrapper.max_subclasses + 10):
+        sql.RowWrapper.subclass({'c%d' % i: 0})
+    assert len(sql.RowWrapper._subclasses) == sql.RowWrapper.max_subclasses
+
+def test_batches():
+    bdb = sql.Db(engine='sqlite', name=':memory:')
+    bdb._execute("CREATE TABLE Users (id integer, login varchar(35))")
+    sql.SqlBuilder().Insert(bdb.Users, 'id', 'login').Values(
+        (i, 'u%d' % i) for i in range(10)).FetchFrom(bdb)
+    query = sql.SqlBuilder().Select(bdb.Users.id).From(bdb.Users)
+
+    assert [row.id for row in query.FetchFrom(bdb, batch_size=3)] == range(10)
+    rows = query.FetchFrom(bdb, batch_size=4)
+    assert rows.next().id == 0
+    # the rest of the first batch comes first
+    assert [[row.id for row in batch] for batch in rows.iter_batches()] == \
+        [[1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert [len(batch) for batch in
+            query.FetchFrom(bdb).iter_batches(6)] == [6, 4]
+
+def test_fetch_columns():
+    cdb = sql.Db(engine='sqlite', name=':memory:')
+    cdb._execute("CREATE TABLE Users (id integer, login varchar(35), "
+                 "age integer, score real)")
+    sql.SqlBuilder().Insert(cdb.Users, 'id', 'login', 'age', 'score').Values(
+        (i, 'u%d' % i, i if i != 3 else None, i / 2.0) for i in range(5)
+        ).FetchFrom(cdb)
+
+    cols = sql.SqlBuilder().Select(cdb.Users.id, cdb.Users.login,
+        cdb.Users.age, (cdb.Users.score, 'mx')
+        ).From(cdb.Users).FetchColumns(cdb, batch_size=2)
+    assert cols['id'] is cols['users__id']
+    assert cols['id'].typecode == 'l' and list(cols['id']) == range(5)
+    assert cols['login'] == ['u0', 'u1', 'u2', 'u3', 'u4']
+    # a NULL turns column into a list
+    assert cols['age'] == [0, 1, 2, None, 4]
+    assert cols['mx'].typecode == 'd' and \
+        list(cols['mx']) == [0.0, 0.5, 1.0, 1.5, 2.0]
+
+    cols = sql.SqlBuilder().Select().From(cdb.Users).Where(cdb.Users.id > 9
+        ).FetchColumns(cdb)
+    assert cols == {'id': [], 'login': [], 'age': [], 'score': []}
+
+def test_settings_per_instance():
+    db1 = sql.Db(engine='sqlite', name=':memory:', paramstyle='qmark')
+    db2 = sql.Db(engine='sqlite', name=':memory:')
+    assert db1._settings['paramstyle'] == 'qmark'
+    assert db2._settings['paramstyle'] is None
+
+def test_pool():
+    tmp = tempfile.mkdtemp()
+    try:
+        pdb = sql.Db(engine='sqlite', name=os.path.join(tmp, 'db'),
+                     pool_size=2, pool_timeout=0.1)
+        with pdb.checkout():
+            pdb._execute("CREATE TABLE Users (id integer)")
+            sql.SqlBuilder().Insert(pdb.Users, 'id').Values(
+                [(1, ), (2, )]).FetchFrom(pdb)
+        query = sql.SqlBuilder().Select(sql.Count()).From(pdb.Users)
+        results = []
+
+        def worker():
+            with pdb.checkout():
+                results.append(query.FetchFrom(pdb).next()[0])
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == [2] * 8
+        assert pdb._pool.size <= 2
+
+        # connections are not kept by threads outside of checkout()
+        def outside():
+            try:
+                query.FetchFrom(pdb)
+            except Exception, e:
+                results.append(str(e))
+        threads = [threading.Thread(target=outside) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(results) == 11 and 'checkout' in results[-1]
+
+        # transaction() checks a connection out for its block
+        def insert():
+            with pdb.transaction():
+                sql.SqlBuilder().Insert(pdb.Users, 'id').Values([(3, )]
+                    ).FetchFrom(pdb)
+        t = threading.Thread(target=insert)
+        t.start()
+        t.join()
+        assert pdb._pool.idle.qsize() == pdb._pool.size
+        with pdb.checkout():
+            assert query.FetchFrom(pdb).next()[0] == 3
+
+        # pool is exhausted while two blocks hold connections
+        with pdb.checkout():
+            other = pdb._pool.acquire()
+            try:
+                pdb._pool.acquire()
+                raise AssertionError("exhausted pool must raise")
+            except Exception, e:
+                assert 'No free connection' in str(e)
+            pdb._pool.release(other)
+        assert pdb._pool.acquire() is not None
+    finally:
+        shutil.rmtree(tmp)
+
+def test_async():
+    tmp = tempfile.mkdtemp()
+    try:
+        adb = sql.AsyncDb(engine='sqlite', name=os.path.join(tmp, 'db'),
+                          workers=2)
+        with adb.checkout():
+            adb._execute("CREATE TABLE Users (id integer)")
+        assert sql.SqlBuilder().Insert(adb.Users, 'id').Values(
+            (i, ) for i in range(10)).FetchFromAsync(adb).result() == 10
+        # writes are committed
+        assert sql.SqlBuilder().Delete().From(adb.Users).Where(
+            adb.Users.id > 6).FetchFromAsync(adb).result(timeout=5) is None
+
+        done = threading.Event()
+        future = sql.SqlBuilder().Select(adb.Users.id).From(adb.Users
+            ).FetchFromAsync(adb, batch_size=3)
+        future.add_done_callback(lambda f: done.set())
+        rows = future.result()
+        assert done.wait(5)
+        batches = []
+        batch = rows.fetch_batch().result()
+        while batch:
+            batches.append([row.id for row in batch])
+            batch = rows.fetch_batch().result()
+        assert batches == [[0, 1, 2], [3, 4, 5], [6]]
+        assert rows.connection is None
+
+        # queries waiting for connections held by open results
+        # do not block workers fetching those results
+        query = sql.SqlBuilder().Select(adb.Users.id).From(adb.Users)
+        r1, r2 = [query.FetchFromAsync(adb, batch_size=5).result(5)
+                  for i in range(2)]
+        waiting = [query.FetchFromAsync(adb) for i in range(2)]
+        assert len(r1.fetch_batch().result(5)) == 5
+        assert len(r2.fetch_batch().result(5)) == 5
+        assert not [f for f in waiting if f.done()]
+        r1.close()
+        r2.close()
+        for future in waiting:
+            rows = future.result(5)
+            assert len(list(rows.rows)) == 7
+            rows.close()
+
+        # errors are raised from result()
+        future = sql.SqlBuilder().Select().From(adb.Missing
+            ).FetchFromAsync(adb)
+        try:
+            future.result()
+            raise AssertionError("missing table must raise")
+        except sql.sqlite3.OperationalError:
+            pass
+        assert 'no such table' in str(future.exception())
+        # as well as those of connecting
+        bad = sql.AsyncDb(engine='sqlite', workers=1,
+                          name=os.path.join(tmp, 'missing', 'db'))
+        assert isinstance(sql.SqlBuilder().Select().From(bad.Users
+            ).FetchFromAsync(bad).exception(5), sql.sqlite3.OperationalError)
+        bad.shutdown()
+        assert adb._pool.idle.qsize() == adb._pool.size
+        adb.shutdown()
+    finally:
+        shutil.rmtree(tmp)
+
+# shared condition, must not be changed by queries using it
+ACTIVE = db.Users.active == 1
+
+def test_immutable_exprs():
+    sql.Literal.default_db = 'sqlite'
+    q1 = sql.SqlBuilder().Select().From(db.Users).Where(ACTIVE
+        ).And(db.Users.age > 18)
+    q2 = sql.SqlBuilder().Select().From(db.Users).Where(ACTIVE
+        ).Or(db.Users.admin == 1)
+    assert str(ACTIVE) == "(Users.active = 1)"
+    assert str(q1.where_conds) == "((Users.active = 1) AND (Users.age > 18))"
+    assert str(q2.where_conds) == "((Users.active = 1) OR (Users.admin = 1))"
+    base = ACTIVE & (db.Users.age > 18)
+    assert str(base & (db.Users.id == 3)) == \
+        "((Users.active = 1) AND (Users.age > 18) AND (Users.id = 3))"
+    assert str(base) == "((Users.active = 1) AND (Users.age > 18))"
+    assert str(sql.Max(base)) == "MAX((Users.active = 1) AND (Users.age > 18))"
+    assert str(base) == "((Users.active = 1) AND (Users.age > 18))"
+
+    # structurally equal trees are the same object
+    assert (db.Users.age > 18).same(db.Users.age > 18)
+    assert q1.where_conds is base
+    assert not (db.Users.age > 18).same(db.Users.age > 18.0)
+    assert not db.a.b._in_((1, 2)).same(db.a.b._in_((True, 2)))
+    assert db.a.b._in_([1, [2]]) is db.a.b._in_([1, [2]])
+    # values are copied, generators are not used up by building the key
+    assert str(db.a.b._in_(x for x in [1, 2])) == "(a.b IN (1, 2))"
+    # and lists changed later do not change the Expr, nor equal ones
+    ids = [1, 2]
+    expr = db.a.b._in_(ids)
+    ids.append(3)
+    assert str(expr) == "(a.b IN (1, 2))"
+    assert str(db.a.b._in_([1, 2])) == "(a.b IN (1, 2))"
+    assert str(db.a.b._in_(ids)) == "(a.b IN (1, 2, 3))"
+    cache = {base: 'cached'}
+    assert cache[ACTIVE & (db.Users.age > 18)] == 'cached'
+    try:
+        base.operator = 'OR'
+        raise AssertionError("Expr must be immutable")
+    except AttributeError:
+        pass
+    sql.Literal.default_db = None
+
+def test_large_exprs():
+    sql.Literal.default_db = 'sqlite'
+    terms = [db.a.b == i for i in range(10000)]
+    query = sql.SqlBuilder().Select().From(db.a).Where(db.a.c == 1
+        ).Or(*terms)
+    assert len(query.where_conds.children) == 2
+    assert len(query.where_conds.children[1].children) == 10000
+    # chains of operators take linear time too
+    assert E.combine('OR', terms) is reduce(lambda x, y: x | y, terms)
+    assert len(reduce(lambda x, y: x & y, terms).children) == 10000
+    assert not E.make((terms[0] | terms[1], terms[2]), 'OR').same(
+        terms[0] | terms[1] | terms[2])
+    assert query.sql(db='sqlite').endswith("OR (a.b = 9999)))")
+    assert E.combine('AND', terms[:2]) is terms[0] & terms[1]
+    assert E.combine('AND', [terms[0]]) is terms[0]
+
+    # deeper than Python recursion limit
+    expr = db.a.b == 0
+    for i in range(2000):
+        expr = (expr | (db.a.c == i)) & (db.a.d == i)
+    assert str(expr).startswith("(((" * 10)
+    assert str(expr).endswith("(a.d = 1999))")
+
+    # IS NULL for NULL Params too
+    query = sql.SqlBuilder().Select().From(db.a).Where(db.a.b == P('b'))
+    query.params = {'b': None}
+    assert query.sql(db='sqlite') == "SELECT * FROM a WHERE (a.b IS NULL)"
+    assert query.sql(db='sqlite', paramstyle='qmark', args=[]) == \
+        "SELECT * FROM a WHERE (a.b IS ?)"
+    assert str(db.a.b != E(None)) == "(a.b IS NOT NULL)"
+    sql.Literal.default_db = None
+
+def test_large_in():
+    assert L([1, 2L, 3]).sql(db='sqlite') == "(1, 2, 3)"
+    assert L(["a'", "b"]).sql(db='sqlite') == "('a''', 'b')"
+    assert L((1, 'b', None)).sql(db='sqlite') == "(1, 'b', NULL)"
+    assert L(x for x in (1, 2)).sql(db='sqlite') == "(1, 2)"
+    assert L([1, "a'"]).sql(db='sqlite', in_threshold=1) == \
+        "(SELECT value FROM json_each('[1, \"a''\"]'))"
+    args = []
+    assert sql.bind_param('x', [1, 2], 'qmark', args, 1) == \
+        "(SELECT value FROM json_each(?))"
+    assert args == ['[1, 2]']
+    # on by default only when sqlite has JSON1 extension
+    assert sql.Db(engine='sqlite', name=':memory:')._settings[
+        'in_threshold'] == (500 if sql.sqlite_json_arrays() else None)
+
+    ids = range(0, 3000, 3)
+    logins = ['u%d' % i for i in range(1, 3000, 3)]
+    for paramstyle in (None, ) + sql.PARAMSTYLES:
+        idb = sql.Db(engine='sqlite', name=':memory:', paramstyle=paramstyle,
+                     in_threshold=100)
+        idb._execute("CREATE TABLE Users (id integer, login varchar(35))")
+        sql.SqlBuilder().Insert(idb.Users, 'id', 'login').Values(
+            (i, 'u%d' % i) for i in range(3000)).FetchFrom(idb)
+        query = sql.SqlBuilder().Select(sql.Count()).From(idb.Users
+            ).Where(idb.Users.id._in_(ids) | idb.Users.login._in_(P('l')))
+        query.params = {'l': logins}
+        assert query.FetchFrom(idb).next()[0] == 2000
+        assert query.Prepare(idb).FetchFrom(idb, {'l': logins[:10]}
+            ).next()[0] == 1010
+
+
+def test_dialects():
+    """Literals are converted by dialect found once per query"""
+
+    class Name(str):
+        pass
+
+    value = "it's\n\\"
+    assert L(value).sql(db='sqlite') == "'it''s\n\\'"
+    assert L(value).sql(db='mysql') == "'it''s\\n\\\\'"
+    assert L(unicode(value)).sql(db='postgres') == u"'it''s\\n\\\\'"
+    assert L(Name("o'k")).sql(db='sqlite') == "'o''k'"
+    assert L(decimal.Decimal('1.50')).sql(db='sqlite') == "1.50"
+    assert L(True).sql(db='sqlite') == "1"
+    assert L(True).sql(db='rdbhost') == "'t'"
+    assert L([Name('a'), 1]).sql(db='mysql') == "('a', 1)"
+    dialect = sql.get_dialect('postgres')
+    assert sql.get_dialect(dialect) is dialect
+    assert db.dialect is sql.get_dialect('sqlite')
+    assert E(db.Users.flag == False).sql(db=dialect
+        ) == "(Users.flag = 'f')"
+    for name in (None, 'oracle'):
+        try:
+            L(1).sql(db=name)
+        except Exception, e:
+            assert str(e) in ("Undefined db", "Database oracle unknown")
+        else:
+            assert False, "Unknown dialect accepted"
+
+
+def test_result_cache():
+    """SELECT results are replayed until tables they read are written"""
+    cdb = sql.Db(engine='sqlite', name=':memory:', paramstyle='qmark',
+                 cache_size=2)
+    cdb._execute("CREATE TABLE Users (id integer, login varchar(35))")
+    cdb._execute("CREATE TABLE Groups (id integer, name varchar(35))")
+    sql.SqlBuilder().Insert(cdb.Users, 'id', 'login').Values(
+        [(1, 'joe'), (2, 'ann')]).FetchFrom(cdb)
+    query = sql.SqlBuilder().Select(cdb.Users.login).From(cdb.Users
+        ).Where(cdb.Users.id > P('id'))
+    query.params = {'id': 0}
+    assert query.tables() == set(['users'])
+    assert [r.login for r in query.FetchFrom(cdb)] == ['joe', 'ann']
+    # raw writes are not seen until invalidated
+    cdb._execute("UPDATE Users SET login = 'bob' WHERE id = 1")
+    rows = query.FetchFrom(cdb, batch_size=1)
+    assert [r.login for r in rows] == ['joe', 'ann']
+    assert query.FetchColumns(cdb)['login'] == ['joe', 'ann']
+    assert len(list(query.FetchFrom(cdb).iter_batches(1))) == 2
+    cdb.invalidate(cdb.Groups)
+    assert query.FetchFrom(cdb).next().login == 'joe'
+    cdb.invalidate('USERS')
+    assert query.FetchFrom(cdb).next().login == 'bob'
+    # different params are cached separately
+    query.params = {'id': 1}
+    assert [r.login for r in query.FetchFrom(cdb)] == ['ann']
+    # writes through SqlBuilder invalidate tables they touch
+    prepared = query.Prepare(cdb)
+    assert prepared.FetchFrom(cdb, {'id': 0}).next().login == 'bob'
+    sql.SqlBuilder().Update(cdb.Users).Set(login='max').Where(
+        cdb.Users.id == 1).FetchFrom(cdb)
+    assert prepared.FetchFrom(cdb, {'id': 0}).next().login == 'max'
+    # least recently used are dropped
+    joined = sql.SqlBuilder().Select(cdb.Groups.name).From(cdb.Groups
+        ).LeftJoin((cdb.Users, 'u'), cdb.Groups.id == cdb.u.id)
+    assert joined.tables() == set(['users', 'groups'])
+    assert list(joined.FetchFrom(cdb)) == []
+    assert len(cdb._cache.entries) == 2
+    sql.SqlBuilder().Insert(cdb.Groups, 'id', 'name').Values(
+        [(1, 'admins')]).FetchFrom(cdb)
+    assert len(cdb._cache.entries) == 1
+    assert joined.FetchFrom(cdb).next().name == 'admins'
+    # results read in batches, or too large, are not stored
+    cdb = sql.Db(engine='sqlite', name=':memory:', cache_size=10,
+                 cache_rows=2)
+    cdb._execute("CREATE TABLE Users (id integer)")
+    sql.SqlBuilder().Insert(cdb.Users, 'id').Values(
+        (i, ) for i in range(5)).FetchFrom(cdb)
+    query = sql.SqlBuilder().Select(cdb.Users.id).From(cdb.Users)
+    assert [row.id for row in query.FetchFrom(cdb)] == range(5)
+    assert query.FetchColumns(cdb, batch_size=2)['id'].tolist() == range(5)
+    assert [len(b) for b in query.FetchFrom(cdb).iter_batches(2)] == \
+        [2, 2, 1]
+    query.Where(cdb.Users.id < 2)
+    assert [row.id for row in query.FetchFrom(cdb, batch_size=1)] == [0, 1]
+    assert not cdb._cache.entries
+    assert [row.id for row in query.FetchFrom(cdb)] == [0, 1]
+    assert len(cdb._cache.entries) == 1
+
+
+def test_result_cache_pool():
+    """Results read while others write are dropped once writes commit"""
+    tmp = tempfile.mkdtemp()
+    try:
+        cdb = sql.Db(engine='sqlite', name=os.path.join(tmp, 'db'),
+                     pool_size=2, cache_size=10)
+        with cdb.checkout():
+            cdb._execute("CREATE TABLE Users (id integer, age integer)")
+            sql.SqlBuilder().Insert(cdb.Users, 'id', 'age').Values(
+                [(1, 0)]).FetchFrom(cdb)
+        query = sql.SqlBuilder().Select(cdb.Users.age).From(cdb.Users)
+        ages = lambda: [row.age for row in query.FetchFrom(cdb)]
+        written = threading.Event()
+        read = threading.Event()
+        seen = []
+
+        def writer():
+            with cdb.checkout():
+                with cdb.transaction():
+                    sql.SqlBuilder().Update(cdb.Users).Set(age=1
+                        ).FetchFrom(cdb)
+                    # uncommitted rows are not cached for others
+                    seen.append(ages())
+                    written.set()
+                    read.wait(5)
+        thread = threading.Thread(target=writer)
+        thread.start()
+        written.wait(5)
+        with cdb.checkout():
+            assert ages() == [0]
+        read.set()
+        thread.join()
+        assert seen == [[1]]
+        with cdb.checkout():
+            assert ages() == [1]
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_result_cache_ttl():
+    """Cached results expire"""
+    cache = sql.ResultCache(10, ttl=0.01)
+    cache.put('q', set(['users']), 1)
+    assert cache.get('q') == 1
+    time.sleep(0.02)
+    assert cache.get('q') is None
+    assert not cache.entries
+
+
+def test_hooks():
+    """Query phases, rows and errors are reported to hooks"""
+    hdb = sql.Db(engine='sqlite', name=':memory:', paramstyle='qmark',
+                 cache_size=10, slow_query_time=0)
+    hdb._execute("CREATE TABLE Users (id integer, login varchar(35))")
+    reported = []
+    hdb.add_hook(reported.append)
+    sql.SqlBuilder().Insert(hdb.Users, 'id', 'login').Values(
+        (i, 'u%d' % i) for i in range(5)).FetchFrom(hdb)
+    assert reported[-1].query_type == sql.INSERT
+    assert reported[-1].rows == 5
+    query = sql.SqlBuilder().Select(hdb.Users.login).From(hdb.Users
+        ).Where(hdb.Users.id > P('id'))
+    query.params = {'id': 1}
+    rows = query.FetchFrom(hdb)
+    assert len(reported) == 1, "Reported before rows are fetched"
+    assert len(list(rows)) == 3
+    stats = reported[-1]
+    assert stats.query_type == sql.SELECT
+    assert stats.sql == "SELECT Users.login FROM Users WHERE (Users.id > ?)"
+    assert stats.args == [1] and stats.params == {'id': 1}
+    assert stats.rows == 3 and not stats.cached
+    assert stats.build >= 0 and stats.render >= 0 and stats.fetch >= 0
+    assert stats.duration() >= stats.execute > 0
+    assert query.FetchColumns(hdb)['login'] == ['u2', 'u3', 'u4']
+    assert reported[-1].cached and reported[-1].build is None
+    rows = query.Prepare(hdb).FetchFrom(hdb, {'id': 3})
+    rows.next()
+    assert len(reported) == 3, "Reported before rows are exhausted"
+    # rows left unread are reported once closed
+    rows.close()
+    assert len(reported) == 4 and reported[-1].rows == 1
+    rows.close()
+    # or with the next query once dropped
+    query.Prepare(hdb).FetchFrom(hdb, {'id': 2}).next()
+    assert len(reported) == 4, "Hooks called by garbage collector"
+    sql.SqlBuilder().Delete().From(hdb.Users).Where(hdb.Users.id < 2
+        ).FetchFrom(hdb)
+    assert len(reported) == 6 and reported[-2].rows == 1
+    assert reported[-1].query_type == sql.DELETE
+    assert reported[-1].rows == 2
+    sql.SqlBuilder().Update(hdb.Users).Set(login=P('login')).Where(
+        hdb.Users.id == P('id')).ExecuteMany(hdb, [{'id': 2, 'login': 'x'}])
+    assert reported[-1].rows == 1
+    try:
+        sql.SqlBuilder().Select().From(hdb.Nothing).FetchFrom(hdb)
+    except sql.sqlite3.OperationalError:
+        pass
+    assert isinstance(reported[-1].error, sql.sqlite3.OperationalError)
+    assert len(hdb.slow_queries.entries) == len(reported)
+    hdb.remove_hook(reported.append)
+    list(query.FetchFrom(hdb))
+    assert len(hdb.slow_queries.entries) == len(reported) + 1
+
+
+def test_fingerprint():
+    """Queries differing only by values have the same shape"""
+    def query(login, age, ids):
+        return sql.SqlBuilder().Select(db.Users.id).From(db.Users
+            ).Where(db.Users.login == login).And(db.Users.age > P(age),
+            db.Users.id._in_(ids)).Limit(ids[0])
+    first = query('joe', 'a', [1, 2])
+    assert first.shape() == "SELECT Users.id FROM Users WHERE " \
+        "((Users.login = ?) AND ((Users.age > ?) AND (Users.id IN ?))) LIMIT ?"
+    assert first.fingerprint() == query("ann", 'b', [3]).fingerprint()
+    assert first.fingerprint() != query(None, 'a', [1]).fingerprint()
+    assert len(first.fingerprint()) == 16
+
+
+def test_metrics():
+    """Calls, errors, latency and rows are aggregated by query shape"""
+    mdb = sql.Db(engine='sqlite', name=':memory:', metrics=True)
+    mdb._execute("CREATE TABLE Users (id integer, login varchar(35))")
+    mdb._execute("CREATE TABLE Groups (id integer)")
+    sql.SqlBuilder().Insert(mdb.Users).Values(
+        {'id': i, 'login': 'u%d' % i} for i in range(20)).FetchFrom(mdb)
+    sql.SqlBuilder().Insert(mdb.Groups).Values([{'id': 1}]).FetchFrom(mdb)
+    for i in range(3):
+        list(sql.SqlBuilder().Select(mdb.Users.id).From(mdb.Users
+            ).Where(mdb.Users.id < i * 10).FetchFrom(mdb))
+    try:
+        sql.SqlBuilder().Select().From(mdb.Nothing).FetchFrom(mdb)
+    except sql.sqlite3.OperationalError:
+        pass
+    metrics = mdb.metrics.as_dict()
+    assert len(metrics) == 4
+    assert sorted(m['shape'] for m in metrics.values()
+                  if m['query_type'] == 'INSERT') == \
+        ['INSERT INTO Groups', 'INSERT INTO Users']
+    select = [m for m in metrics.values()
+              if m['shape'].startswith('SELECT Users.id')][0]
+    assert select['calls'] == 3 and select['errors'] == 0
+    assert select['rows']['sum'] == 30
+    assert select['rows']['buckets'][:4] == [(0, 1), (1, 1), (10, 2),
+                                             (100, 3)]
+    assert select['latency']['buckets'][-1] == (float('inf'), 3)
+    assert sum(m['errors'] for m in metrics.values()) == 1
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'sql.prom')
+        mdb.metrics.write_prometheus(path)
+        text = open(path).read()
+    finally:
+        shutil.rmtree(tmp)
+    fingerprint = [f for f, m in metrics.items() if m is select][0]
+    labels = 'fingerprint="%s",type="SELECT"' % fingerprint
+    assert "# TYPE sql_query_duration_seconds histogram" in text
+    assert "sql_queries_total{%s} 3\n" % labels in text
+    assert 'sql_query_rows_bucket{%s,le="10"} 2\n' % labels in text
+    assert 'sql_query_rows_bucket{%s,le="+Inf"} 3\n' % labels in text
+    assert "sql_query_rows_sum{%s} 30\n" % labels in text
+
+
+def test_explain():
+    """Query plans are returned as trees, full scans are found"""
+    edb = sql.Db(engine='sqlite', name=':memory:', paramstyle='qmark')
+    edb._execute("CREATE TABLE Users (id integer PRIMARY KEY, age integer)")
+    edb._execute("CREATE TABLE Rights (user_id integer, name varchar(35))")
+    query = sql.SqlBuilder().Select(edb.r.name).From((edb.Rights, 'r')
+        ).InnerJoin((edb.Users, 'u'), edb.r.user_id == edb.u.id
+        ).Where(edb.u.age > P('age'))
+    query.params = {'age': 1}
+    assert query.aliases() == {'u': 'Users', 'r': 'Rights'}
+    plan = query.Explain(edb)
+    assert [n.detail.split()[0] for n in plan] == ['SCAN', 'SEARCH']
+    assert plan.full_scans() == ['r']
+    assert "USING INTEGER PRIMARY KEY" in plan.dump()
+    edb._execute("CREATE INDEX rights_user ON Rights (user_id)")
+    by_user = sql.SqlBuilder().Select(edb.Rights.name).From(edb.Rights
+        ).Where(edb.Rights.user_id._in_(P('ids')))
+    by_user.params = {'ids': range(1000)}
+    plan = by_user.Explain(edb)
+    assert len(list(plan)) > 1, "No IN list subquery"
+    assert plan.full_scans() == []
+    assert sql.SqlBuilder().Insert(edb.Users, 'id', 'age').Explain(edb
+        ).full_scans() == []
+
+
+def test_full_scan_check():
+    """Db warns of queries scanning large tables"""
+    sdb = sql.Db(engine='sqlite', name=':memory:', full_scan_rows=2)
+    sdb._execute("CREATE TABLE Users (id integer PRIMARY KEY, age integer)")
+    sql.SqlBuilder().Insert(sdb.Users, 'id', 'age').Values(
+        [(1, 10), (2, 20)]).FetchFrom(sdb)
+    query = sql.SqlBuilder().Select(sdb.u.id).From((sdb.Users, 'u')
+        ).Where(sdb.u.age > 15)
+    by_id = sql.SqlBuilder().Select(sdb.Users.age).From(sdb.Users
+        ).Where(sdb.Users.id == 2)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always', sql.FullScanWarning)
+        assert len(list(query.FetchFrom(sdb))) == 1
+        assert not caught, "Small table reported"
+        sdb._execute("INSERT INTO Users VALUES (3, 30)")
+        assert len(list(query.FetchFrom(sdb))) == 2
+        assert by_id.FetchFrom(sdb).next().age == 20
+        assert len(caught) == 1
+        assert issubclass(caught[0].category, sql.FullScanWarning)
+        assert "Full scan of Users, 3 rows" in str(caught[0].message)
+        warnings.simplefilter('error', sql.FullScanWarning)
+        try:
+            query.Prepare(sdb).FetchFrom(sdb)
+        except sql.FullScanWarning:
+            pass
+        else:
+            assert False, "Full scan of prepared query not reported"
+
+
+def test_paginate():
+    """Rows are walked by pages of keyset queries, resumable by token"""
+    pdb = sql.Db(engine='sqlite', name=':memory:', paramstyle='qmark')
+    pdb._execute("CREATE TABLE Users (id integer PRIMARY KEY, "
+                 "login varchar(35), age integer)")
+    sql.SqlBuilder().Insert(pdb.Users, 'id', 'login', 'age').Values(
+        (i, 'u%02d' % i, i % 3) for i in range(50, 0, -1)).FetchFrom(pdb)
+    query = sql.SqlBuilder().Select(pdb.Users.login, (pdb.Users.id, 'i')
+        ).From(pdb.Users).Where(pdb.Users.age != P('age'))
+    query.params = {'age': 0}
+    assert query.OrderBy((pdb.Users.age, 'DESC'), pdb.Users.id).sql(
+        db='sqlite', slots=[]).endswith(
+        "ORDER BY Users.age DESC, Users.id")
+    query.order_fields = []
+    pages = query.Paginate(pdb, pdb.Users.id, page_size=10)
+    assert pages.token is None
+    first = pages.next()
+    assert [r.i for r in first] == [1, 2, 4, 5, 7, 8, 10, 11, 13, 14]
+    assert len(first[0]) == 2
+    # restart after the first page
+    resumed = query.Paginate(pdb, pdb.Users.id, 10, token=pages.token)
+    rest = list(resumed)
+    assert [len(p) for p in rest] == [10, 10, 4]
+    assert [r.login for r in rest[-1]] == ['u46', 'u47', 'u49', 'u50']
+    assert list(resumed) == []
+    assert [[r.i for r in p] for p in rest] == \
+        [[r.i for r in p] for p in pages]
+    # not selected key is added, * is replaced by tables
+    rows = [r for p in sql.SqlBuilder().Select().From(pdb.Users
+            ).Paginate(pdb, pdb.Users.id, 20) for r in p]
+    assert len(rows) == 50
+    assert tuple(rows[-1]) == (50, 'u50', 2, 50)
+    assert rows[0].login == 'u01'
+    try:
+        query.Paginate(pdb, pdb.Users.id, token='junk').next()
+    except Exception, e:
+        assert str(e) == "Invalid page token 'junk'"
+    else:
+        assert False, "Invalid token accepted"
+
+
+def test_export():
+    """Rows are written to files in batches"""
+    xdb = sql.Db(engine='sqlite', name=':memory:')
+    xdb._execute("CREATE TABLE Users (id integer, login varchar(35))")
+    sql.SqlBuilder().Insert(xdb.Users, 'id', 'login').Values(
+        [(1, u'j\xf6e'), (2, 'a,"b"'), (3, None)]).FetchFrom(xdb)
+    query = sql.SqlBuilder().Select((xdb.Users.id, 'UserId'), xdb.Users.login,
+        xdb.Users.id + 1).From(xdb.Users).Where(xdb.Users.id > P('id'))
+    query.params = {'id': 1}
+    out = cStringIO.StringIO()
+    stats = query.ExportTo(xdb, out, batch_size=1)
+    assert stats['rows'] == 2 and stats['seconds'] >= 0
+    assert list(csv.reader(cStringIO.StringIO(out.getvalue()))) == [
+        ['UserId', 'login', '(Users.id + 1)'], ['2', 'a,"b"', '3'],
+        ['3', '', '4']]
+    query.params = {'id': 0}
+    out = cStringIO.StringIO()
+    query.ExportTo(xdb, out, format='jsonl', batch_size=2)
+    lines = [json.loads(l) for l in out.getvalue().splitlines()]
+    assert lines[0] == {'UserId': 1, 'login': u'j\xf6e', '(Users.id + 1)': 2}
+    assert len(lines) == 3 and lines[2]['login'] is None
+    out = cStringIO.StringIO()
+    sql.SqlBuilder().Select().From(xdb.Users).ExportTo(
+        xdb, out, format='columns', batch_size=2)
+    assert [json.loads(l) for l in out.getvalue().splitlines()] == [
+        ['id', 'login'], [[1, 2], [u'j\xf6e', 'a,"b"']], [[3], [None]]]
+    # rows are not loaded into the result cache
+    cdb = sql.Db(engine='sqlite', name=':memory:', cache_size=10)
+    cdb._execute("CREATE TABLE Users (id integer)")
+    sql.SqlBuilder().Insert(cdb.Users, 'id').Values([(1, ), (2, )]
+        ).FetchFrom(cdb)
+    out = cStringIO.StringIO()
+    assert sql.SqlBuilder().Select().From(cdb.Users).ExportTo(
+        cdb, out)['rows'] == 2
+    assert not cdb._cache.entries
+
+
+def test_schema():
+    """Fields and types of operands are checked against the database"""
+    sdb = sql.Db(engine='sqlite', name=':memory:', check_schema=True)
+    sdb._execute("CREATE TABLE Users (id integer PRIMARY KEY, "
+                 "login varchar(35), score double, born date, data)")
+    assert sdb.schema.columns('USERS') == {'id': 'INTEGER', 'login': 'TEXT',
+        'score': 'REAL', 'born': 'NUMERIC', 'data': 'BLOB'}
+    sdb.Users.id == 1
+    sdb.Users.Login != u'joe'
+    sdb.Users.id._in_([1, 2L, True, '3'])
+    sdb.Users.score > decimal.Decimal('1.5')
+    sdb.Users.login < datetime.date(2010, 1, 1)
+    sdb.Users.born > 'yesterday'
+    sdb.Users.data == 5
+    sdb.Users.login == P('login')
+    sdb.Users.id == sdb.Users.score
+    sdb.Users.login != None
+    assert sdb.Users.id._in_(i for i in (1, 2)).sql(db='sqlite') == \
+        "(Users.id IN (1, 2))"
+    # aliases and unknown tables are not checked
+    sdb.u.login < 5
+    sdb.Groups.whatever == 'x'
+    for build, error in (
+            (lambda: sdb.Users.logn,
+             "Table Users has no column logn"),
+            (lambda: sdb.Users.login < 5,
+             "Users.login of TEXT type compared to 5"),
+            (lambda: sdb.Users.id == 'joe',
+             "Users.id of INTEGER type compared to 'joe'"),
+            (lambda: sdb.Users.login._in_(['a', sql.Literal(2)]),
+             "Users.login of TEXT type compared to 2"),
+            (lambda: sdb.Users.score < datetime.date(2010, 1, 1),
+             "Users.score of REAL type compared to datetime.date(2010, 1, 1)"),
+            (lambda: sdb.Users.id == sdb.Users.login,
+             "Users.id of INTEGER type compared to Users.login of TEXT")):
+        try:
+            build()
+        except sql.SchemaError, e:
+            assert str(e) == error, str(e)
+        else:
+            assert False, "No SchemaError: %s" % error
+    # tables created later are seen once the schema is refreshed
+    sdb._execute("CREATE TABLE Groups (id integer)")
+    sdb.Groups.id == 'x'
+    sdb.schema.refresh()
+    try:
+        sdb.Groups.id == 'x'
+    except sql.SchemaError:
+        pass
+    else:
+        assert False, "Schema not refreshed"
+    # checks are off by default
+    db.Users.login < 5
+    # tables named like attributes of Db
+    assert sdb.table('schema') is sdb.table('schema')
+    assert repr(sdb.table('metrics').id) == "<Field:metrics.id>"
+
+    # schema is loaded without keeping pooled connection with the thread
+    tmp = tempfile.mkdtemp()
+    try:
+        pdb = sql.Db(engine='sqlite', name=os.path.join(tmp, 'db'),
+                     pool_size=2, check_schema=True)
+        with pdb.checkout():
+            pdb._execute("CREATE TABLE Users (id integer)")
+        pdb.Users.id == 1
+        assert pdb._pool.idle.qsize() == pdb._pool.size
+        # nor takes it from the thread holding one
+        with pdb.checkout():
+            connection = pdb._connection()
+            pdb.schema.refresh()
+            assert pdb._connection() is connection
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_index_advisor():
+    """Indexes are suggested for columns queries filter and order by"""
+    adb = sql.Db(engine='sqlite', name=':memory:', paramstyle='qmark',
+                 index_advisor=True)
+    adb._execute("CREATE TABLE Users (id integer PRIMARY KEY, "
+                 "login varchar(35), age integer, group_id integer)")
+    adb._execute("CREATE TABLE Groups (id integer, name varchar(35))")
+    adb._execute("CREATE INDEX groups_name ON Groups (name, id)")
+    query = sql.SqlBuilder().Select(adb.u.login).From((adb.Users, 'u')
+        ).InnerJoin(adb.Groups, adb.Groups.id == adb.u.group_id
+        ).Where(adb.u.age > P('age')).And(adb.Groups.name == P('name'),
+        adb.u.login._in_(['a', 'b'])).OrderBy((adb.u.id, 'DESC'))
+    assert sorted(query.predicates()) == [
+        ('Groups', 'id', 'join'), ('Groups', 'name', 'equality'),
+        ('Users', 'age', 'range'), ('Users', 'group_id', 'join'),
+        ('Users', 'id', 'order'), ('Users', 'login', 'equality')]
+    for age in range(3):
+        query.params = {'age': age, 'name': 'staff'}
+        list(query.FetchFrom(adb))
+    by_id = sql.SqlBuilder().Select(adb.Users.login).From(adb.Users
+        ).Where(adb.Users.id == P('id')).Prepare(adb)
+    list(by_id.FetchFrom(adb, {'id': 1}))
+    list(sql.SqlBuilder().Select(adb.Users.id).From(adb.Users
+        ).OrderBy(adb.Users.age).FetchFrom(adb))
+    assert adb.index_advisor.columns[('Users', 'age', 'range')][0] == 3
+    suggestions = adb.index_advisor.suggestions()
+    assert [(s['table'], s['columns'], s['calls'])
+            for s in sorted(suggestions, key=lambda s: s['calls'])] == [
+        ('Users', ['age'], 1), ('Users', ['group_id', 'login', 'age'], 3)]
+    assert suggestions[0]['seconds'] >= suggestions[1]['seconds']
+    index = [s['index'] for s in suggestions if s['calls'] == 3][0]
+    assert index.sql() == "CREATE INDEX IF NOT EXISTS " \
+        "ix_users_group_id_login_age ON Users (group_id, login, age)"
+    index.FetchFrom(adb)
+    assert len(adb.index_advisor.suggestions()) == 1
+    assert sql.CreateIndex(adb.Users, adb.Users.login).Name('u_login'
+        ).Unique().sql() == \
+        "CREATE UNIQUE INDEX IF NOT EXISTS u_login ON Users (login)"
+
+    # branches of OR are served by indexes of their own
+    odb = sql.Db(engine='sqlite', name=':memory:', index_advisor=True)
+    odb._execute("CREATE TABLE Users (id integer, grp integer, age integer)")
+    query = sql.SqlBuilder().Select(odb.Users.id).From(odb.Users).Where(
+        (odb.Users.grp == 1) | (odb.Users.age == 2)).And(odb.Users.id > 3)
+    assert query.predicate_groups() == [[('Users', 'id', 'range')],
+        [('Users', 'grp', 'equality')], [('Users', 'age', 'equality')]]
+    list(query.FetchFrom(odb))
+    assert sorted(s['columns'] for s in odb.index_advisor.suggestions()) == \
+        [['age'], ['grp'], ['id']]
+
+
+def test_sharded():
+    """Queries are run on shards at once and their rows merged"""
+    tmp = tempfile.mkdtemp()
+    try:
+        sdb = sql.ShardedDb([{'engine': 'sqlite',
+                              'name': os.path.join(tmp, 'shard%d' % i)}
+                             for i in range(3)], key='id', bounds=[10, 20])
+        for shard in sdb.shards:
+            with shard.checkout():
+                shard._execute("CREATE TABLE Users "
+                               "(id integer, team varchar(10), age integer)")
+                shard._commit()
+        assert sql.SqlBuilder().Insert(sdb.Users, 'id', 'team', 'age').Values(
+            (i, 'ab'[i % 2], 30 - i) for i in range(25)).FetchFrom(sdb) == 25
+        counts = []
+        for shard in sdb.shards:
+            with shard.checkout():
+                counts.append(shard._execute(
+                    "SELECT COUNT(*) FROM Users").fetchone()[0])
+        assert counts == [10, 10, 5]
+
+        # ORDER BY is merged across shards, LIMIT applied to the whole
+        rows = sql.SqlBuilder().Select(sdb.Users.id, sdb.Users.age).From(
+            sdb.Users).OrderBy((sdb.Users.age, 'DESC')).Limit(4).FetchFrom(sdb)
+        assert [row.id for row in rows] == [0, 1, 2, 3]
+        query = sql.SqlBuilder().Select(sdb.Users.id).From(sdb.Users).Where(
+            sdb.Users.id._in_([3, 12, 14])).OrderBy(sdb.Users.id)
+        assert sdb.route(query) == [0, 1]
+        assert [row.id for row in query.FetchFrom(sdb)] == [3, 12, 14]
+        query = sql.SqlBuilder().Select(sdb.Users.team).From(sdb.Users).Where(
+            (sdb.Users.id == P('id')) & (sdb.Users.age > 0))
+        query.params = {'id': 22}
+        assert sdb.route(query) == [2]
+        assert [row.team for row in query.FetchFrom(sdb)] == ['a']
+
+        # aggregates are combined per group
+        rows = sql.SqlBuilder().Select(sdb.Users.team, (sql.Count(), 'n'),
+            sql.Sum(sdb.Users.age), sql.Max(sdb.Users.id)).From(sdb.Users
+            ).GroupBy(sdb.Users.team).OrderBy(sdb.Users.team).FetchFrom(sdb)
+        assert [tuple(row) for row in rows] == [
+            ('a', 13, 30 * 13 - 156, 24), ('b', 12, 30 * 12 - 144, 23)]
+        try:
+            sql.SqlBuilder().Select(sql.Avg(sdb.Users.age)).From(sdb.Users
+                ).FetchFrom(sdb)
+            raise AssertionError("AVG must not be combined")
+        except Exception, e:
+            assert 'AVG' in str(e)
+        try:
+            sql.SqlBuilder().Select((sql.Max(sdb.Users.age) + 1, 'm')).From(
+                sdb.Users).FetchFrom(sdb)
+            raise AssertionError("MAX within expression must not be combined")
+        except Exception, e:
+            assert 'MAX can not be combined' in str(e)
+
+        # rows are read from shards as they are fetched
+        rows = sql.SqlBuilder().Select(sdb.Users.id).From(sdb.Users
+            ).OrderBy(sdb.Users.id).FetchFrom(sdb)
+        idle = lambda: [shard._pool.idle.qsize() == shard._pool.size
+                        for shard in sdb.shards]
+        assert idle() == [False] * 3
+        assert [rows.next().id for i in range(12)] == range(12)
+        assert idle() == [False] * 3
+        assert [row.id for row in rows] == range(12, 25)
+        assert idle() == [True] * 3
+
+        # IN with a single value bound to Param is routed like =
+        query = sql.SqlBuilder().Select(sdb.Users.id).From(sdb.Users).Where(
+            sdb.Users.id._in_(P('id')))
+        query.params = {'id': 12}
+        assert sdb.route(query) == [1]
+
+        count = lambda: list(sql.SqlBuilder().Select(sql.Count()).From(
+            sdb.Users).FetchFrom(sdb))[0][0]
+        # rows missing the key are rejected, nothing is inserted
+        try:
+            sql.SqlBuilder().Insert(sdb.Users).Values(
+                [{'id': 1, 'team': 'a', 'age': 1},
+                 {'team': 'b', 'age': 2}]).FetchFrom(sdb)
+            raise AssertionError("Row without key must not be inserted")
+        except Exception, e:
+            assert 'Row 1 has no value of key id' in str(e)
+        assert count() == 25
+        # writes failing on a shard are rolled back on all of them
+        with sdb.shards[2].checkout():
+            sdb.shards[2]._execute("CREATE TRIGGER fail BEFORE DELETE ON "
+                                   "Users BEGIN SELECT RAISE(ABORT, 'x'); END")
+            sdb.shards[2]._commit()
+        try:
+            sql.SqlBuilder().Delete().From(sdb.Users).FetchFrom(sdb)
+            raise AssertionError("Failing DELETE must raise")
+        except sql.sqlite3.IntegrityError:
+            pass
+        assert count() == 25
+        with sdb.shards[2].checkout():
+            sdb.shards[2]._execute("DROP TRIGGER fail")
+            sdb.shards[2]._commit()
+
+        sql.SqlBuilder().Delete().From(sdb.Users).Where(
+            sdb.Users.age < 10).FetchFrom(sdb)
+        assert count() == 21
+        sdb.shutdown()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_transaction():
+    """Blocks are committed or rolled back, nested ones are savepoints"""
+    tdb = sql.Db(engine='sqlite', name=':memory:')
+    tdb._execute("CREATE TABLE Users (id integer PRIMARY KEY)")
+    ids = lambda: [row.id for row in sql.SqlBuilder().Select(tdb.Users.id
+        ).From(tdb.Users).OrderBy(tdb.Users.id).FetchFrom(tdb)]
+    insert = lambda *ids: sql.SqlBuilder().Insert(tdb.Users, 'id').Values(
+        (i, ) for i in ids).FetchFrom(tdb)
+    with tdb.transaction():
+        insert(1, 2)
+        try:
+            with tdb.transaction():
+                insert(3)
+                insert(4, 1)
+        except sql.sqlite3.IntegrityError:
+            pass
+        insert(5)
+    # the block is committed
+    tdb._connection().rollback()
+    assert ids() == [1, 2, 5]
+    try:
+        with tdb.transaction():
+            sql.SqlBuilder().Delete().From(tdb.Users).FetchFrom(tdb)
+            assert ids() == []
+            raise ValueError
+    except ValueError:
+        pass
+    assert ids() == [1, 2, 5]
+    # failed insert alone is rolled back as a whole
+    try:
+        insert(6, 2)
+    except sql.sqlite3.IntegrityError:
+        pass
+    assert ids() == [1, 2, 5]
+
+
+def test_write_queue():
+    """Writes of many threads are committed in groups"""
+    tmp = tempfile.mkdtemp()
+    try:
+        wdb = sql.Db(engine='sqlite', name=os.path.join(tmp, 'db'),
+                     pool_size=4)
+        with wdb.checkout():
+            wdb._execute("CREATE TABLE Users (id integer PRIMARY KEY, "
+                         "age integer)")
+            wdb._commit()
+        writer = sql.WriteQueue(wdb, size=10, batch_size=5)
+        futures = []
+
+        def worker(start):
+            for i in range(start, start + 10):
+                futures.append(writer.submit(sql.SqlBuilder().Insert(
+                    wdb.Users, 'id', 'age').Values([(i, 20)])))
+        threads = [threading.Thread(target=worker, args=(i * 10, ))
+                   for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert [f.result(timeout=5) for f in futures] == [1] * 30
+        assert writer.submit(sql.SqlBuilder().Update(wdb.Users).Set(
+            age=30).Where(wdb.Users.id < 5)).result(5) == 5
+        # failing write does not affect others
+        failed = writer.submit(sql.SqlBuilder().Insert(wdb.Users, 'id'
+            ).Values([(1, )]))
+        deleted = writer.submit(sql.SqlBuilder().Delete().From(wdb.Users
+            ).Where(wdb.Users.age == 20))
+        writer.shutdown()
+        assert isinstance(failed.exception(), sql.sqlite3.IntegrityError)
+        assert deleted.result() == 25
+        # no writes are queued once shut down
+        try:
+            writer.submit(sql.SqlBuilder().Delete().From(wdb.Users))
+            raise AssertionError("Write queued after shutdown")
+        except Exception, e:
+            assert 'shut down' in str(e)
+        writer.shutdown()
+        with wdb.checkout():
+            assert [tuple(row) for row in sql.SqlBuilder().Select().From(
+                wdb.Users).FetchFrom(wdb)] == [(i, 30) for i in range(5)]
+
+        # writes fail when no connection is there for the writer
+        wdb = sql.Db(engine='sqlite', name=os.path.join(tmp, 'db'),
+                     pool_size=1, pool_timeout=0.2)
+        writer = sql.WriteQueue(wdb)
+        with wdb.checkout():
+            future = writer.submit(sql.SqlBuilder().Delete().From(wdb.Users))
+            assert 'No free connection' in str(future.exception(2))
+        writer.shutdown()
+    finally:
+        shutil.rmtree(tmp)